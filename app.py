@@ -1,21 +1,34 @@
 import streamlit as st
+from streamlit import runtime
 import pandas as pd
+import numpy as np
 import io
+import os
 import base64
+import time
+import hashlib
+import tempfile
+import threading
+import importlib
+import importlib.util
+import argparse
+import fnmatch
+import glob
+import json
+import sys
+import re
+import unicodedata
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from difflib import SequenceMatcher
 import openpyxl
-from typing import List, Dict, Tuple, Optional
+from collections.abc import Mapping
+from typing import List, Dict, Tuple, Optional, Callable, Union
 import plotly.express as px
 import plotly.graph_objects as go
 
-# Page configuration
-st.set_page_config(
-    page_title="File Merger - by Bot Aom",
-    page_icon="📁",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
-
 # Custom CSS for Earth Tone theme
 def load_css():
     st.markdown("""
@@ -135,47 +148,1705 @@ def load_css():
     </style>
     """, unsafe_allow_html=True)
 
+# Reader engines selectable in the sidebar. Each maps to the pandas engine used
+# for CSV and Excel (None keeps pandas' default) and the modules it needs.
+READER_ENGINES = {
+    'pandas': {'label': 'pandas (มาตรฐาน)', 'csv': 'c', 'excel': None, 'requires': []},
+    'pyarrow': {'label': 'PyArrow (CSV เร็ว)', 'csv': 'pyarrow', 'excel': None, 'requires': ['pyarrow']},
+    'calamine': {'label': 'Calamine (Excel เร็ว)', 'csv': 'c', 'excel': 'calamine', 'requires': ['python_calamine'],
+                 'min_pandas': (2, 2)},
+}
+PANDAS_VERSION = tuple(int(part) for part in pd.__version__.split('.')[:2])
+STREAMLIT_VERSION = tuple(int(part) for part in st.__version__.split('.')[:2])
+DEFAULT_READER_ENGINE = os.environ.get('FILE_MERGER_READER_ENGINE', 'auto')
+
+# Per-stage rerun timings are logged at INFO, FILE_MERGER_LOG_LEVEL=INFO prints them
+logger = logging.getLogger('file_merger')
+if os.environ.get('FILE_MERGER_LOG_LEVEL') and not logger.handlers:
+    logger.setLevel(os.environ['FILE_MERGER_LOG_LEVEL'].upper())
+    logger.addHandler(logging.StreamHandler())
+
+# Download formats: file extension, MIME type, offered compressions and required modules
+EXPORT_FORMATS = {
+    'csv': {'label': 'CSV', 'extension': 'csv', 'mime': 'text/csv', 'compressions': [None], 'requires': []},
+    'parquet': {'label': 'Parquet', 'extension': 'parquet', 'mime': 'application/vnd.apache.parquet',
+                'compressions': ['snappy', 'zstd', 'gzip', None], 'requires': ['pyarrow']},
+    'feather': {'label': 'Arrow / Feather', 'extension': 'feather', 'mime': 'application/vnd.apache.arrow.file',
+                'compressions': ['lz4', 'zstd', None], 'requires': ['pyarrow']},
+    'xlsx': {'label': 'Excel (xlsx)', 'extension': 'xlsx',
+             'mime': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+             'compressions': [None], 'requires': []},
+}
+# Excel's row limit, one row is left for the header
+XLSX_MAX_ROWS = 1_048_575
+# Exports stay in memory up to this size, then spill to a temporary file on disk
+EXPORT_SPOOL_BYTES = int(os.environ.get('FILE_MERGER_EXPORT_SPOOL_MB', 64)) * 1024 * 1024
+# Row hashes the streaming dedupe keeps in memory before spilling sorted runs to disk
+DEDUPE_MEMORY_ROWS = int(os.environ.get('FILE_MERGER_DEDUPE_MEMORY_ROWS', 2_000_000))
+JOIN_TYPES = ('left', 'inner', 'outer')
+JOIN_STRATEGIES = ('auto', 'hash', 'sort')
+# Conditions and aggregates the query stage evaluates during the scan
+QUERY_OPERATORS = ('==', '!=', '>', '>=', '<', '<=', 'in', 'between', 'contains')
+QUERY_AGGREGATES = ('count', 'sum', 'mean', 'min', 'max')
+# Streamlit 1.52 accepts a callable and only builds the download on click
+DEFERRED_DOWNLOADS = STREAMLIT_VERSION >= (1, 52)
+
+def is_module_available(module: str) -> bool:
+    """Check whether an optional dependency can be imported"""
+    return importlib.util.find_spec(module) is not None
+
+def available_reader_engines() -> List[str]:
+    """List reader engines whose backends are installed, 'auto' first"""
+    return ['auto'] + [
+        name for name, spec in READER_ENGINES.items()
+        if all(is_module_available(m) for m in spec['requires'])
+        and PANDAS_VERSION >= spec.get('min_pandas', (0, 0))
+    ]
+
+def available_export_formats() -> List[str]:
+    """List export formats whose writers are installed"""
+    return [
+        name for name, spec in EXPORT_FORMATS.items()
+        if all(is_module_available(m) for m in spec['requires'])
+    ]
+
+def resolve_reader_engines(engine: str = 'auto') -> Dict[str, Optional[str]]:
+    """Map a reader engine name to the pandas CSV/Excel engines to use
+    
+    'auto' picks the fastest installed backend per format. Engines whose
+    backend is missing fall back to pandas' defaults.
+    """
+    installed = available_reader_engines()
+    if engine == 'auto':
+        return {
+            'csv': 'pyarrow' if 'pyarrow' in installed else 'c',
+            'excel': 'calamine' if 'calamine' in installed else None,
+        }
+    if engine not in installed:
+        engine = 'pandas'
+    spec = READER_ENGINES[engine]
+    return {'csv': spec['csv'], 'excel': spec['excel']}
+
+def readable_source(source: Union[bytes, str]):
+    """Something pandas readers accept: a path as is, upload bytes as a file object"""
+    return source if isinstance(source, str) else io.BytesIO(source)
+
+class LazySheetStore(Mapping):
+    """Sheet name -> DataFrame mapping that only parses a sheet when it is first accessed
+    
+    source is the upload's bytes, or the path of a file on disk that is read
+    again whenever a sheet is parsed, so CLI inputs are not held in memory.
+    """
+    
+    def __init__(self, source: Union[bytes, str], file_type: str, sheet_names: List[str], preview_rows: int = 5,
+                 workbook: Optional[pd.ExcelFile] = None, engines: Optional[Dict] = None,
+                 previews: Optional[Dict[str, pd.DataFrame]] = None):
+        self.source = source
+        self.file_type = file_type
+        self.sheet_names = list(sheet_names)
+        self.preview_rows = preview_rows
+        self.engines = engines or resolve_reader_engines('pandas')
+        self._workbook = workbook
+        self._loaded = {}
+        # Sheets read with usecols, kept apart so other sessions still get every column
+        self._pruned = {}
+        self._previews = dict(previews or {})
+        self._schemas = {}
+        # Stores are shared across sessions through the ingest cache
+        self._lock = threading.RLock()
+    
+    def __getitem__(self, sheet: str) -> pd.DataFrame:
+        if sheet not in self.sheet_names:
+            raise KeyError(sheet)
+        with self._lock:
+            if sheet not in self._loaded:
+                self._loaded[sheet] = self._read(sheet)
+                # The full sheet supersedes its preview
+                self._previews.pop(sheet, None)
+            return self._loaded[sheet]
+    
+    def __contains__(self, sheet) -> bool:
+        # Mapping's default would parse the sheet just to answer membership
+        return sheet in self.sheet_names
+    
+    def __iter__(self):
+        return iter(self.sheet_names)
+    
+    def __len__(self) -> int:
+        return len(self.sheet_names)
+    
+    def is_loaded(self, sheet: str) -> bool:
+        """Check whether a sheet has already been fully parsed"""
+        return sheet in self._loaded
+    
+    def select(self, sheet: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """A sheet with at least the given columns, parsing only those when it is not loaded
+        
+        Returns the full sheet when it is already loaded, when the columns are
+        all of its columns or when they cannot be selected by name, e.g. for
+        duplicate headers.
+        """
+        if columns is None:
+            return self[sheet]
+        if sheet not in self.sheet_names:
+            raise KeyError(sheet)
+        with self._lock:
+            if sheet in self._loaded or list(columns) == list(self.schema(sheet).index):
+                return self[sheet]
+            pruned = self._pruned.get(sheet)
+            if pruned is not None and set(columns) <= set(pruned.columns):
+                return pruned if list(pruned.columns) == list(columns) else pruned[list(columns)]
+            try:
+                df = self._read(sheet, usecols=list(columns))
+            except ValueError:
+                df = None
+            if df is None or list(df.columns) != list(columns):
+                return self[sheet]
+            self._pruned[sheet] = df
+            return df
+    
+    def has_columns(self, sheet: str, columns: Optional[List[str]] = None) -> bool:
+        """Whether select(sheet, columns) is served without parsing"""
+        with self._lock:
+            if sheet in self._loaded:
+                return True
+            pruned = self._pruned.get(sheet)
+            return columns is not None and pruned is not None and set(columns) <= set(pruned.columns)
+    
+    def memory_usage(self) -> int:
+        """Bytes held by the source bytes and every parsed frame and preview"""
+        with self._lock:
+            frames = [*self._loaded.values(), *self._pruned.values(), *self._previews.values()]
+            source = len(self.source) if isinstance(self.source, bytes) else 0
+            return source + sum(int(df.memory_usage(deep=True).sum()) for df in frames)
+    
+    def loaded_rows(self, sheet: str) -> Optional[int]:
+        """Row count of a fully or partly parsed sheet, None while it is unread"""
+        with self._lock:
+            df = self._loaded.get(sheet, self._pruned.get(sheet))
+            return None if df is None else len(df)
+    
+    def preview(self, sheet: str) -> pd.DataFrame:
+        """Return the first few rows of a sheet without parsing the rest of it"""
+        if sheet not in self.sheet_names:
+            raise KeyError(sheet)
+        with self._lock:
+            if sheet in self._loaded:
+                return self._loaded[sheet].head(self.preview_rows)
+            if sheet not in self._previews:
+                self._previews[sheet] = self._read(sheet, nrows=self.preview_rows)
+            return self._previews[sheet]
+    
+    def sample(self, sheet: str, rows: int) -> pd.DataFrame:
+        """First rows of a sheet for profiling, read on their own and not kept"""
+        if sheet not in self.sheet_names:
+            raise KeyError(sheet)
+        with self._lock:
+            if sheet in self._loaded:
+                return self._loaded[sheet].head(rows)
+            if rows <= self.preview_rows:
+                return self.preview(sheet).head(rows)
+            return self._read(sheet, nrows=rows)
+    
+    def schema(self, sheet: str) -> pd.Series:
+        """Column names and dtypes of a sheet, from the cheapest source available
+        
+        A loaded sheet or cached preview is used as is. Otherwise only the
+        header row is probed: nrows=0 for CSV, the first data row for Excel.
+        """
+        if sheet not in self.sheet_names:
+            raise KeyError(sheet)
+        with self._lock:
+            if sheet in self._loaded:
+                return self._loaded[sheet].dtypes
+            if sheet in self._previews:
+                return self._previews[sheet].dtypes
+            if sheet not in self._schemas:
+                probe_rows = 0 if self.file_type == 'csv' else 1
+                self._schemas[sheet] = self._read(sheet, nrows=probe_rows).dtypes
+            return self._schemas[sheet]
+    
+    def load_sheets(self, sheets: List[str], usecols: Optional[Dict[str, List[str]]] = None) -> Dict[str, pd.DataFrame]:
+        """Parse several sheets in one pass over the open workbook, optionally only some columns"""
+        usecols = usecols or {}
+        return {sheet: self.select(sheet, usecols.get(sheet)) for sheet in sheets}
+    
+    def iter_chunks(self, sheet: str, chunksize: int, usecols: Optional[List[str]] = None):
+        """Yield a sheet in row chunks, streaming CSV sources instead of loading them whole
+        
+        With usecols, unread sources only parse those columns. Chunks hold
+        either those columns or every column of the sheet.
+        """
+        if sheet not in self.sheet_names:
+            raise KeyError(sheet)
+        with self._lock:
+            df = self._loaded.get(sheet)
+            pruned = self._pruned.get(sheet)
+        if df is None and pruned is not None and usecols is not None and set(usecols) <= set(pruned.columns):
+            df = pruned[list(usecols)]
+        
+        if df is None and self.file_type == 'csv':
+            # Chunked reads are only supported by the C parser
+            try:
+                reader = pd.read_csv(readable_source(self.source), chunksize=chunksize, engine='c', usecols=usecols)
+            except ValueError:
+                # Names that cannot be selected, e.g. mangled duplicates, read everything
+                reader = pd.read_csv(readable_source(self.source), chunksize=chunksize, engine='c')
+            with reader:
+                yield from reader
+            return
+        if df is None:
+            # xlsx cannot be read in row ranges, parse it without keeping it in the store
+            with self._lock:
+                try:
+                    df = self._read(sheet, usecols=usecols)
+                except ValueError:
+                    df = self._read(sheet)
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize]
+    
+    def put(self, sheet: str, df: pd.DataFrame):
+        """Store a sheet that was parsed elsewhere, e.g. by a pool worker
+        
+        A frame with fewer columns than the sheet is kept as its pruned read.
+        """
+        if sheet not in self.sheet_names:
+            raise KeyError(sheet)
+        with self._lock:
+            if sheet not in self._loaded and df.shape[1] < len(self.schema(sheet)):
+                self._pruned[sheet] = df
+                return
+            self._loaded[sheet] = df
+            self._pruned.pop(sheet, None)
+            self._previews.pop(sheet, None)
+    
+    def release(self, sheet: str):
+        """Drop a parsed sheet so its memory can be reclaimed"""
+        with self._lock:
+            self._loaded.pop(sheet, None)
+            self._pruned.pop(sheet, None)
+    
+    def close(self):
+        """Close the underlying workbook handle"""
+        with self._lock:
+            if self._workbook is not None:
+                self._workbook.close()
+                self._workbook = None
+    
+    @property
+    def workbook(self) -> pd.ExcelFile:
+        """Workbook handle shared by every sheet read, opened on first use"""
+        if self._workbook is None:
+            self._workbook = pd.ExcelFile(readable_source(self.source), engine=self.engines['excel'])
+        return self._workbook
+    
+    def _read(self, sheet: str, nrows: Optional[int] = None, usecols: Optional[List[str]] = None) -> pd.DataFrame:
+        if self.file_type == 'csv':
+            # The pyarrow engine cannot stop after n rows, previews use the C parser
+            engine = 'c' if nrows is not None else self.engines['csv']
+            return pd.read_csv(readable_source(self.source), nrows=nrows, engine=engine, usecols=usecols)
+        # Reuse the parsed workbook instead of re-opening the upload for every sheet
+        return self.workbook.parse(sheet_name=sheet, nrows=nrows, usecols=usecols)
+
+def content_hash(content: Union[bytes, str]) -> str:
+    """Fingerprint upload content so identical files share one parse, reading a path in blocks"""
+    if not isinstance(content, str):
+        return hashlib.blake2b(content, digest_size=16).hexdigest()
+    digest = hashlib.blake2b(digest_size=16)
+    with open(content, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class IngestCache:
+    """Bounded LRU cache of parsed uploads with time-based expiry
+    
+    Besides max_entries, max_bytes caps the memory of the cached stores.
+    Stores grow as their sheets are parsed, so they are measured again on
+    every put, and the least recently used entries are evicted until the
+    total fits. The newest entry is always kept.
+    """
+    
+    def __init__(self, max_entries: int = 32, ttl: float = 3600, clock=time.monotonic,
+                 max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if self._clock() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        """Cache a value, evicting the least recently used entries beyond max_entries or max_bytes"""
+        with self._lock:
+            self._entries[key] = (self._clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self.max_bytes is not None:
+                sizes = {k: self._size(v) for k, (_, v) in self._entries.items()}
+                total = sum(sizes.values())
+                while total > self.max_bytes and len(self._entries) > 1:
+                    evicted, _ = self._entries.popitem(last=False)
+                    total -= sizes[evicted]
+    
+    def _size(self, value) -> int:
+        return value.memory_usage() if isinstance(value, LazySheetStore) else 0
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+
+@st.cache_resource
+def get_ingest_cache() -> IngestCache:
+    """Process-wide ingest cache shared by every session and rerun"""
+    return IngestCache(
+        max_entries=int(os.environ.get('FILE_MERGER_CACHE_ENTRIES', 32)),
+        ttl=float(os.environ.get('FILE_MERGER_CACHE_TTL', 3600)),
+        max_bytes=int(os.environ.get('FILE_MERGER_CACHE_MB', 1024)) * 1024 * 1024
+    )
+
+def open_sheet_store(content: Union[bytes, str], file_type: str, engines: Dict) -> LazySheetStore:
+    """Register the sheets of an upload and preview its first sheet"""
+    if file_type == 'csv':
+        sheet_names = ['Sheet1']
+        workbook = None
+    elif file_type == 'excel':
+        # Only the workbook index is read here, sheets are parsed on demand
+        workbook = pd.ExcelFile(readable_source(content), engine=engines['excel'])
+        sheet_names = workbook.sheet_names
+    else:
+        raise ValueError("Unsupported file type")
+    
+    store = LazySheetStore(content, file_type, sheet_names, workbook=workbook, engines=engines)
+    # Preview the default sheet so the first render needs no full parse
+    store.preview(sheet_names[0])
+    return store
+
+# Process-pool jobs. They take and return plain picklable values because
+# workbook handles cannot cross process boundaries.
+def _inspect_upload_job(content: Union[bytes, str], file_type: str, engines: Dict) -> Tuple[List[str], pd.DataFrame]:
+    store = open_sheet_store(content, file_type, engines)
+    return store.sheet_names, store.preview(store.sheet_names[0])
+
+def _parse_sheets_job(content: Union[bytes, str], file_type: str, engines: Dict, sheet_names: List[str],
+                      sheets: List[str], usecols: Optional[Dict[str, List[str]]] = None) -> Dict[str, pd.DataFrame]:
+    store = LazySheetStore(content, file_type, sheet_names, engines=engines)
+    try:
+        return store.load_sheets(sheets, usecols)
+    finally:
+        store.close()
+
+def _importable(func):
+    """Resolve func through the importable app module
+    
+    Streamlit executes this file as __main__, where pool workers cannot look
+    functions up by name when unpickling them.
+    """
+    if func.__module__ != '__main__':
+        return func
+    module = importlib.import_module(os.path.splitext(os.path.basename(__file__))[0])
+    return getattr(module, func.__name__)
+
+class MergeCancelled(Exception):
+    """Raised when a merge or ingest is stopped through its cancel event"""
+
+class ProgressReporter:
+    """Per-file and per-chunk progress of one stage, with cooperative cancellation
+    
+    The callback receives a dict with the stage, current file, files and rows
+    done, the fraction complete, throughput in rows per second and an ETA in
+    seconds (None until it can be estimated). The fraction follows rows when
+    the total row count is known and finished files otherwise.
+    """
+    
+    def __init__(self, stage: str, files_total: int, rows_total: Optional[int] = None,
+                 callback: Optional[Callable] = None, cancel_event: Optional[threading.Event] = None,
+                 clock=time.monotonic):
+        self.stage = stage
+        self.files_total = files_total
+        self.rows_total = rows_total
+        self.callback = callback
+        self.cancel_event = cancel_event
+        self.clock = clock
+        self.files_done = 0
+        self.rows = 0
+        self.started = clock()
+    
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise MergeCancelled(f"{self.stage} cancelled after {self.files_done} of {self.files_total} files")
+    
+    def advance(self, filename: Optional[str] = None, rows: int = 0, file_done: bool = False):
+        """Record progress, notify the callback and stop if cancellation was requested"""
+        self.check_cancelled()
+        self.rows += rows
+        if file_done:
+            self.files_done += 1
+        if self.callback is not None:
+            self.callback(self.snapshot(filename))
+    
+    def snapshot(self, filename: Optional[str] = None) -> Dict:
+        elapsed = self.clock() - self.started
+        if self.rows_total:
+            fraction = self.rows / self.rows_total
+        else:
+            fraction = self.files_done / self.files_total if self.files_total else 1.0
+        fraction = min(fraction, 1.0)
+        return {
+            'stage': self.stage,
+            'file': filename,
+            'files_done': self.files_done,
+            'files_total': self.files_total,
+            'rows': self.rows,
+            'rows_total': self.rows_total,
+            'fraction': fraction,
+            'elapsed': elapsed,
+            'rows_per_second': self.rows / elapsed if elapsed > 0 else None,
+            'eta': elapsed * (1 - fraction) / fraction if 0 < fraction < 1 else (0.0 if fraction >= 1 else None),
+        }
+
+def unify_arrow_type(types: List):
+    """Common Arrow type for one column across chunks
+    
+    Integers widen to int64, mixed integers and floats to float64 and any
+    other disagreement falls back to string.
+    """
+    import pyarrow as pa
+    
+    types = [t for t in types if not pa.types.is_null(t)]
+    if not types:
+        return pa.null()
+    if all(t == types[0] for t in types):
+        return types[0]
+    if all(pa.types.is_integer(t) for t in types):
+        return pa.int64()
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64()
+    return pa.string()
+
+def unify_arrow_schemas(schemas: List, columns: List[str]):
+    """One schema for chunks whose inferred column types differ"""
+    import pyarrow as pa
+    
+    return pa.schema([
+        pa.field(name, unify_arrow_type([s.field(name).type for s in schemas if name in s.names]))
+        for name in columns
+    ])
+
+def dtype_kind(series: pd.Series) -> str:
+    """Coarse kind of a column for dtype reconciliation
+    
+    One of int, intlike (floats that are all whole numbers), float, bool,
+    datetime, text, null (no values at all) or other.
+    """
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return 'other'
+    if not series.notna().any():
+        return 'null'
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'bool'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'int'
+    if pd.api.types.is_float_dtype(dtype):
+        values = series.to_numpy(dtype='float64', na_value=np.nan)
+        values = values[~np.isnan(values)]
+        # Beyond 2**53 a float no longer holds every whole number exactly
+        whole = np.array_equal(values, np.trunc(values)) and bool(np.all(np.abs(values) < 2 ** 53))
+        return 'intlike' if whole else 'float'
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'datetime'
+    if pd.api.types.is_object_dtype(dtype):
+        return 'text' if pd.api.types.infer_dtype(series, skipna=True) == 'string' else 'other'
+    if pd.api.types.is_string_dtype(dtype):
+        return 'text'
+    return 'other'
+
+def reconcile_kinds(kinds: set, nullable: bool) -> Optional[str]:
+    """Target for a column whose sources have these kinds, None to leave it to pd.concat
+    
+    Integers stay integers, as nullable Int64 when some source has no value
+    or holds whole floats; real floats make float64; numbers mixed with text
+    become text. Datetimes and mixed object columns are left alone.
+    """
+    if not kinds or 'other' in kinds or 'datetime' in kinds:
+        return None
+    if kinds == {'int'}:
+        return 'Int64' if nullable else None
+    if kinds == {'bool'}:
+        return 'boolean' if nullable else None
+    if kinds == {'int', 'intlike'}:
+        return 'Int64'
+    if kinds <= {'int', 'intlike', 'float'}:
+        return 'float64' if len(kinds) > 1 else None
+    if 'text' in kinds:
+        return 'text' if len(kinds) > 1 else None
+    return None
+
+class DtypeReconciler:
+    """One dtype per merged column, from the kinds every source contributes
+    
+    observe() records each source frame (or chunk), coerce() casts a frame
+    to the current targets. Missing and all-null columns count as nulls.
+    Text targets keep the dtype of the first text source, so the merged
+    column does not become object. widened() reports the columns whose
+    sources had to change dtype.
+    
+    Streamed chunks are coerced before later chunks are seen, so with
+    stream a column never turns floats into Int64 after writing them: whole
+    floats count as floats until the column has held integers, and later
+    integers then follow the floats.
+    """
+    
+    def __init__(self, stream: bool = False):
+        self.stream = stream
+        self.kinds = {}
+        self.nullable = set()
+        self.source_dtypes = {}
+        self._text_dtypes = {}
+    
+    def observe(self, source: str, df: pd.DataFrame):
+        for col in df.columns:
+            if col == '_source_file':
+                continue
+            kind = dtype_kind(df[col])
+            if kind == 'null':
+                self.nullable.add(col)
+            else:
+                if self.stream and kind == 'intlike' and 'int' not in self.kinds.get(col, ()):
+                    kind = 'float'
+                self.kinds.setdefault(col, set()).add(kind)
+                self.source_dtypes.setdefault(col, {}).setdefault(source, str(df[col].dtype))
+            if kind == 'text':
+                self._text_dtypes.setdefault(col, df[col].dtype)
+    
+    def target(self, column: str):
+        target = reconcile_kinds(self.kinds.get(column, set()), column in self.nullable)
+        return self._text_dtypes[column] if target == 'text' else target
+    
+    def coerce(self, df: pd.DataFrame) -> pd.DataFrame:
+        """df with every column that has a target cast to it"""
+        converted = {}
+        for col in df.columns:
+            target = self.target(col) if col != '_source_file' else None
+            if target is not None and str(df[col].dtype) != str(target):
+                converted[col] = self._convert(df[col], target)
+        return df.assign(**converted) if converted else df
+    
+    def empty_column(self, column: str, rows: int) -> Optional[pd.Series]:
+        """All-missing column in the target dtype, for sources without the column"""
+        target = self.target(column)
+        if target is None:
+            return None
+        return pd.Series(np.nan, index=pd.RangeIndex(rows), dtype='float64').astype(target)
+    
+    def _convert(self, series: pd.Series, target) -> pd.Series:
+        if target in ('Int64', 'float64', 'boolean'):
+            return series.astype(target)
+        # Whole floats print as 25 rather than 25.0 once they are text
+        source = series.astype('Int64') if dtype_kind(series) == 'intlike' else series
+        return source.astype(str).where(series.notna()).astype(target)
+    
+    def widened(self) -> Dict[str, Dict]:
+        """{column: {'dtype': target, 'sources': {source: original dtype}}} for changed columns"""
+        report = {}
+        for col, sources in self.source_dtypes.items():
+            target = self.target(col)
+            if target is not None and any(dtype != str(target) for dtype in sources.values()):
+                report[col] = {'dtype': str(target), 'sources': dict(sources)}
+        return report
+
+def join_key_kinds(left: pd.DataFrame, right: pd.DataFrame) -> List[str]:
+    """How each key column is compared across both sides: 'int', 'float' or 'text'
+    
+    Integers, and floats that only hold whole numbers, compare as exact
+    integers. Numbers compare as float64 only when a side has real
+    fractions, and as text when either side is not numeric.
+    """
+    kinds = []
+    for left_col, right_col in zip(left.columns, right.columns):
+        series = (left[left_col], right[right_col])
+        numeric = all(pd.api.types.is_numeric_dtype(s.dtype) and not isinstance(s.dtype, pd.CategoricalDtype)
+                      for s in series)
+        if not numeric:
+            kinds.append('text')
+        elif all(dtype_kind(s) in ('int', 'intlike', 'bool', 'null') for s in series):
+            kinds.append('int')
+        else:
+            kinds.append('float')
+    return kinds
+
+def join_key_frame(df: pd.DataFrame, kinds: List[str]) -> pd.DataFrame:
+    """Key columns in a form that compares equal across files
+    
+    Integer keys become Int64 so large IDs are not rounded through float64,
+    text keys write whole numbers without a trailing .0.
+    """
+    normalised = {}
+    for i, (col, kind) in enumerate(zip(df.columns, kinds)):
+        series = df[col]
+        if kind == 'int':
+            normalised[i] = series.astype('Int64')
+        elif kind == 'float':
+            normalised[i] = series.astype('float64')
+        else:
+            if dtype_kind(series) in ('int', 'intlike'):
+                series = series.astype('Int64')
+            normalised[i] = series.astype(str).where(series.notna()).astype('string')
+    return pd.DataFrame(normalised, index=df.index)
+
+def join_key_codes(left: pd.DataFrame, right: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """Dense integer codes for the normalised key rows of both sides, -1 where a key is missing"""
+    combined = missing = None
+    for col in left.columns:
+        codes, uniques = pd.factorize(pd.concat([left[col], right[col]], ignore_index=True))
+        codes = codes.astype(np.int64)
+        if combined is None:
+            combined, missing = codes, codes < 0
+        else:
+            missing |= codes < 0
+            combined = pd.factorize(combined * (len(uniques) + 1) + codes)[0].astype(np.int64)
+    combined[missing] = -1
+    return combined[:len(left)], combined[len(left):]
+
+def sorted_key_codes(left: pd.DataFrame, right: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """Key ranks in key order for both sides, -1 where a key is missing
+    
+    Each column is ranked by sorting its values, never by hashing, and the
+    ranks of several columns are combined in lexicographic order, so codes
+    compare like the key values themselves.
+    """
+    combined = None
+    missing = np.zeros(len(left) + len(right), dtype=bool)
+    for col in left.columns:
+        values = pd.concat([left[col], right[col]], ignore_index=True)
+        present = values.notna().to_numpy()
+        codes = np.full(len(values), -1, dtype=np.int64)
+        uniques, codes[present] = np.unique(values[present].to_numpy(), return_inverse=True)
+        missing |= ~present
+        if combined is None:
+            combined = codes
+        else:
+            combined = np.unique(combined * (len(uniques) + 1) + codes + 1, return_inverse=True)[1].astype(np.int64)
+    combined[missing] = -1
+    return combined[:len(left)], combined[len(left):]
+
+def match_key_codes(left_codes: np.ndarray, right_codes: np.ndarray, how: str = 'inner',
+                    strategy: str = 'hash') -> Tuple[np.ndarray, np.ndarray]:
+    """Row indexers (left_idx, right_idx) of a join on precomputed key codes, -1 for no partner
+    
+    hash buckets the right rows by code with a count table; sort orders the
+    right codes (skipped when already sorted) and binary-searches each left
+    code. Rows come out in left order, then unmatched right rows for outer.
+    """
+    left_codes = np.asarray(left_codes, dtype=np.int64)
+    right_codes = np.asarray(right_codes, dtype=np.int64)
+    valid = np.flatnonzero(right_codes >= 0)
+    safe_left = np.maximum(left_codes, 0)
+    
+    if strategy == 'sort':
+        if np.all(right_codes[valid[1:]] >= right_codes[valid[:-1]]):
+            order = valid
+        else:
+            order = valid[np.argsort(right_codes[valid], kind='stable')]
+        sorted_codes = right_codes[order]
+        starts = np.searchsorted(sorted_codes, left_codes, 'left')
+        counts = np.searchsorted(sorted_codes, left_codes, 'right') - starts
+    else:
+        size = int(max(left_codes.max(initial=-1), right_codes.max(initial=-1))) + 1
+        table = np.bincount(right_codes[valid], minlength=size)
+        order = valid[np.argsort(right_codes[valid], kind='stable')]
+        bucket_starts = np.concatenate([[0], np.cumsum(table)[:-1]]) if size else table
+        starts = bucket_starts[safe_left] if size else np.zeros(len(left_codes), dtype=np.int64)
+        counts = table[safe_left] if size else np.zeros(len(left_codes), dtype=np.int64)
+    counts = np.where(left_codes >= 0, counts, 0)
+    
+    take = np.maximum(counts, 1) if how in ('left', 'outer') else counts
+    left_idx = np.repeat(np.arange(len(left_codes)), take)
+    offsets = np.arange(len(left_idx)) - np.repeat(np.cumsum(take) - take, take)
+    matched = np.repeat(counts > 0, take)
+    right_idx = np.full(len(left_idx), -1, dtype=np.int64)
+    right_idx[matched] = order[np.repeat(starts, take)[matched] + offsets[matched]]
+    
+    if how == 'outer':
+        seen = np.zeros(len(right_codes), dtype=bool)
+        seen[right_idx[right_idx >= 0]] = True
+        unmatched = np.flatnonzero(~seen)
+        left_idx = np.concatenate([left_idx, np.full(len(unmatched), -1, dtype=np.int64)])
+        right_idx = np.concatenate([right_idx, unmatched])
+    return left_idx, right_idx
+
+def join_indexers(left: pd.DataFrame, right: pd.DataFrame, how: str = 'left',
+                  strategy: str = 'auto') -> Tuple[np.ndarray, np.ndarray, str]:
+    """Row indexers of a join between two key frames, plus the strategy used
+    
+    hash factorizes the keys into codes and buckets the right side; sort
+    ranks the keys by sorting them and merges the sorted sides. auto picks
+    sort when the normalised right keys are already in order.
+    """
+    if how not in JOIN_TYPES:
+        raise ValueError(f"Unknown join type: {how}")
+    if strategy not in JOIN_STRATEGIES:
+        raise ValueError(f"Unknown join strategy: {strategy}")
+    kinds = join_key_kinds(left, right)
+    left, right = join_key_frame(left, kinds), join_key_frame(right, kinds)
+    if strategy == 'auto':
+        monotonic = len(right.columns) == 1 and right.iloc[:, 0].is_monotonic_increasing
+        strategy = 'sort' if monotonic else 'hash'
+    codes = sorted_key_codes(left, right) if strategy == 'sort' else join_key_codes(left, right)
+    return (*match_key_codes(*codes, how, strategy), strategy)
+
+def take_rows(df: pd.DataFrame, indexer: np.ndarray) -> pd.DataFrame:
+    """Rows of df by position, all-missing where the position is -1"""
+    if not len(indexer) or indexer.min() >= 0:
+        return df.iloc[indexer].reset_index(drop=True)
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        # Integers keep their type as nullable columns instead of turning into floats
+        if pd.api.types.is_bool_dtype(series.dtype) and not isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.astype('boolean')
+        elif pd.api.types.is_integer_dtype(series.dtype) and not pd.api.types.is_extension_array_dtype(series.dtype):
+            series = series.astype('Int64')
+        columns[col] = series.array.take(indexer, allow_fill=True)
+    return pd.DataFrame(columns, columns=df.columns)
+
+def condition_mask(series: pd.Series, op: str, value) -> np.ndarray:
+    """Rows of a column that satisfy one query condition, missing values never match
+    
+    The value is compared in the column's own type: as a number for numeric
+    columns, a timestamp for dates and text otherwise. 'in' and 'between'
+    take a list of values, 'contains' matches text case-insensitively.
+    """
+    if op == 'contains':
+        result = series.astype('string').str.contains(str(value), case=False, regex=False)
+        return np.asarray(result.fillna(False), dtype=bool)
+    
+    values = pd.Series(list(value) if op in ('in', 'between') else [value], dtype=object)
+    if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+        values = pd.to_numeric(values, errors='coerce')
+    elif pd.api.types.is_datetime64_any_dtype(series.dtype):
+        values = pd.to_datetime(values, errors='coerce')
+    else:
+        series = series.astype('string')
+        values = values.astype('string')
+    
+    if op == 'in':
+        result = series.isin(values.dropna())
+    elif values.isna().any():
+        # A value that is not valid for the column's type matches nothing
+        return np.zeros(len(series), dtype=bool)
+    elif op == 'between':
+        result = (series >= values.iloc[0]) & (series <= values.iloc[1])
+    else:
+        method = {'==': 'eq', '!=': 'ne', '>': 'gt', '>=': 'ge', '<': 'lt', '<=': 'le'}[op]
+        result = getattr(series, method)(values.iloc[0]) & series.notna()
+    return np.asarray(result.fillna(False), dtype=bool)
+
+class MergeQuery:
+    """Row conditions, a column projection and aggregates evaluated while files are scanned
+    
+    where holds (column, operator, value) conditions that must all hold.
+    aggregates holds (function, column) pairs, column None for a row count;
+    with aggregates the result has one row per group_by combination
+    instead of the matching rows. Aggregates are computed per chunk with
+    partial() and merged with combine(), so matching rows are not kept.
+    """
+    
+    # Group key used internally when there is no group_by
+    _ALL = '__all__'
+    
+    def __init__(self, where: Optional[List[Tuple]] = None, columns: Optional[List[str]] = None,
+                 group_by: Optional[List[str]] = None, aggregates: Optional[List[Tuple]] = None):
+        self.where = [tuple(condition) for condition in where or []]
+        self.columns = list(columns) if columns else None
+        self.group_by = list(group_by or [])
+        self.aggregates = [tuple(aggregate) for aggregate in aggregates or []]
+        for _, op, _ in self.where:
+            if op not in QUERY_OPERATORS:
+                raise ValueError(f"Unknown query operator: {op}")
+        for func, column in self.aggregates:
+            if func not in QUERY_AGGREGATES:
+                raise ValueError(f"Unknown aggregate: {func}")
+            if column is None and func != 'count':
+                raise ValueError(f"{func} needs a column")
+        if self.group_by and not self.aggregates:
+            self.aggregates = [('count', None)]
+    
+    @staticmethod
+    def parse_condition(column: str, op: str, text: str) -> Tuple:
+        """A condition from user text, 'in' and 'between' values separated by commas"""
+        if op in ('in', 'between'):
+            value = [part.strip() for part in str(text).split(',') if part.strip()]
+            if op == 'between' and len(value) != 2:
+                raise ValueError(f"between needs two values: {text}")
+            return column, op, value
+        return column, op, str(text).strip()
+    
+    @staticmethod
+    def aggregate_name(func: str, column: Optional[str]) -> str:
+        return func if column is None else f"{func}({column})"
+    
+    def is_empty(self) -> bool:
+        return not (self.where or self.columns or self.aggregates)
+    
+    def key(self) -> Tuple:
+        return freeze_key((self.where, self.columns, self.group_by, self.aggregates))
+    
+    def referenced_columns(self) -> List[str]:
+        columns = [column for column, _, _ in self.where] + self.group_by
+        columns += [column for _, column in self.aggregates if column is not None]
+        return columns + (self.columns or [])
+    
+    def validate(self, columns: List[str]):
+        missing = sorted(set(self.referenced_columns()) - set(columns))
+        if missing:
+            raise ValueError(f"Query columns not in the merged columns: {', '.join(missing)}")
+    
+    def needed_columns(self, columns: List[str]) -> List[str]:
+        """Merged columns the scan has to read, in merged order"""
+        if self.aggregates:
+            needed = set(self.referenced_columns()) - set(self.columns or [])
+        elif self.columns is not None:
+            needed = set(self.referenced_columns())
+        else:
+            return list(columns)
+        return [column for column in columns if column in needed]
+    
+    def output_columns(self, columns: List[str]) -> List[str]:
+        if self.aggregates:
+            return self.group_by + [self.aggregate_name(func, column) for func, column in self.aggregates]
+        return list(self.columns) if self.columns is not None else list(columns)
+    
+    def mask(self, df: pd.DataFrame) -> np.ndarray:
+        keep = np.ones(len(df), dtype=bool)
+        for column, op, value in self.where:
+            keep &= condition_mask(df[column], op, value)
+        return keep
+    
+    def filter(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Matching rows of a chunk, with only the projected columns plus _source_file"""
+        if self.where:
+            df = df[self.mask(df)]
+        if self.columns is not None and not self.aggregates:
+            df = df[self.columns + [col for col in ['_source_file'] if col in df.columns]]
+        return df
+    
+    def partial(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Per-group partial aggregates of one chunk, for combine()"""
+        keys = [df[col] for col in self.group_by] or [pd.Series(0, index=df.index, name=self._ALL)]
+        parts = {}
+        for func, column in self.aggregates:
+            if column is None:
+                parts['count'] = pd.Series(0, index=df.index).groupby(keys, dropna=False, sort=False).size()
+                continue
+            values = df[column]
+            if func in ('sum', 'mean'):
+                values = pd.to_numeric(values, errors='coerce')
+            grouped = values.groupby(keys, dropna=False, sort=False)
+            if func in ('sum', 'mean'):
+                parts[f'sum({column})'] = grouped.sum(min_count=1)
+            if func in ('count', 'mean'):
+                parts[f'count({column})'] = grouped.count()
+            if func in ('min', 'max'):
+                parts[f'{func}({column})'] = getattr(grouped, func)()
+        return pd.DataFrame(parts).reset_index()
+    
+    def combine(self, partials: List[pd.DataFrame]) -> pd.DataFrame:
+        """Final aggregates from the partials of every chunk"""
+        output = self.output_columns([])
+        if not partials:
+            if self.group_by:
+                return pd.DataFrame(columns=output)
+            return pd.DataFrame({self.aggregate_name(func, column): [0 if func == 'count' else np.nan]
+                                 for func, column in self.aggregates})
+        
+        grouped = pd.concat(partials, ignore_index=True).groupby(self.group_by or [self._ALL], dropna=False)
+        result = {}
+        for func, column in self.aggregates:
+            name = self.aggregate_name(func, column)
+            if func == 'count':
+                result[name] = grouped[name].sum()
+            elif func == 'sum':
+                result[name] = grouped[name].sum(min_count=1)
+            elif func == 'mean':
+                result[name] = grouped[f'sum({column})'].sum(min_count=1) / grouped[f'count({column})'].sum()
+            else:
+                result[name] = getattr(grouped[name], func)()
+        result = pd.DataFrame(result).reset_index()
+        return result[output].reset_index(drop=True)
+
+# Thai header words and the English token they stand for
+HEADER_SYNONYMS = {
+    'ยอดขาย': 'sales', 'เงินเดือน': 'salary', 'นามสกุล': 'surname', 'โทรศัพท์': 'phone', 'เบอร์โทร': 'phone',
+    'หมวดหมู่': 'category', 'หมายเหตุ': 'note', 'ที่อยู่': 'address', 'จังหวัด': 'province', 'ประเทศ': 'country',
+    'พนักงาน': 'employee', 'ลูกค้า': 'customer', 'สินค้า': 'product', 'วันที่': 'date', 'เลขที่': 'no',
+    'ลำดับ': 'no', 'จำนวน': 'qty', 'ราคา': 'price', 'สาขา': 'branch', 'เมือง': 'city', 'อีเมล': 'email',
+    'แผนก': 'department', 'สถานะ': 'status', 'ประเภท': 'type', 'เวลา': 'time', 'อายุ': 'age', 'เพศ': 'gender',
+    'ค่าขนส่ง': 'shipping', 'ส่วนลด': 'discount', 'ภาษี': 'tax', 'บริษัท': 'company', 'หน่วย': 'unit',
+    'เดือน': 'month', 'รหัส': 'id', 'ชื่อ': 'name', 'ยอด': 'amount', 'รวม': 'total',
+}
+# English spellings folded onto one token
+TOKEN_ALIASES = {
+    'quantity': 'qty', 'amt': 'amount', 'number': 'no', 'num': 'no', 'code': 'id', 'tel': 'phone',
+    'telephone': 'phone', 'mobile': 'phone', 'mail': 'email', 'lastname': 'surname', 'sex': 'gender',
+    'dept': 'department', 'cust': 'customer', 'prod': 'product', 'qty': 'qty',
+}
+
+# Matched after the same NFKC folding as headers, longest words first
+_THAI_SYNONYMS = sorted(
+    ((unicodedata.normalize('NFKC', thai), english) for thai, english in HEADER_SYNONYMS.items()),
+    key=lambda item: -len(item[0])
+)
+
+def header_tokens(header) -> Tuple[str, frozenset]:
+    """Normalised form of a header and its tokens
+    
+    Case, width and separators are folded, camelCase is split and Thai
+    words with an English equivalent become that English token.
+    """
+    text = unicodedata.normalize('NFKC', str(header))
+    text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', text).casefold()
+    for thai, english in _THAI_SYNONYMS:
+        text = text.replace(thai, f' {english} ')
+    # Thai vowel and tone marks are combining characters, keep them inside words
+    tokens = [TOKEN_ALIASES.get(token, token) for token in re.findall(r'(?:[^\W_]|[\u0E00-\u0E7F])+', text)]
+    tokens = [token for token in tokens if len(token) > 1 or token.isdigit()]
+    return ' '.join(tokens), frozenset(tokens)
+
+def name_similarity(a: Tuple[str, frozenset], b: Tuple[str, frozenset]) -> float:
+    """Best of token overlap and character similarity of two normalised headers"""
+    if a[0] == b[0]:
+        return 1.0
+    token_score = len(a[1] & b[1]) / len(a[1] | b[1]) if a[1] or b[1] else 0.0
+    char_score = SequenceMatcher(None, a[0].replace(' ', ''), b[0].replace(' ', '')).ratio()
+    return max(token_score, char_score)
+
+def value_profile(values: pd.Series) -> Optional[Dict]:
+    """Kind, typical length and distinct values of a sampled column"""
+    values = values.dropna()
+    if values.empty:
+        return None
+    if pd.api.types.is_bool_dtype(values):
+        kind = 'bool'
+    elif pd.api.types.is_numeric_dtype(values):
+        kind = 'number'
+    elif pd.api.types.is_datetime64_any_dtype(values):
+        kind = 'date'
+    else:
+        kind = 'number' if pd.to_numeric(values, errors='coerce').notna().mean() > 0.9 else 'text'
+    text = values.astype(str)
+    return {'kind': kind, 'length': float(text.str.len().mean()), 'values': set(text.head(50))}
+
+def profile_similarity(a: Optional[Dict], b: Optional[Dict]) -> Optional[float]:
+    if a is None or b is None:
+        return None
+    length = min(a['length'], b['length']) / max(a['length'], b['length'], 1.0)
+    overlap = len(a['values'] & b['values']) / len(a['values'] | b['values'])
+    return 0.5 * (a['kind'] == b['kind']) + 0.3 * length + 0.2 * overlap
+
+class HeaderMatcher:
+    """Suggests a header from the other files for every header that only one file has
+    
+    Later files are mapped onto the names of earlier ones, never the other
+    way round, so two files are not both renamed to each other's header.
+    Candidates come from an inverted index of name tokens and character
+    trigrams, so a header is only scored against names that share a key
+    with it; keys shared by too many headers are skipped. Scores mix name
+    similarity with value-profile similarity of sampled rows.
+    """
+    
+    def __init__(self, threshold: float = 0.6, max_candidates: int = 20, name_weight: float = 0.7):
+        self.threshold = threshold
+        self.max_candidates = max_candidates
+        self.name_weight = name_weight
+    
+    def _keys(self, normalised: Tuple[str, frozenset]) -> set:
+        compact = normalised[0].replace(' ', '')
+        trigrams = {compact[i:i + 3] for i in range(len(compact) - 2)} or {compact}
+        return set(normalised[1]) | {f'#{gram}' for gram in trigrams}
+    
+    def suggest(self, file_headers: Dict[str, List[str]],
+                samples: Optional[Dict[str, pd.DataFrame]] = None) -> Dict[str, Dict[str, Tuple[str, float]]]:
+        """{filename: {header: (suggested header, score)}} for headers missing from the other files"""
+        samples = samples or {}
+        owners = {}
+        for filename, headers in file_headers.items():
+            for header in headers:
+                owners.setdefault(header, []).append(filename)
+        
+        normalised = {header: header_tokens(header) for header in owners}
+        index = {}
+        for header, norm in normalised.items():
+            for key in self._keys(norm):
+                index.setdefault(key, []).append(header)
+        # Keys common to a large share of headers do not narrow the search
+        max_postings = max(50, len(owners) // 10)
+        
+        profiles = {}
+        
+        def profile(filename, header):
+            if (filename, header) not in profiles:
+                sample = samples.get(filename)
+                profiles[(filename, header)] = (
+                    value_profile(sample[header]) if sample is not None and header in sample.columns
+                    and sample[header].ndim == 1 else None
+                )
+            return profiles[(filename, header)]
+        
+        order = {filename: i for i, filename in enumerate(file_headers)}
+        renamed = set()
+        suggestions = {}
+        for filename, headers in file_headers.items():
+            own = set(headers)
+            for header in headers:
+                if len(owners[header]) > 1:
+                    continue
+                shared = {}
+                for key in self._keys(normalised[header]):
+                    postings = index.get(key, ())
+                    if len(postings) > max_postings:
+                        continue
+                    for candidate in postings:
+                        if candidate not in own and candidate not in renamed \
+                                and order[owners[candidate][0]] < order[filename]:
+                            shared[candidate] = shared.get(candidate, 0) + 1
+                
+                best = None
+                for candidate in sorted(shared, key=shared.get, reverse=True)[:self.max_candidates]:
+                    score = name_similarity(normalised[header], normalised[candidate])
+                    values = profile_similarity(profile(filename, header), profile(owners[candidate][0], candidate))
+                    if values is not None:
+                        score = self.name_weight * score + (1 - self.name_weight) * values
+                    if best is None or score > best[1]:
+                        best = (candidate, score)
+                if best is not None and best[1] >= self.threshold:
+                    suggestions.setdefault(filename, {})[header] = best
+                    renamed.add(header)
+        return suggestions
+
+def header_signature(headers: List[str]) -> str:
+    """Stable id of a file layout, its headers in order"""
+    return hashlib.blake2b('\x1f'.join(map(str, headers)).encode('utf-8'), digest_size=8).hexdigest()
+
+class ColumnPlan:
+    """Compiled header mapping: final column order plus per-source select/rename index arrays
+    
+    sources[filename] holds the positions of the kept source columns and
+    their output names, both already in output order, so applying the plan
+    is a single positional column take per source. Sources read with only
+    their used_columns are taken by their position among those instead.
+    """
+    
+    def __init__(self, columns: List[str], sources: Dict[str, Tuple], signatures: Dict[str, str],
+                 headers: Optional[Dict[str, List[str]]] = None):
+        self.columns = columns
+        self.sources = sources
+        self.signatures = signatures
+        self.headers = headers or {}
+        # Position of each selected column within a frame holding only the used columns
+        self._pruned = {filename: np.searchsorted(np.sort(select), select) for filename, (select, _) in sources.items()}
+    
+    @classmethod
+    def compile(cls, file_headers: Dict[str, List[str]], header_mapping: Dict = None,
+                excluded_headers: Dict = None) -> 'ColumnPlan':
+        header_mapping = header_mapping or {}
+        excluded_headers = excluded_headers or {}
+        columns = {}
+        kept = {}
+        
+        for filename, headers in file_headers.items():
+            excluded = set(excluded_headers.get(filename, []))
+            mapping = header_mapping.get(filename, {})
+            targets = {}
+            for position, col in enumerate(headers):
+                name = mapping.get(col, col)
+                if col not in excluded and name != '_source_file':
+                    # A later source column renamed onto the same name wins
+                    targets[name] = position
+                    columns.setdefault(name, len(columns))
+            kept[filename] = targets
+        
+        sources = {}
+        for filename, targets in kept.items():
+            names = sorted(targets, key=columns.get)
+            sources[filename] = (np.array([targets[name] for name in names], dtype=np.intp), pd.Index(names))
+        signatures = {filename: header_signature(headers) for filename, headers in file_headers.items()}
+        headers = {filename: list(names) for filename, names in file_headers.items()}
+        return cls(list(columns), sources, signatures, headers)
+    
+    def file_columns(self, filename: str) -> List[str]:
+        """Output columns a file contributes, in output order"""
+        return list(self.sources[filename][1])
+    
+    def project(self, columns: List[str]) -> 'ColumnPlan':
+        """The plan narrowed to some output columns, so only their sources are read"""
+        wanted = set(columns)
+        sources = {}
+        for filename, (select, names) in self.sources.items():
+            keep = np.array([name in wanted for name in names], dtype=bool)
+            sources[filename] = (select[keep], names[keep])
+        return ColumnPlan([col for col in self.columns if col in wanted], sources, self.signatures, self.headers)
+    
+    def used_columns(self, filename: str) -> Optional[List[str]]:
+        """Source columns the plan keeps for a file, in file order, for usecols at read time
+        
+        None when the plan does not know the file's headers.
+        """
+        headers = self.headers.get(filename)
+        if headers is None:
+            return None
+        return [headers[position] for position in np.sort(self.sources[filename][0])]
+    
+    def apply(self, filename: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Select and rename one source's columns, in output order
+        
+        df is either the whole source or only its used_columns.
+        """
+        select, names = self.sources[filename]
+        if df.shape[1] == len(select):
+            select = self._pruned[filename]
+        if PANDAS_VERSION >= (3, 0):
+            # Copy-on-write makes the positional take a view
+            return df.iloc[:, select].set_axis(names, axis=1)
+        return pd.DataFrame({name: df.iloc[:, position] for name, position in zip(names, select)}, copy=False)
+
+class MappingProfile:
+    """Saved header_mapping/excluded_headers keyed by header signature
+    
+    Files are matched by their layout rather than their name, so next
+    month's exports with the same headers reuse the mapping as is.
+    """
+    
+    VERSION = 1
+    
+    def __init__(self, name: str = '', layouts: Optional[Dict] = None):
+        self.name = name
+        # signature -> {'headers', 'header_mapping', 'excluded_headers'}
+        self.layouts = layouts or {}
+    
+    def add(self, file_headers: Dict[str, List[str]], header_mapping: Dict = None, excluded_headers: Dict = None):
+        """Record the mapping of each file under its header signature"""
+        header_mapping = header_mapping or {}
+        excluded_headers = excluded_headers or {}
+        for filename, headers in file_headers.items():
+            self.layouts[header_signature(headers)] = {
+                'headers': list(headers),
+                'header_mapping': dict(header_mapping.get(filename, {})),
+                'excluded_headers': list(excluded_headers.get(filename, [])),
+            }
+        return self
+    
+    def unmatched(self, file_headers: Dict[str, List[str]]) -> List[str]:
+        """Files whose layout the profile does not know"""
+        return [f for f, headers in file_headers.items() if header_signature(headers) not in self.layouts]
+    
+    def resolve(self, file_headers: Dict[str, List[str]]) -> Tuple[Dict, Dict]:
+        """header_mapping and excluded_headers for the files with a known layout"""
+        header_mapping = {}
+        excluded_headers = {}
+        for filename, headers in file_headers.items():
+            layout = self.layouts.get(header_signature(headers))
+            if layout is None:
+                continue
+            if layout['header_mapping']:
+                header_mapping[filename] = dict(layout['header_mapping'])
+            if layout['excluded_headers']:
+                excluded_headers[filename] = list(layout['excluded_headers'])
+        return header_mapping, excluded_headers
+    
+    def compile(self, file_headers: Dict[str, List[str]]) -> ColumnPlan:
+        return ColumnPlan.compile(file_headers, *self.resolve(file_headers))
+    
+    def to_json(self) -> str:
+        return json.dumps({'name': self.name, 'version': self.VERSION, 'layouts': self.layouts},
+                          ensure_ascii=False, indent=2)
+    
+    @classmethod
+    def from_json(cls, text) -> 'MappingProfile':
+        data = json.loads(text)
+        if not isinstance(data, dict) or data.get('version') != cls.VERSION or not isinstance(data.get('layouts'), dict):
+            raise ValueError("Not a mapping profile")
+        return cls(data.get('name', ''), data['layouts'])
+
+def canonical_text(series: pd.Series) -> pd.Series:
+    """Values as text, with whole floats written like integers, missing values kept missing"""
+    text = series.astype(str).to_numpy(dtype=object)
+    if pd.api.types.is_float_dtype(series.dtype):
+        values = series.to_numpy(dtype='float64', na_value=np.nan)
+        whole = np.isfinite(values) & (np.trunc(values) == values) & (np.abs(values) < 2 ** 53)
+        text[whole] = values[whole].astype(np.int64).astype(str)
+    return pd.Series(text, index=series.index, dtype='string').where(series.notna())
+
+class HashRuns:
+    """Set of 64-bit row hashes, each with the code of the file it came from
+    
+    Hashes are kept as sorted numpy runs and looked up with searchsorted.
+    Past max_memory_rows the in-memory runs are merged into one and written
+    to a .npy file that is memory-mapped, so memory stays bounded and a
+    lookup only touches the pages it searches. Past max_runs spilled runs
+    they are merged into one file, so a lookup never searches more than
+    max_runs runs on disk.
+    """
+    
+    def __init__(self, max_memory_rows: int = DEDUPE_MEMORY_ROWS, spill_dir: Optional[str] = None,
+                 max_runs: int = 8):
+        self.max_memory_rows = max_memory_rows
+        self.max_runs = max_runs
+        self.spill_dir = spill_dir
+        self._tempdir = None
+        self._memory = []
+        self._disk = []
+        self._runs_written = 0
+    
+    def __len__(self) -> int:
+        return sum(len(hashes) for hashes, _ in self._memory + self._disk)
+    
+    @property
+    def spilled(self) -> int:
+        return len(self._disk)
+    
+    def lookup(self, hashes: np.ndarray) -> np.ndarray:
+        """Source code of each hash already in the set, -1 where it is new"""
+        found = np.full(len(hashes), -1, dtype=np.int32)
+        for run_hashes, run_sources in self._disk + self._memory:
+            if not len(run_hashes):
+                continue
+            pending = np.flatnonzero(found < 0)
+            if not len(pending):
+                break
+            positions = np.searchsorted(run_hashes, hashes[pending])
+            positions[positions == len(run_hashes)] = 0
+            hit = run_hashes[positions] == hashes[pending]
+            found[pending[hit]] = run_sources[positions[hit]]
+        return found
+    
+    def add(self, hashes: np.ndarray, sources: np.ndarray):
+        """Add hashes that are not in the set yet"""
+        if not len(hashes):
+            return
+        order = np.argsort(hashes, kind='stable')
+        self._memory.append((hashes[order], sources[order].astype(np.int32)))
+        if sum(len(run) for run, _ in self._memory) > self.max_memory_rows:
+            self._spill()
+        elif len(self._memory) > self.max_runs:
+            self._memory = [self._merge(self._memory)]
+    
+    def _merge(self, runs):
+        hashes = np.concatenate([run for run, _ in runs])
+        sources = np.concatenate([codes for _, codes in runs])
+        order = np.argsort(hashes, kind='stable')
+        return hashes[order], sources[order]
+    
+    def _run_path(self) -> str:
+        if self._tempdir is None:
+            self._tempdir = tempfile.TemporaryDirectory(prefix="file_merger_dedupe_", dir=self.spill_dir)
+        self._runs_written += 1
+        return os.path.join(self._tempdir.name, f"run_{self._runs_written}")
+    
+    def _open_run(self, path: str):
+        return np.load(path + '_hashes.npy', mmap_mode='r'), np.load(path + '_sources.npy', mmap_mode='r')
+    
+    def _spill(self):
+        hashes, sources = self._merge(self._memory)
+        path = self._run_path()
+        np.save(path + '_hashes.npy', hashes)
+        np.save(path + '_sources.npy', sources)
+        self._disk.append(self._open_run(path))
+        self._memory = []
+        if len(self._disk) > self.max_runs:
+            self._compact()
+    
+    def _compact(self):
+        """Merge the spilled runs into one, a block of about max_memory_rows hashes at a time"""
+        runs = self._disk
+        total = sum(len(hashes) for hashes, _ in runs)
+        path = self._run_path()
+        hashes_out = np.lib.format.open_memmap(path + '_hashes.npy', mode='w+', dtype=runs[0][0].dtype, shape=(total,))
+        sources_out = np.lib.format.open_memmap(path + '_sources.npy', mode='w+', dtype=np.int32, shape=(total,))
+        
+        # Every run is cut at the same hash values, so each block merges on its own
+        step = max(1, self.max_memory_rows // len(runs))
+        bounds = np.unique(np.concatenate([np.asarray(hashes[step::step]) for hashes, _ in runs]))
+        starts = [0] * len(runs)
+        written = 0
+        for bound in list(bounds) + [None]:
+            pieces = []
+            for i, (hashes, sources) in enumerate(runs):
+                end = len(hashes) if bound is None else int(np.searchsorted(hashes, bound, side='right'))
+                pieces.append((np.asarray(hashes[starts[i]:end]), np.asarray(sources[starts[i]:end])))
+                starts[i] = end
+            block_hashes, block_sources = self._merge(pieces)
+            hashes_out[written:written + len(block_hashes)] = block_hashes
+            sources_out[written:written + len(block_hashes)] = block_sources
+            written += len(block_hashes)
+        hashes_out.flush()
+        sources_out.flush()
+        
+        old_files = [array.filename for run in runs for array in run]
+        del hashes_out, sources_out, runs, pieces
+        self._disk = [self._open_run(path)]
+        for filename in old_files:
+            os.remove(filename)
+    
+    def close(self):
+        self._memory = []
+        self._disk = []
+        if self._tempdir is not None:
+            self._tempdir.cleanup()
+            self._tempdir = None
+
+class RowDeduplicator:
+    """Drops rows already seen earlier in the merge, on full rows or a key set
+    
+    Rows are hashed column-wise with pd.util.hash_pandas_object, every
+    value as text in one form whatever the dtype of the chunk it came in:
+    whole numbers print without .0, so 1, 1.0 and the text "1" match, and
+    large integers stay exact. Rows of the same frame whose hashes are
+    equal are compared by value, so a hash collision never drops a row of
+    merge_files. Rows of earlier chunks are only kept as their 64-bit
+    hash: with n distinct rows, the streamed merge drops a colliding row
+    with a chance of about n**2 / 2**65. The first row
+    of a duplicate group is kept, in merge order. Frames can be passed
+    whole or one chunk at a time; pair_counts counts the dropped rows per
+    (file kept, file dropped) pair.
+    """
+    
+    def __init__(self, keys: Optional[List[str]] = None, max_memory_rows: int = DEDUPE_MEMORY_ROWS,
+                 spill_dir: Optional[str] = None):
+        self.keys = list(keys) if keys else None
+        self.seen = HashRuns(max_memory_rows, spill_dir)
+        self.sources = []
+        self._source_codes = {}
+        self.pair_counts = {}
+        self.rows_in = 0
+        self.rows_dropped = 0
+    
+    def hash_rows(self, df: pd.DataFrame) -> np.ndarray:
+        keys = self.keys or [col for col in df.columns if col != '_source_file']
+        missing = [key for key in keys if key not in df.columns]
+        if missing:
+            raise ValueError(f"Dedupe keys not in the merged columns: {', '.join(map(str, missing))}")
+        
+        return pd.util.hash_pandas_object(self.key_frame(df, keys), index=False).to_numpy()
+    
+    def key_frame(self, df: pd.DataFrame, keys: Optional[List[str]] = None) -> pd.DataFrame:
+        """The compared values of each row, in canonical text form"""
+        keys = keys or self.keys or [col for col in df.columns if col != '_source_file']
+        return pd.DataFrame({i: canonical_text(df[key]) for i, key in enumerate(keys)}, index=df.index)
+    
+    def _codes(self, df: pd.DataFrame) -> np.ndarray:
+        """Per-row code of the row's _source_file in self.sources"""
+        names = df['_source_file'] if '_source_file' in df.columns else pd.Series('', index=df.index)
+        codes, uniques = pd.factorize(names)
+        mapping = np.empty(len(uniques), dtype=np.int32)
+        for i, name in enumerate(uniques):
+            if name not in self._source_codes:
+                self._source_codes[name] = len(self.sources)
+                self.sources.append(name)
+            mapping[i] = self._source_codes[name]
+        return mapping[codes]
+    
+    def filter(self, df: pd.DataFrame) -> pd.DataFrame:
+        """df without the rows seen before, in this frame or in earlier ones"""
+        if df.empty:
+            return df
+        hashes = self.hash_rows(df)
+        sources = self._codes(df)
+        
+        # Duplicates inside the frame point at the first row with the same hash
+        rows = np.arange(len(hashes))
+        first = pd.Series(rows).groupby(hashes, sort=False).transform('first').to_numpy()
+        repeated = np.flatnonzero(first != rows)
+        if len(repeated):
+            keys = self.key_frame(df).reset_index(drop=True)
+            later, earliest = keys.iloc[repeated].reset_index(drop=True), keys.iloc[first[repeated]].reset_index(drop=True)
+            same = ((later == earliest).fillna(False) | (later.isna() & earliest.isna())).all(axis=1)
+            if not same.all():
+                # A hash collision, group the frame by its values instead
+                first = pd.Series(rows).groupby([keys[col] for col in keys.columns], sort=False,
+                                                dropna=False).transform('first').to_numpy()
+        earlier = self.seen.lookup(hashes)
+        drop = (earlier >= 0) | (first != rows)
+        
+        self.rows_in += len(df)
+        if not drop.any():
+            self.seen.add(hashes, sources)
+            return df
+        
+        kept_by = np.where(earlier >= 0, earlier, sources[first])[drop]
+        pairs = pd.Series(kept_by.astype(np.int64) * len(self.sources) + sources[drop]).value_counts()
+        for pair, count in pairs.items():
+            key = (self.sources[pair // len(self.sources)], self.sources[pair % len(self.sources)])
+            self.pair_counts[key] = self.pair_counts.get(key, 0) + int(count)
+        self.rows_dropped += int(drop.sum())
+        
+        keep = ~drop
+        self.seen.add(hashes[keep], sources[keep])
+        return df.iloc[np.flatnonzero(keep)]
+    
+    def summary(self) -> pd.DataFrame:
+        """Dropped rows per (first_file, duplicate_file) pair, most first"""
+        rows = [(first, duplicate, count) for (first, duplicate), count in self.pair_counts.items()]
+        return pd.DataFrame(rows, columns=['first_file', 'duplicate_file', 'rows']).sort_values(
+            'rows', ascending=False, kind='stable', ignore_index=True
+        )
+    
+    def close(self):
+        self.seen.close()
+
 class FileMerger:
-    def __init__(self):
+    def __init__(self, reader_engine: str = DEFAULT_READER_ENGINE, max_workers: int = 1,
+                 optimize_memory: bool = False, error_handler: Optional[Callable] = None):
         self.uploaded_files = []
         self.processed_data = {}
         self.merged_df = None
         self.header_mapping = {}
+        self.reader_engine = reader_engine
+        self.max_workers = max_workers
+        self.optimize_memory = optimize_memory
+        self.header_index = {}
+        self._indexed_file_headers = None
+        # Receives per-file error messages, st.error in the app
+        self.error_handler = error_handler
+        
+    def process_uploaded_files(self, files, max_workers: Optional[int] = None,
+                               cache: Optional[IngestCache] = None,
+                               progress_callback: Optional[Callable] = None,
+                               cancel_event: Optional[threading.Event] = None) -> Dict:
+        """Process uploaded files and register their sheets for lazy loading
         
-    def process_uploaded_files(self, files) -> Dict:
-        """Process uploaded files and extract data"""
+        With a cache, uploads whose content was parsed before reuse that
+        parse and only new or changed files are read. Progress is reported
+        per file; setting cancel_event raises MergeCancelled.
+        """
         processed = {}
+        engines = resolve_reader_engines(self.reader_engine)
+        workers = max_workers or self.max_workers
+        progress = ProgressReporter('ingest', len(files), callback=progress_callback, cancel_event=cancel_event)
+        progress.check_cancelled()
         
+        uploads = []
         for file in files:
+            # Files on disk are read from their path when needed rather than held as bytes
+            content = getattr(file, 'path', None) or file.getvalue()
+            file_type = self.get_file_type(file.name)
+            digest = content_hash(content)
+            cache_key = (digest, file_type, engines['csv'], engines['excel'])
+            cached = cache.get(cache_key) if cache is not None else None
+            uploads.append((file, content, file_type, digest, cache_key, cached))
+        
+        misses = [i for i, upload in enumerate(uploads) if upload[5] is None]
+        inspected = {}
+        if workers > 1 and len(misses) > 1:
+            # Workers report sheet names and a preview, the stores stay in this process
+            results = self._run_in_pool(
+                _inspect_upload_job,
+                [(uploads[i][1], uploads[i][2], engines) for i in misses],
+                workers,
+                cancel_event=cancel_event
+            )
+            inspected = dict(zip(misses, results))
+        
+        for i, (file, content, file_type, digest, cache_key, store) in enumerate(uploads):
             file_info = {
                 'name': file.name,
                 'size': file.size,
-                'type': self.get_file_type(file.name)
+                'type': file_type,
+                'hash': digest
             }
             
             try:
-                if file_info['type'] == 'csv':
-                    df = pd.read_csv(file)
-                    file_info['sheets'] = ['Sheet1']
-                    file_info['data'] = {'Sheet1': df}
-                    
-                elif file_info['type'] == 'excel':
-                    # Read all sheets
-                    excel_file = pd.ExcelFile(file)
-                    file_info['sheets'] = excel_file.sheet_names
-                    file_info['data'] = {}
-                    
-                    for sheet in excel_file.sheet_names:
-                        df = pd.read_excel(file, sheet_name=sheet)
-                        file_info['data'][sheet] = df
-                        
+                if store is None:
+                    if i in inspected:
+                        result, error = inspected[i]
+                        if error is not None:
+                            raise error
+                        sheet_names, preview = result
+                        store = LazySheetStore(content, file_type, sheet_names, engines=engines,
+                                               previews={sheet_names[0]: preview})
+                    else:
+                        store = open_sheet_store(content, file_type, engines)
+                    if cache is not None:
+                        cache.put(cache_key, store)
+                
+                file_info['sheets'] = store.sheet_names
+                file_info['data'] = store
                 processed[file.name] = file_info
                 
             except Exception as e:
-                st.error(f"Error processing {file.name}: {str(e)}")
+                self._report_error(f"Error processing {file.name}: {str(e)}")
+            
+            progress.advance(file.name, file_done=True)
                 
         return processed
     
+    def load_sheets(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict,
+                    max_workers: Optional[int] = None, progress_callback: Optional[Callable] = None,
+                    cancel_event: Optional[threading.Event] = None, plan: Optional[ColumnPlan] = None):
+        """Parse the selected sheet of every selected file, in parallel when allowed
+        
+        With a plan, only the columns it keeps are parsed.
+        Files that fail to parse are reported and deselected.
+        Progress is reported per parsed file; setting cancel_event raises
+        MergeCancelled.
+        """
+        workers = max_workers or self.max_workers
+        pending = []
+        
+        for filename, file_info in processed_data.items():
+            store = file_info['data']
+            if not selected_files.get(filename, True) or not isinstance(store, LazySheetStore):
+                continue
+            sheet_name = selected_sheets.get(filename, file_info['sheets'][0])
+            columns = plan.used_columns(filename) if plan is not None else None
+            if sheet_name in store and not store.has_columns(sheet_name, columns):
+                pending.append((filename, store, sheet_name, columns))
+        
+        progress = ProgressReporter('load', len(pending), callback=progress_callback, cancel_event=cancel_event)
+        progress.check_cancelled()
+        if workers > 1 and len(pending) > 1:
+            results = self._run_in_pool(
+                _parse_sheets_job,
+                [(store.source, store.file_type, store.engines, store.sheet_names, [sheet_name], {sheet_name: columns})
+                 for _, store, sheet_name, columns in pending],
+                workers,
+                cancel_event=cancel_event
+            )
+        else:
+            results = [(None, None)] * len(pending)
+        
+        for (filename, store, sheet_name, columns), (result, error) in zip(pending, results):
+            rows = 0
+            try:
+                if error is not None:
+                    raise error
+                if result is None:
+                    store.load_sheets([sheet_name], {sheet_name: columns})
+                else:
+                    store.put(sheet_name, result[sheet_name])
+                rows = store.loaded_rows(sheet_name)
+            except Exception as e:
+                self._report_error(f"Error processing {filename}: {str(e)}")
+                selected_files[filename] = False
+            progress.advance(filename, rows, file_done=True)
+    
+    def _report_error(self, message: str):
+        (self.error_handler or st.error)(message)
+    
+    def _run_in_pool(self, func, jobs: List[Tuple], max_workers: int,
+                     cancel_event: Optional[threading.Event] = None) -> List[Tuple]:
+        """Run jobs on a bounded process pool
+        
+        Returns (result, error) pairs in job order so callers keep upload order.
+        Once cancel_event is set, queued jobs are dropped and MergeCancelled
+        is raised.
+        """
+        func = _importable(func)
+        outcomes = []
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+            futures = [pool.submit(func, *job) for job in jobs]
+            for future in futures:
+                if cancel_event is not None and cancel_event.is_set():
+                    for queued in futures:
+                        queued.cancel()
+                    raise MergeCancelled(f"cancelled after {len(outcomes)} of {len(jobs)} files")
+                try:
+                    outcomes.append((future.result(), None))
+                except Exception as e:
+                    outcomes.append((None, e))
+        return outcomes
+    
+    def iter_selected_sheets(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict):
+        """Yield (filename, file_info, sheet_name) for every selected file"""
+        for filename, file_info in processed_data.items():
+            if selected_files.get(filename, True):
+                sheet_name = selected_sheets.get(filename, file_info['sheets'][0])
+                if sheet_name in file_info['data']:
+                    yield filename, file_info, sheet_name
+    
+    def get_sheet_schema(self, file_info: Dict, sheet_name: str) -> pd.Series:
+        """Column dtypes of a sheet without parsing its data"""
+        data = file_info['data']
+        if isinstance(data, LazySheetStore):
+            return data.schema(sheet_name)
+        return data[sheet_name].dtypes
+    
+    def get_sheet_columns(self, file_info: Dict, sheet_name: str) -> List[str]:
+        """Column names of a sheet without parsing its data"""
+        return list(self.get_sheet_schema(file_info, sheet_name).index)
+    
+    def get_sheet_preview(self, file_info: Dict, sheet_name: str, rows: int = 5) -> pd.DataFrame:
+        """First rows of a sheet, read on their own when the sheet is not loaded"""
+        data = file_info['data']
+        if isinstance(data, LazySheetStore):
+            return data.preview(sheet_name).head(rows)
+        return data[sheet_name].head(rows)
+    
+    def get_sheet_sample(self, file_info: Dict, sheet_name: str, rows: int = 100) -> pd.DataFrame:
+        """A larger sample than the preview, for value profiling"""
+        data = file_info['data']
+        if isinstance(data, LazySheetStore):
+            return data.sample(sheet_name, rows)
+        return data[sheet_name].head(rows)
+    
+    def get_sheet_data(self, file_info: Dict, sheet_name: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """A sheet, parsing only the given columns when it is not loaded yet
+        
+        This session's optimised frame is used when it has the columns.
+        """
+        optimized = self.get_optimized_data(file_info, sheet_name, columns)
+        if optimized is not None:
+            return optimized
+        data = file_info['data']
+        if isinstance(data, LazySheetStore):
+            return data.select(sheet_name, columns)
+        return data[sheet_name]
+    
+    def get_optimized_data(self, file_info: Dict, sheet_name: str,
+                           columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+        """This session's optimised frame of a sheet, or None when it lacks the columns"""
+        df = file_info.get('optimized', {}).get(sheet_name)
+        if df is None:
+            return None
+        wanted = self.get_sheet_columns(file_info, sheet_name) if columns is None else list(columns)
+        if not set(wanted) <= set(df.columns):
+            return None
+        return df if list(df.columns) == wanted else df[wanted]
+    
+    def get_sheet_rows(self, file_info: Dict, sheet_name: str) -> Optional[int]:
+        """Row count of a sheet, or None while it has not been loaded"""
+        if sheet_name in file_info.get('optimized', {}):
+            return len(file_info['optimized'][sheet_name])
+        data = file_info['data']
+        if isinstance(data, LazySheetStore):
+            return data.loaded_rows(sheet_name)
+        return len(data[sheet_name])
+    
+    def get_output_columns(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict,
+                           header_mapping: Dict = None, excluded_headers: Dict = None) -> List[str]:
+        """Final merged columns in first-appearance order, with _source_file last"""
+        plan = self.compile_column_plan(processed_data, selected_sheets, selected_files,
+                                        header_mapping, excluded_headers)
+        return plan.columns + ['_source_file']
+    
     def get_file_type(self, filename: str) -> str:
         """Determine file type from filename"""
         if filename.lower().endswith('.csv'):
@@ -184,71 +1855,777 @@ class FileMerger:
             return 'excel'
         return 'unknown'
     
+    def get_file_headers(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict) -> Dict[str, List[str]]:
+        """Headers of the selected sheet of every selected file, from schemas only"""
+        return {
+            filename: self.get_sheet_columns(file_info, sheet_name)
+            for filename, file_info, sheet_name in self.iter_selected_sheets(processed_data, selected_sheets, selected_files)
+        }
+    
+    def compile_column_plan(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict,
+                            header_mapping: Dict = None, excluded_headers: Dict = None) -> ColumnPlan:
+        return ColumnPlan.compile(self.get_file_headers(processed_data, selected_sheets, selected_files),
+                                  header_mapping, excluded_headers)
+    
     def analyze_headers(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict) -> Tuple[List[str], bool]:
         """Analyze headers across all selected sheets"""
+        # Only analyze selected files, from their schema so no sheet gets fully parsed
+        file_headers = self.get_file_headers(processed_data, selected_sheets, selected_files)
         all_headers = set()
+        for headers in file_headers.values():
+            all_headers.update(headers)
+        
+        self.build_header_index(file_headers)
+        
+        # Check for header consistency
+        all_headers_list = list(all_headers)
+        has_mismatch = False
+        
+        if len(file_headers) > 1:  # Only check if we have multiple files
+            reference_headers = set(next(iter(file_headers.values())))
+            for filename, headers in file_headers.items():
+                if set(headers) != reference_headers:
+                    has_mismatch = True
+                    break
+                    
+        return all_headers_list, has_mismatch, file_headers
+    
+    def suggest_header_matches(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict,
+                               sample_rows: int = 100,
+                               matcher: Optional[HeaderMatcher] = None) -> Dict[str, Dict[str, Tuple[str, float]]]:
+        """Likely counterparts in other files for headers only one selected file has"""
         file_headers = {}
+        samples = {}
+        for filename, file_info, sheet_name in self.iter_selected_sheets(processed_data, selected_sheets, selected_files):
+            file_headers[filename] = self.get_sheet_columns(file_info, sheet_name)
+            samples[filename] = self.get_sheet_sample(file_info, sheet_name, sample_rows)
+        return (matcher or HeaderMatcher()).suggest(file_headers, samples)
+    
+    def build_header_index(self, file_headers: Dict) -> Dict[str, set]:
+        """Build the header -> set of files index used for match status lookups"""
+        index = {}
+        for filename, headers in file_headers.items():
+            for header in headers:
+                index.setdefault(header, set()).add(filename)
+        self.header_index = index
+        self._indexed_file_headers = file_headers
+        return index
+    
+    def get_header_match_status(self, header: str, all_file_headers: Dict, current_filename: str) -> str:
+        """Check if header exists in other files"""
+        if all_file_headers is not self._indexed_file_headers:
+            self.build_header_index(all_file_headers)
         
-        # Only analyze selected files
-        for filename, file_info in processed_data.items():
-            if selected_files.get(filename, True):  # Default to True if not specified
-                sheet_name = selected_sheets.get(filename, file_info['sheets'][0])
-                if sheet_name in file_info['data']:
-                    df = file_info['data'][sheet_name]
-                    headers = list(df.columns)
-                    file_headers[filename] = headers
-                    all_headers.update(headers)
+        other_file_count = len(all_file_headers) - (current_filename in all_file_headers)
+        if not other_file_count:
+            return "single_file"
+        
+        files = self.header_index.get(header, ())
+        exists_in_others = len(files) > (current_filename in files)
+        return "match" if exists_in_others else "no_match"
+    
+    def merge_files(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict, header_mapping: Dict = None, excluded_headers: Dict = None,
+                    progress_callback: Optional[Callable] = None, cancel_event: Optional[threading.Event] = None,
+                    plan: Optional[ColumnPlan] = None,
+                    deduplicator: Optional[RowDeduplicator] = None) -> pd.DataFrame:
+        """Merge all files into a single DataFrame
+        
+        Sources are selected and renamed without copying their data and are
+        laid out in the final column order before concatenation, so the
+        merged frame is the only full copy made. _source_file is categorical.
+        A precompiled plan replaces header_mapping/excluded_headers. Progress
+        is reported per file, weighted by rows when every sheet is loaded,
+        since each sheet is read whole: a single large file holds the bar
+        until it is read, only the streamed merge reports per chunk. Setting
+        cancel_event raises MergeCancelled. Column dtypes are reconciled across sources before concatenation,
+        the columns that had to widen are listed in attrs['widened_columns'].
+        With a deduplicator, repeated rows are dropped after concatenation.
+        """
+        if plan is None:
+            plan = self.compile_column_plan(processed_data, selected_sheets, selected_files,
+                                            header_mapping, excluded_headers)
+        selected = list(self.iter_selected_sheets(processed_data, selected_sheets, selected_files))
+        row_counts = [self.get_sheet_rows(file_info, sheet_name) for _, file_info, sheet_name in selected]
+        rows_total = None if None in row_counts else sum(row_counts)
+        progress = ProgressReporter('merge', len(selected), rows_total,
+                                    callback=progress_callback, cancel_event=cancel_event)
+        
+        merged_dfs = []
+        source_files = []
+        for filename, file_info, sheet_name in selected:
+            progress.check_cancelled()
+            # Excluded columns of unloaded sheets are never parsed
+            df = self.get_sheet_data(file_info, sheet_name, plan.used_columns(filename))
+            # Renamed views of the source columns, in output order
+            merged_dfs.append(plan.apply(filename, df))
+            source_files.append(filename)
+            progress.advance(filename, len(df), file_done=True)
+        
+        if not merged_dfs:
+            return pd.DataFrame()
+        
+        progress.check_cancelled()
+        self._unify_categories(merged_dfs)
+        reconciler = self._reconcile_dtypes(merged_dfs, source_files, plan.columns)
+        merged_df = self._concat_in_plan_order(merged_dfs, plan)
+        # One small integer code per row instead of a Python string
+        merged_df['_source_file'] = pd.Categorical.from_codes(
+            np.repeat(np.arange(len(source_files)), [len(df) for df in merged_dfs]),
+            categories=source_files
+        )
+        if deduplicator is not None:
+            progress.check_cancelled()
+            merged_df = deduplicator.filter(merged_df).reset_index(drop=True)
+        else:
+            # Rows per _source_file only depend on that file, so the result can be updated later
+            merged_df.attrs['merge_inputs'] = self.partition_keys(processed_data, selected_sheets, selected_files, plan)
+        merged_df.attrs['widened_columns'] = reconciler.widened()
+        return merged_df
+    
+    def _concat_in_plan_order(self, frames: List[pd.DataFrame], plan: ColumnPlan) -> pd.DataFrame:
+        """Concatenate frames with the columns in the plan's order, whichever frame has them first"""
+        merged_df = pd.concat(frames, ignore_index=True, sort=False)
+        ordered = [col for col in plan.columns if col in merged_df.columns]
+        return merged_df if list(merged_df.columns) == ordered else merged_df[ordered]
+    
+    def partition_keys(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict,
+                       plan: ColumnPlan) -> Dict[str, str]:
+        """Key of each selected file's rows in a merge: its name, content, sheet and column mapping
+        
+        The name is part of the key since it is written into _source_file,
+        and it keeps copies of the same file in separate partitions.
+        """
+        keys = {}
+        for filename, file_info, sheet_name in self.iter_selected_sheets(processed_data, selected_sheets, selected_files):
+            select, names = plan.sources[filename]
+            # Inputs built without an upload hash are told apart by their data object
+            source = file_info.get('hash') or f"id:{id(file_info['data'])}"
+            key = json.dumps([filename, source, sheet_name, select.tolist(), [str(name) for name in names]],
+                             ensure_ascii=False)
+            keys[filename] = content_hash(key.encode('utf-8'))
+        return keys
+    
+    def update_merge(self, merged_df: Optional[pd.DataFrame], processed_data: Dict, selected_sheets: Dict,
+                     selected_files: Dict, header_mapping: Dict = None, excluded_headers: Dict = None,
+                     progress_callback: Optional[Callable] = None, cancel_event: Optional[threading.Event] = None,
+                     plan: Optional[ColumnPlan] = None) -> pd.DataFrame:
+        """Bring an earlier merge_files result up to date with the current inputs
+        
+        The rows of each _source_file are a partition keyed by partition_keys.
+        Partitions of removed or changed files are dropped by their category
+        code, only new or changed files are read and merged, and unchanged
+        partitions are kept as they are. Results without merge_inputs, e.g.
+        deduplicated ones, and removals of a file that widened a column are
+        merged from scratch. attrs['merge_changes'] lists the files added and
+        removed.
+        """
+        if plan is None:
+            plan = self.compile_column_plan(processed_data, selected_sheets, selected_files,
+                                            header_mapping, excluded_headers)
+        wanted = self.partition_keys(processed_data, selected_sheets, selected_files, plan)
+        previous = merged_df.attrs.get('merge_inputs') if merged_df is not None else None
+        if previous is not None:
+            gone = {filename for filename in previous if wanted.get(filename) != previous[filename]}
+            # Kept rows cannot be narrowed back to a type a removed file made them widen from
+            if any(gone & set(info['sources']) for info in merged_df.attrs.get('widened_columns', {}).values()):
+                previous = None
+        if previous is None or '_source_file' not in merged_df.columns:
+            result = self.merge_files(processed_data, selected_sheets, selected_files,
+                                      progress_callback=progress_callback, cancel_event=cancel_event, plan=plan)
+            result.attrs['merge_changes'] = {'added': list(wanted), 'removed': []}
+            return result
+        
+        removed = [filename for filename in previous if wanted.get(filename) != previous[filename]]
+        added = [filename for filename in wanted if previous.get(filename) != wanted[filename]]
+        kept = [filename for filename in previous if filename not in removed]
+        if not removed and not added and list(merged_df.columns) == plan.columns + ['_source_file']:
+            merged_df.attrs['merge_changes'] = {'added': [], 'removed': []}
+            return merged_df
+        
+        sources = merged_df['_source_file']
+        codes = sources.cat.codes.to_numpy()
+        # Old category code -> position of the file in the new partition order
+        remap = np.array([list(wanted).index(name) if name in kept else -1 for name in sources.cat.categories],
+                         dtype=np.int64)
+        base = merged_df
+        if removed:
+            keep = remap[codes] >= 0
+            base = merged_df[keep]
+            codes = codes[keep]
+        parts = [base[[col for col in plan.columns if col in base.columns]]]
+        part_codes = [remap[codes]]
+        labels = [', '.join(kept)]
+        
+        widened = {
+            col: {**info, 'sources': {f: d for f, d in info['sources'].items() if f not in removed}}
+            for col, info in merged_df.attrs.get('widened_columns', {}).items() if col in plan.columns
+        }
+        if added:
+            new_df = self.merge_files({filename: processed_data[filename] for filename in added}, selected_sheets,
+                                      selected_files, progress_callback=progress_callback,
+                                      cancel_event=cancel_event, plan=plan)
+            new_codes = new_df['_source_file'].cat.codes.to_numpy()
+            new_remap = np.array([list(wanted).index(name) for name in new_df['_source_file'].cat.categories],
+                                 dtype=np.int64)
+            parts.append(new_df[[col for col in plan.columns if col in new_df.columns]])
+            part_codes.append(new_remap[new_codes])
+            labels.append(', '.join(added))
+            widened.update(new_df.attrs.get('widened_columns', {}))
+        
+        progress = ProgressReporter('merge', 1, callback=progress_callback, cancel_event=cancel_event)
+        progress.check_cancelled()
+        self._unify_categories(parts)
+        reconciler = self._reconcile_dtypes(parts, labels, plan.columns)
+        result = self._concat_in_plan_order(parts, plan)
+        codes = np.concatenate(part_codes)
+        if len(codes) > 1 and (np.diff(codes) < 0).any():
+            # An added file comes before kept ones, restore the selection order
+            order = np.argsort(codes, kind='stable')
+            result = result.take(order).reset_index(drop=True)
+            codes = codes[order]
+        result['_source_file'] = pd.Categorical.from_codes(codes, categories=list(wanted))
+        for col, info in reconciler.widened().items():
+            sources_before = widened.get(col, {}).get('sources', {})
+            widened[col] = {'dtype': info['dtype'], 'sources': {**sources_before, **info['sources']}}
+        result.attrs['widened_columns'] = widened
+        result.attrs['merge_inputs'] = wanted
+        result.attrs['merge_changes'] = {'added': added, 'removed': removed}
+        progress.advance(file_done=True)
+        return result
+    
+    def _reconcile_dtypes(self, frames: List[pd.DataFrame], source_files: List[str],
+                          columns: List[str]) -> DtypeReconciler:
+        """Cast every frame in place to one dtype per column so pd.concat keeps it
+        
+        Columns a frame lacks are added as typed all-missing columns, which
+        pd.concat would otherwise fill with float NaN.
+        """
+        reconciler = DtypeReconciler()
+        for filename, df in zip(source_files, frames):
+            reconciler.observe(filename, df)
+            reconciler.nullable.update(col for col in columns if col not in df.columns)
+        
+        for i, df in enumerate(frames):
+            df = reconciler.coerce(df)
+            missing = {}
+            for col in columns:
+                if col not in df.columns:
+                    empty = reconciler.empty_column(col, len(df))
+                    if empty is not None:
+                        missing[col] = empty.set_axis(df.index)
+            if missing:
+                df = df.assign(**missing)
+                df = df[[col for col in columns if col in df.columns]]
+            frames[i] = df
+        return reconciler
+    
+    def query_files(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict, query: MergeQuery,
+                    header_mapping: Dict = None, excluded_headers: Dict = None, chunksize: int = 100_000,
+                    progress_callback: Optional[Callable] = None,
+                    cancel_event: Optional[threading.Event] = None,
+                    deduplicator: Optional[RowDeduplicator] = None) -> pd.DataFrame:
+        """Run a query over the selected files instead of merging them whole
+        
+        The query is evaluated inside the chunked scan of the streaming
+        merge: only the columns it references are parsed, unloaded CSVs are
+        read chunk by chunk and rows failing its conditions are dropped
+        before the next chunk is read. Aggregates are combined from per-chunk
+        partials. attrs['query_report'] maps each file to its rows scanned
+        and rows matched.
+        """
+        summary, chunks = self._merged_chunks(processed_data, selected_sheets, selected_files, header_mapping,
+                                              excluded_headers, chunksize, progress_callback, cancel_event,
+                                              deduplicator=deduplicator, query=query)
+        frames = []
+        source_files = []
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            source_files.append(chunk['_source_file'].iat[0])
+            frames.append(query.partial(chunk) if query.aggregates else chunk)
+        
+        if query.aggregates:
+            if frames:
+                self._reconcile_dtypes(frames, source_files, list(frames[0].columns))
+            result = query.combine(frames)
+        elif frames:
+            self._reconcile_dtypes(frames, source_files, summary['columns'])
+            result = pd.concat(frames, ignore_index=True, sort=False)
+            result['_source_file'] = pd.Categorical(result['_source_file'], categories=list(summary['rows_per_file']))
+        else:
+            result = pd.DataFrame(columns=summary['columns'])
+        
+        result.attrs['query_report'] = {
+            filename: {'rows': summary['rows_scanned'][filename], 'matched': summary['rows_per_file'][filename]}
+            for filename in summary['rows_per_file']
+        }
+        return result
+    
+    def join_files(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict, keys: List[str],
+                   how: str = 'left', header_mapping: Dict = None, excluded_headers: Dict = None,
+                   strategy: str = 'auto', progress_callback: Optional[Callable] = None,
+                   cancel_event: Optional[threading.Event] = None, plan: Optional[ColumnPlan] = None) -> pd.DataFrame:
+        """Join the selected files side by side on key columns, after header mapping
+        
+        The first selected file is the base and every later file is joined
+        onto the running result with join_indexers. Non-key columns that
+        already exist get the file name appended. attrs['join_report'] holds
+        per-file match counts: rows of the file that found a partner and rows
+        of the running result that found one in the file. Every joined file
+        and the result are held in memory.
+        """
+        if how not in JOIN_TYPES:
+            raise ValueError(f"Unknown join type: {how}")
+        if not keys:
+            raise ValueError("A join needs at least one key column")
+        if plan is None:
+            plan = self.compile_column_plan(processed_data, selected_sheets, selected_files,
+                                            header_mapping, excluded_headers)
+        selected = list(self.iter_selected_sheets(processed_data, selected_sheets, selected_files))
+        progress = ProgressReporter('join', len(selected), callback=progress_callback, cancel_event=cancel_event)
+        
+        result = None
+        report = []
+        for filename, file_info, sheet_name in selected:
+            progress.check_cancelled()
+            df = plan.apply(filename, self.get_sheet_data(file_info, sheet_name, plan.used_columns(filename)))
+            missing = [key for key in keys if key not in df.columns]
+            if missing:
+                raise ValueError(f"{filename} has no key column {', '.join(missing)}")
+            
+            if result is None:
+                result = df.reset_index(drop=True)
+                report.append({'file': filename, 'rows': len(df), 'matched': None, 'strategy': None,
+                               'base_rows': None, 'base_matched': None})
+            else:
+                left_idx, right_idx, used = join_indexers(result[keys], df[keys], how, strategy)
+                paired = (left_idx >= 0) & (right_idx >= 0)
+                report.append({
+                    'file': filename,
+                    'rows': len(df),
+                    'matched': int(np.unique(right_idx[paired]).size),
+                    'strategy': used,
+                    'base_rows': len(result),
+                    'base_matched': int(np.unique(left_idx[paired]).size),
+                })
+                result = self._join_frames(result, df, keys, left_idx, right_idx, filename)
+            progress.advance(filename, len(df), file_done=True)
+        
+        if result is None:
+            return pd.DataFrame()
+        result.attrs['join_report'] = report
+        return result
+    
+    def _join_frames(self, left: pd.DataFrame, right: pd.DataFrame, keys: List[str], left_idx: np.ndarray,
+                     right_idx: np.ndarray, filename: str) -> pd.DataFrame:
+        """Materialise a join from its row indexers"""
+        joined = take_rows(left, left_idx)
+        if (left_idx < 0).any():
+            # Right-only rows of an outer join take their keys from the right side
+            right_keys = take_rows(right[keys], right_idx)
+            for key in keys:
+                joined[key] = joined[key].where(left_idx >= 0, right_keys[key])
+        
+        values = [col for col in right.columns if col not in keys]
+        added = take_rows(right[values], right_idx)
+        added.columns = [f"{col} ({filename})" if col in joined.columns else col for col in values]
+        return pd.concat([joined, added], axis=1)
+    
+    def _unify_categories(self, frames: List[pd.DataFrame]):
+        """Give categorical columns the union of their categories across frames
+        
+        pd.concat only keeps a categorical dtype when every part has the same
+        categories, otherwise the column falls back to object.
+        """
+        categorical = {}
+        for df in frames:
+            for col in df.columns:
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    categorical.setdefault(col, []).append(df[col].cat.categories)
+        
+        for col, category_lists in categorical.items():
+            parts = [df for df in frames if col in df.columns]
+            if len(category_lists) != len(parts):
+                continue  # Mixed with non-categorical parts, leave to pd.concat
+            union = category_lists[0]
+            for categories in category_lists[1:]:
+                union = union.union(categories, sort=False)
+            for df in parts:
+                if not df[col].cat.categories.equals(union):
+                    df[col] = df[col].cat.set_categories(union)
+    
+    def optimize_dtypes(self, df: pd.DataFrame, category_ratio: float = 0.5) -> pd.DataFrame:
+        """Shrink a frame's memory footprint without changing its values
+        
+        Integers are downcast, floats only when float32 holds them exactly,
+        low-cardinality text becomes categorical and remaining text uses
+        Arrow-backed strings when pyarrow is installed.
+        """
+        arrow_strings = is_module_available('pyarrow')
+        optimized = {}
+        
+        for col in df.columns:
+            series = df[col]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                pass
+            elif pd.api.types.is_integer_dtype(series.dtype):
+                series = pd.to_numeric(series, downcast='integer')
+            elif series.dtype == np.float64:
+                narrow = series.astype(np.float32)
+                if ((narrow.astype(np.float64) == series) | series.isna()).all():
+                    series = narrow
+            elif pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype):
+                # Only pure text columns, mixed object columns would change meaning
+                if pd.api.types.infer_dtype(series, skipna=True) == 'string':
+                    if len(series) and series.nunique() / len(series) <= category_ratio:
+                        series = series.astype('category')
+                    elif arrow_strings:
+                        series = series.astype(pd.StringDtype('pyarrow'))
+            optimized[col] = series
+        
+        result = pd.DataFrame(optimized, index=df.index, copy=False)
+        result.attrs.update(df.attrs)
+        result.attrs['dtypes_optimized'] = True
+        return result
+    
+    def optimize_processed_data(self, processed_data: Dict, selected_sheets: Dict,
+                                selected_files: Dict, plan: Optional[ColumnPlan] = None) -> Tuple[int, int]:
+        """Optimise each selected sheet for this session
+        
+        Optimised frames go in file_info['optimized'], which get_sheet_data
+        reads first. The sheet stores are shared across sessions through the
+        ingest cache, so they are not changed: the parsed frame is released
+        instead, and other sessions parse the sheet again when they need it.
+        With a plan, sheets read with only its columns are optimised as read.
+        Returns the memory of those sheets in bytes before and after.
+        """
+        before = after = 0
+        for filename, file_info, sheet_name in self.iter_selected_sheets(processed_data, selected_sheets, selected_files):
+            df = self.get_sheet_data(file_info, sheet_name, plan.used_columns(filename) if plan is not None else None)
+            if df.attrs.get('dtypes_optimized'):
+                size = int(df.memory_usage(deep=True).sum())
+                before += df.attrs.get('original_memory', size)
+                after += size
+                continue
+            
+            original = int(df.memory_usage(deep=True).sum())
+            optimized = self.optimize_dtypes(df)
+            optimized.attrs['original_memory'] = original
+            file_info.setdefault('optimized', {})[sheet_name] = optimized
+            if isinstance(file_info['data'], LazySheetStore):
+                # Otherwise the original stays alive next to its optimised copy
+                file_info['data'].release(sheet_name)
+            before += original
+            after += int(optimized.memory_usage(deep=True).sum())
+        return before, after
+    
+    def merge_files_to_csv(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict, output,
+                           header_mapping: Dict = None, excluded_headers: Dict = None,
+                           chunksize: int = 100_000, progress_callback: Optional[Callable] = None,
+                           cancel_event: Optional[threading.Event] = None,
+                           deduplicator: Optional[RowDeduplicator] = None,
+                           query: Optional[MergeQuery] = None) -> Dict:
+        """Stream the merge straight into a CSV file, one chunk at a time
+        
+        Each chunk gets the same exclusions, renames and _source_file tag as
+        merge_files and is aligned to the unified column set before it is
+        written, so peak memory depends on chunksize rather than data size.
+        Progress is reported per chunk; setting cancel_event raises
+        MergeCancelled. A deduplicator drops repeated rows chunk by chunk and
+        a query's conditions and projection are applied to each chunk.
+        Returns row counts per file and the output columns.
+        """
+        summary, chunks = self._merged_chunks(processed_data, selected_sheets, selected_files, header_mapping,
+                                              excluded_headers, chunksize, progress_callback, cancel_event,
+                                              deduplicator=deduplicator, query=query)
+        
+        handle = open(output, 'w', encoding='utf-8', newline='') if isinstance(output, str) else output
+        try:
+            write_header = True
+            for chunk in chunks:
+                chunk.to_csv(handle, index=False, header=write_header)
+                write_header = False
+            
+            if write_header:
+                # No rows at all, still write the header line
+                pd.DataFrame(columns=summary['columns']).to_csv(handle, index=False)
+        finally:
+            if handle is not output:
+                handle.close()
+        
+        return summary
+    
+    def merge_files_to_file(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict, output,
+                            fmt: str = 'csv', compression: Optional[str] = None,
+                            header_mapping: Dict = None, excluded_headers: Dict = None,
+                            chunksize: int = 100_000, progress_callback: Optional[Callable] = None,
+                            cancel_event: Optional[threading.Event] = None,
+                            max_workers: Optional[int] = None,
+                            deduplicator: Optional[RowDeduplicator] = None,
+                            query: Optional[MergeQuery] = None) -> Dict:
+        """Stream the merge into a binary file object or path in any export format
+        
+        CSV and XLSX are written as chunks arrive. Parquet and Feather need
+        one schema for the whole file, so chunks are spilled to Arrow files
+        on disk first and cast to their unified schema while being copied
+        into the output. With several workers, upcoming Excel sheets are
+        parsed in the pool while earlier files are written. Returns the same
+        summary as merge_files_to_csv.
+        """
+        self._check_export_format(fmt)
+        summary, chunks = self._merged_chunks(processed_data, selected_sheets, selected_files, header_mapping,
+                                              excluded_headers, chunksize, progress_callback, cancel_event,
+                                              max_workers or self.max_workers, deduplicator, query)
+        
+        handle = open(output, 'wb') if isinstance(output, str) else output
+        try:
+            if fmt == 'csv':
+                self._write_csv(chunks, summary['columns'], handle)
+            elif fmt == 'xlsx':
+                self._write_xlsx(chunks, summary['columns'], handle)
+            else:
+                self._write_arrow_spilled(chunks, summary['columns'], handle, fmt, compression)
+        finally:
+            if handle is not output:
+                handle.close()
+        
+        return summary
+    
+    def _merged_chunks(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict,
+                       header_mapping: Optional[Dict], excluded_headers: Optional[Dict], chunksize: int,
+                       progress_callback: Optional[Callable], cancel_event: Optional[threading.Event],
+                       max_workers: int = 1, deduplicator: Optional[RowDeduplicator] = None,
+                       query: Optional[MergeQuery] = None):
+        """Summary dict plus a generator of merged chunks that fills it in as it is consumed
+        
+        With a query, sources only parse the columns it and the deduplicator
+        need. Duplicates are dropped from the merged rows first, then each
+        chunk is filtered before it is yielded; rows_scanned counts the rows
+        read.
+        """
+        plan = self.compile_column_plan(processed_data, selected_sheets, selected_files,
+                                        header_mapping, excluded_headers)
+        output_columns = plan.columns
+        if query is not None:
+            query.validate(plan.columns)
+            needed = query.needed_columns(plan.columns)
+            if not query.aggregates:
+                output_columns = query.output_columns(needed)
+            if deduplicator is not None:
+                # Duplicates are judged on the merged rows, before the query narrows them
+                dedupe_columns = set(deduplicator.keys or plan.columns)
+                needed = [col for col in plan.columns if col in dedupe_columns or col in needed]
+            plan = plan.project(needed)
+        data_columns = plan.columns
+        summary = {'columns': output_columns + ['_source_file'], 'rows': 0, 'rows_per_file': {}, 'widened': {},
+                   'rows_scanned': {}}
+        reconciler = DtypeReconciler(stream=True)
+        selected = list(self.iter_selected_sheets(processed_data, selected_sheets, selected_files))
+        # Row totals are only known when every selected sheet is already loaded
+        row_counts = [self.get_sheet_rows(file_info, sheet_name) for _, file_info, sheet_name in selected]
+        rows_total = None if None in row_counts else sum(row_counts)
+        progress = ProgressReporter('stream', len(selected), rows_total,
+                                    callback=progress_callback, cancel_event=cancel_event)
+        progress.check_cancelled()
+        
+        # Unloaded Excel sheets can be parsed ahead in the pool, at most max_workers at a time
+        prefetchable = {
+            i for i, (_, file_info, sheet_name) in enumerate(selected)
+            if isinstance(file_info['data'], LazySheetStore) and file_info['data'].file_type == 'excel'
+            and not file_info['data'].is_loaded(sheet_name) and sheet_name not in file_info.get('optimized', {})
+        }
+        
+        def chunks():
+            pool = ProcessPoolExecutor(max_workers=max_workers) if max_workers > 1 and len(prefetchable) > 1 else None
+            prefetched = {}
+            try:
+                for i, (filename, file_info, sheet_name) in enumerate(selected):
+                    if pool is not None:
+                        for ahead in range(i, min(i + max_workers, len(selected))):
+                            if ahead in prefetchable and ahead not in prefetched:
+                                store, sheet = selected[ahead][1]['data'], selected[ahead][2]
+                                prefetched[ahead] = pool.submit(
+                                    _importable(_parse_sheets_job),
+                                    store.source, store.file_type, store.engines, store.sheet_names, [sheet],
+                                    {sheet: plan.used_columns(selected[ahead][0]) or None}
+                                )
+                    yield from file_chunks(filename, file_info, sheet_name,
+                                           prefetched.pop(i).result()[sheet_name] if i in prefetched else None)
+            finally:
+                if pool is not None:
+                    for future in prefetched.values():
+                        future.cancel()
+                    pool.shutdown()
+        
+        def file_chunks(filename, file_info, sheet_name, df):
+            data = file_info['data']
+            if df is None:
+                df = self.get_optimized_data(file_info, sheet_name, plan.used_columns(filename) or None)
+            if df is None and isinstance(data, LazySheetStore):
+                # A file without needed columns still has to be read for its row count
+                source_chunks = data.iter_chunks(sheet_name, chunksize, plan.used_columns(filename) or None)
+            else:
+                df = data[sheet_name] if df is None else df
+                source_chunks = (df.iloc[start:start + chunksize] for start in range(0, len(df), chunksize))
+            
+            file_rows = 0
+            file_scanned = 0
+            for chunk in source_chunks:
+                chunk = plan.apply(filename, chunk).reindex(columns=data_columns)
+                # Keeps e.g. an int column from printing as 25.0 in later chunks that contain gaps
+                reconciler.observe(filename, chunk)
+                chunk = reconciler.coerce(chunk)
+                chunk['_source_file'] = filename
+                source_rows = len(chunk)
+                if deduplicator is not None:
+                    chunk = deduplicator.filter(chunk)
+                if query is not None:
+                    chunk = query.filter(chunk)
+                yield chunk
+                file_rows += len(chunk)
+                file_scanned += source_rows
+                progress.advance(filename, source_rows)
+            
+            summary['rows_per_file'][filename] = file_rows
+            summary['rows_scanned'][filename] = file_scanned
+            summary['rows'] += file_rows
+            summary['widened'] = reconciler.widened()
+            progress.advance(filename, file_done=True)
+        
+        return summary, chunks()
+    
+    def export(self, df: pd.DataFrame, output, fmt: str = 'csv', compression: Optional[str] = None,
+               chunksize: int = 100_000):
+        """Write a frame to a binary file object or path in the given format
+        
+        Every format is written chunk by chunk, so the serialised output is
+        never held in memory as a whole: CSV text in chunks, Parquet row
+        groups, Arrow IPC (Feather v2) record batches and an openpyxl
+        write-only workbook that spills to a new sheet past Excel's row limit.
+        """
+        self._check_export_format(fmt)
+        
+        handle = open(output, 'wb') if isinstance(output, str) else output
+        try:
+            if fmt == 'csv':
+                self._write_csv(self._frame_chunks(df, chunksize), df.columns, handle)
+            elif fmt == 'parquet':
+                self._export_parquet(df, handle, compression, chunksize)
+            elif fmt == 'feather':
+                self._export_feather(df, handle, compression, chunksize)
+            else:
+                self._write_xlsx(self._frame_chunks(df, chunksize), df.columns, handle)
+        finally:
+            if handle is not output:
+                handle.close()
+    
+    def _check_export_format(self, fmt: str):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format: {fmt}")
+        if fmt not in available_export_formats():
+            raise ValueError(f"{EXPORT_FORMATS[fmt]['label']} export needs: {', '.join(EXPORT_FORMATS[fmt]['requires'])}")
+    
+    def _frame_chunks(self, df: pd.DataFrame, chunksize: int):
+        return (df.iloc[start:start + chunksize] for start in range(0, len(df), chunksize))
+    
+    def _write_csv(self, chunks, columns, handle):
+        write_header = True
+        for chunk in chunks:
+            handle.write(chunk.to_csv(index=False, header=write_header).encode('utf-8'))
+            write_header = False
+        if write_header:
+            handle.write(pd.DataFrame(columns=columns).to_csv(index=False).encode('utf-8'))
+    
+    def _arrow_chunks(self, df: pd.DataFrame, chunksize: int):
+        """Arrow schema of the whole frame plus a generator of per-chunk tables"""
+        import pyarrow as pa
         
-        # Check for header consistency
-        all_headers_list = list(all_headers)
-        has_mismatch = False
+        df = df.rename(columns=str)
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        tables = (
+            pa.Table.from_pandas(df.iloc[start:start + chunksize], schema=schema, preserve_index=False)
+            for start in range(0, max(len(df), 1), chunksize)
+        )
+        return schema, tables
+    
+    def _export_parquet(self, df: pd.DataFrame, handle, compression: Optional[str], chunksize: int):
+        import pyarrow.parquet as pq
         
-        if len(file_headers) > 1:  # Only check if we have multiple files
-            reference_headers = set(next(iter(file_headers.values())))
-            for filename, headers in file_headers.items():
-                if set(headers) != reference_headers:
-                    has_mismatch = True
-                    break
-                    
-        return all_headers_list, has_mismatch, file_headers
+        schema, tables = self._arrow_chunks(df, chunksize)
+        with pq.ParquetWriter(handle, schema, compression=compression or 'none') as writer:
+            for table in tables:
+                writer.write_table(table)
     
-    def get_header_match_status(self, header: str, all_file_headers: Dict, current_filename: str) -> str:
-        """Check if header exists in other files"""
-        other_files = [f for f in all_file_headers.keys() if f != current_filename]
+    def _export_feather(self, df: pd.DataFrame, handle, compression: Optional[str], chunksize: int):
+        import pyarrow as pa
         
-        if not other_files:
-            return "single_file"
+        schema, tables = self._arrow_chunks(df, chunksize)
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        with pa.ipc.new_file(handle, schema, options=options) as writer:
+            for table in tables:
+                writer.write_table(table)
+    
+    def _write_arrow_spilled(self, chunks, columns, handle, fmt: str, compression: Optional[str]):
+        """Write chunks with differing dtypes as one Parquet/Feather file
         
-        exists_in_others = any(header in all_file_headers[f] for f in other_files)
-        return "match" if exists_in_others else "no_match"
+        Each chunk is spilled to an uncompressed Arrow file, then read back
+        memory-mapped and cast to the schema unified over all chunks.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        with tempfile.TemporaryDirectory(prefix="file_merger_spill_") as spill_dir:
+            parts = []
+            for i, chunk in enumerate(chunks):
+                table = pa.Table.from_pandas(chunk.rename(columns=str), preserve_index=False)
+                path = os.path.join(spill_dir, f"{i:06d}.arrow")
+                with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+                parts.append((path, table.schema))
+            
+            schema = unify_arrow_schemas([schema for _, schema in parts], [str(col) for col in columns])
+            if fmt == 'parquet':
+                writer = pq.ParquetWriter(handle, schema, compression=compression or 'none')
+            else:
+                writer = pa.ipc.new_file(handle, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+            with writer:
+                for path, _ in parts:
+                    with pa.memory_map(path) as source:
+                        table = pa.ipc.open_file(source).read_all()
+                    writer.write_table(table.cast(schema, safe=False))
     
-    def merge_files(self, processed_data: Dict, selected_sheets: Dict, selected_files: Dict, header_mapping: Dict = None, excluded_headers: Dict = None) -> pd.DataFrame:
-        """Merge all files into a single DataFrame"""
-        merged_dfs = []
+    def _write_xlsx(self, chunks, columns, handle):
+        workbook = openpyxl.Workbook(write_only=True)
+        header = [str(col) for col in columns]
+        sheet = None
+        sheet_rows = XLSX_MAX_ROWS
         
-        for filename, file_info in processed_data.items():
-            # Only merge selected files
-            if selected_files.get(filename, True):
-                sheet_name = selected_sheets.get(filename, file_info['sheets'][0])
-                if sheet_name in file_info['data']:
-                    df = file_info['data'][sheet_name].copy()
-                    
-                    # Remove excluded headers first
-                    if excluded_headers and filename in excluded_headers:
-                        columns_to_keep = [col for col in df.columns if col not in excluded_headers[filename]]
-                        df = df[columns_to_keep]
-                    
-                    # Apply header mapping if provided
-                    if header_mapping and filename in header_mapping:
-                        df.rename(columns=header_mapping[filename], inplace=True)
-                    
-                    # Add source file column
-                    df['_source_file'] = filename
-                    merged_dfs.append(df)
+        for chunk in chunks:
+            chunk = chunk.astype(object)
+            chunk = chunk.where(chunk.notna(), None)
+            for row in chunk.itertuples(index=False, name=None):
+                if sheet_rows >= XLSX_MAX_ROWS:
+                    sheet = workbook.create_sheet(f"Merged_{len(workbook.worksheets) + 1}")
+                    sheet.append(header)
+                    sheet_rows = 0
+                sheet.append(row)
+                sheet_rows += 1
         
-        if merged_dfs:
-            return pd.concat(merged_dfs, ignore_index=True, sort=False)
-        return pd.DataFrame()
+        if sheet is None:
+            workbook.create_sheet("Merged_1").append(header)
+        workbook.save(handle)
+    
+    def export_to_spooled(self, df: pd.DataFrame, fmt: str = 'csv', compression: Optional[str] = None,
+                          max_memory: int = EXPORT_SPOOL_BYTES) -> tempfile.SpooledTemporaryFile:
+        """Export into a temporary file that moves to disk once it outgrows max_memory"""
+        spooled = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        try:
+            self.export(df, spooled, fmt, compression)
+        except Exception:
+            spooled.close()
+            raise
+        spooled.seek(0)
+        return spooled
     
     def create_download_link(self, df: pd.DataFrame, filename: str) -> str:
         """Create download link for merged file"""
@@ -257,7 +2634,473 @@ class FileMerger:
         href = f'<a href="data:file/csv;base64,{b64}" download="{filename}">ดาวน์โหลดไฟล์ที่รวมแล้ว</a>'
         return href
 
+class ExportCache:
+    """Exports of one merge result, each format generated once into a spooled temp file"""
+    
+    def __init__(self, merger: FileMerger, df: pd.DataFrame):
+        self.merger = merger
+        self.df = df
+        self._files = {}
+        self._lock = threading.Lock()
+    
+    def get(self, fmt: str, compression: Optional[str] = None):
+        """Spooled export for a format, generated on first request"""
+        with self._lock:
+            key = (fmt, compression)
+            if key not in self._files:
+                start = time.perf_counter()
+                self._files[key] = self.merger.export_to_spooled(self.df, fmt, compression)
+                logger.info("stage export (%s, %s): %.1f ms", fmt, compression or 'none',
+                            (time.perf_counter() - start) * 1000)
+            return self._files[key]
+    
+    def size(self, fmt: str, compression: Optional[str] = None) -> Optional[int]:
+        """Size in bytes of a generated export, None until it exists"""
+        with self._lock:
+            spooled = self._files.get((fmt, compression))
+            if spooled is None:
+                return None
+            position = spooled.tell()
+            size = spooled.seek(0, io.SEEK_END)
+            spooled.seek(position)
+            return size
+    
+    def read(self, fmt: str, compression: Optional[str] = None) -> bytes:
+        """Contents of an export, generating it if needed"""
+        spooled = self.get(fmt, compression)
+        with self._lock:
+            spooled.seek(0)
+            return spooled.read()
+    
+    def close(self):
+        with self._lock:
+            for spooled in self._files.values():
+                spooled.close()
+            self._files.clear()
+
+class ParquetPartitions:
+    """A Parquet dataset directory holding one file per merged source file
+    
+    Syncing a merge into the same directory again only writes the partitions
+    of new or changed inputs, keyed like FileMerger.partition_keys, and
+    deletes those of inputs that are gone. _manifest.json keeps each
+    partition's key and the schema its own file produced. Partitions whose
+    schema differs from the one unified over all of them are cast and
+    rewritten, so any Parquet reader sees one schema. Files are named in
+    merge order, so reading the directory returns rows in merge order.
+    """
+    
+    MANIFEST = '_manifest.json'
+    VERSION = 1
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.partitions = {}
+        manifest = os.path.join(path, self.MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if not isinstance(data, dict) or data.get('version') != self.VERSION:
+                raise ValueError(f"{path}: not a partition manifest")
+            self.partitions = data['partitions']
+        elif os.path.isdir(path) and os.listdir(path):
+            raise ValueError(f"{path} is not empty and has no {self.MANIFEST}")
+    
+    def sync(self, merger: 'FileMerger', processed_data: Dict, selected_sheets: Dict, selected_files: Dict,
+             header_mapping: Dict = None, excluded_headers: Dict = None, compression: Optional[str] = 'snappy',
+             chunksize: int = 100_000, progress_callback: Optional[Callable] = None) -> Dict:
+        """Update the directory to hold the merge of the selected files
+        
+        Returns the files whose partitions were added, removed or rewritten
+        for a schema change, plus total rows and the columns.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        os.makedirs(self.path, exist_ok=True)
+        # Leftovers of an interrupted sync are not in the manifest
+        known = {entry['file'] for entry in self.partitions.values()}
+        for name in os.listdir(self.path):
+            if name.startswith(('part-', 'new-')) and name not in known:
+                os.remove(os.path.join(self.path, name))
+        
+        plan = merger.compile_column_plan(processed_data, selected_sheets, selected_files,
+                                          header_mapping, excluded_headers)
+        wanted = merger.partition_keys(processed_data, selected_sheets, selected_files, plan)
+        removed = [filename for filename, entry in self.partitions.items() if wanted.get(filename) != entry['key']]
+        added = [filename for filename in wanted if self.partitions.get(filename, {}).get('key') != wanted[filename]]
+        
+        for filename in removed:
+            path = os.path.join(self.path, self.partitions.pop(filename)['file'])
+            if os.path.exists(path):
+                os.remove(path)
+        
+        def write_source(filename: str, name: str) -> Dict:
+            path = os.path.join(self.path, name)
+            summary = merger.merge_files_to_file(
+                {filename: processed_data[filename]}, selected_sheets, selected_files, path, 'parquet',
+                compression, header_mapping, excluded_headers, chunksize=chunksize,
+                progress_callback=progress_callback
+            )
+            schema = pq.read_schema(path).remove_metadata()
+            return {'key': wanted[filename], 'file': name, 'rows': summary['rows'],
+                    'schema': base64.b64encode(schema.serialize().to_pybytes()).decode('ascii')}
+        
+        for filename in added:
+            self.partitions[filename] = write_source(filename, f"new-{wanted[filename]}.parquet")
+        self.partitions = {filename: self.partitions[filename] for filename in wanted}
+        
+        native = [pa.ipc.read_schema(pa.py_buffer(base64.b64decode(entry['schema'])))
+                  for entry in self.partitions.values()]
+        schema = unify_arrow_schemas(native, [str(col) for col in plan.columns] + ['_source_file'])
+        
+        rewritten = []
+        for position, (filename, entry) in enumerate(self.partitions.items()):
+            name = f"part-{position:05d}-{entry['key']}.parquet"
+            path = os.path.join(self.path, entry['file'])
+            if not pq.read_schema(path).remove_metadata().equals(schema):
+                table = pq.read_table(path)
+                try:
+                    table = self._conform(table, schema)
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                    # Values widened to text earlier may not cast back, re-read the source instead
+                    os.remove(path)
+                    entry.update(write_source(filename, entry['file']))
+                    table = self._conform(pq.read_table(path), schema)
+                pq.write_table(table, os.path.join(self.path, f"new-{name}"), compression=compression or 'none')
+                os.replace(os.path.join(self.path, f"new-{name}"), os.path.join(self.path, name))
+                if entry['file'] != name:
+                    os.remove(path)
+                if filename not in added:
+                    rewritten.append(filename)
+            elif entry['file'] != name:
+                os.replace(path, os.path.join(self.path, name))
+            entry['file'] = name
+        
+        pq.write_metadata(schema, os.path.join(self.path, '_common_metadata'))
+        manifest = os.path.join(self.path, self.MANIFEST)
+        with open(manifest + '.partial', 'w', encoding='utf-8') as f:
+            json.dump({'version': self.VERSION, 'partitions': self.partitions}, f, ensure_ascii=False, indent=2)
+        os.replace(manifest + '.partial', manifest)
+        
+        return {
+            'added': added,
+            'removed': removed,
+            'rewritten': rewritten,
+            'rows': sum(entry['rows'] for entry in self.partitions.values()),
+            'columns': schema.names,
+        }
+    
+    @staticmethod
+    def _conform(table, schema):
+        """A partition's table with every column of the schema, in its order and types"""
+        import pyarrow as pa
+        
+        columns = [
+            table.column(field.name).cast(field.type, safe=False) if field.name in table.column_names
+            else pa.nulls(table.num_rows, field.type)
+            for field in schema
+        ]
+        return pa.Table.from_arrays(columns, schema=schema)
+    
+    def read(self) -> pd.DataFrame:
+        """The whole dataset as one frame, in merge order"""
+        return pd.read_parquet(self.path)
+
+def freeze_key(value):
+    """Hashable stage key from nested dicts, lists and sets"""
+    if isinstance(value, Mapping):
+        return tuple(sorted((key, freeze_key(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_key(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+    return value
+
+class StageCache:
+    """Memoised pipeline stages for one session
+    
+    Every widget interaction reruns main(). Each stage keeps the key of the
+    inputs it was last computed from and recomputes only when that key
+    changes. Per-stage times of every rerun are logged.
+    """
+    
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.rerun = 0
+        self.timings = {}
+        self._results = {}
+        self._versions = {}
+    
+    def start_rerun(self):
+        self.rerun += 1
+        self.timings = {}
+    
+    def run(self, stage: str, key, compute: Callable):
+        """Result of a stage for these inputs, computed only if the key changed"""
+        start = self.clock()
+        cached = self._results.get(stage)
+        hit = cached is not None and cached[0] == key
+        if hit:
+            value = cached[1]
+        else:
+            value = compute()
+            self._results[stage] = (key, value)
+            self._versions[stage] = self._versions.get(stage, 0) + 1
+        elapsed = self.clock() - start
+        self.timings[stage] = (elapsed, hit)
+        logger.info("rerun %d stage %s: %.1f ms (%s)", self.rerun, stage, elapsed * 1000,
+                    "cached" if hit else "computed")
+        return value
+    
+    def version(self, stage: str) -> int:
+        """How many times a stage has been computed, usable as a downstream key"""
+        return self._versions.get(stage, 0)
+    
+    def invalidate(self, *stages: str):
+        for stage in stages:
+            self._results.pop(stage, None)
+
+class ResultBrowser:
+    """Filtered and sorted pages of a merge result, sliced server-side
+    
+    The row order for a filter/sort combination is computed once as an array
+    of positions; a page is then an iloc over page_size rows, so paging costs
+    the same however many rows the result has.
+    """
+    
+    def __init__(self, df: pd.DataFrame, max_orders: int = 4):
+        self.df = df
+        self.max_orders = max_orders
+        self._orders = OrderedDict()
+    
+    def positions(self, filters: Optional[Dict] = None, sort_by: Optional[str] = None,
+                  ascending: bool = True) -> Optional[np.ndarray]:
+        """Positions of the matching rows in display order, None for the frame as it is
+        
+        A list filter value keeps rows equal to one of its items, any other
+        value keeps rows whose text contains it, ignoring case.
+        """
+        filters = {column: value for column, value in (filters or {}).items() if value not in (None, '', [])}
+        key = (freeze_key(filters), sort_by, ascending)
+        if key in self._orders:
+            self._orders.move_to_end(key)
+            return self._orders[key]
+        
+        positions = None
+        for column, value in filters.items():
+            series = self.df[column] if positions is None else self.df[column].iloc[positions]
+            if isinstance(value, (list, tuple, set)):
+                mask = series.isin(list(value))
+            else:
+                mask = series.astype(str).str.contains(str(value), case=False, regex=False)
+            matched = np.flatnonzero(mask.fillna(False).to_numpy(dtype=bool))
+            positions = matched if positions is None else positions[matched]
+        
+        if sort_by is not None:
+            series = self.df[sort_by] if positions is None else self.df[sort_by].iloc[positions]
+            series = series.reset_index(drop=True)
+            try:
+                order = series.sort_values(ascending=ascending, kind='stable', na_position='last').index
+            except TypeError:
+                # Mixed types in an object column sort by their text
+                order = series.astype(str).sort_values(ascending=ascending, kind='stable').index
+            order = order.to_numpy()
+            positions = order if positions is None else positions[order]
+        
+        self._orders[key] = positions
+        if len(self._orders) > self.max_orders:
+            self._orders.popitem(last=False)
+        return positions
+    
+    def count(self, filters: Optional[Dict] = None) -> int:
+        positions = self.positions(filters)
+        return len(self.df) if positions is None else len(positions)
+    
+    def page(self, page: int, page_size: int, filters: Optional[Dict] = None, sort_by: Optional[str] = None,
+             ascending: bool = True) -> pd.DataFrame:
+        """Rows of one zero-based page, keeping their row numbers in the result as the index"""
+        start = page * page_size
+        positions = self.positions(filters, sort_by, ascending)
+        if positions is None:
+            return self.df.iloc[start:start + page_size]
+        return self.df.iloc[positions[start:start + page_size]]
+
+def clear_export_cache():
+    """Release the spooled exports of the previous merge result"""
+    cache = st.session_state.get('export_cache')
+    if cache is not None:
+        cache.close()
+    st.session_state.export_cache = None
+    st.session_state.pop('prepared_downloads', None)
+
+def download_ready(key: str) -> bool:
+    """Whether a download button can be built on this run
+    
+    Deferred downloads are only built on click. Older Streamlit versions
+    need the data up front, so the file is only read once a prepare
+    button has been clicked, not on every rerun.
+    """
+    if DEFERRED_DOWNLOADS:
+        return True
+    prepared = st.session_state.setdefault('prepared_downloads', set())
+    if key not in prepared and st.button("📦 เตรียมไฟล์สำหรับดาวน์โหลด", key=f"prepare_download_{key}",
+                                         use_container_width=True):
+        prepared.add(key)
+    return key in prepared
+
+PROGRESS_STAGES = {
+    'ingest': 'กำลังอ่านไฟล์',
+    'load': 'กำลังโหลดชีต',
+    'merge': 'กำลังรวมข้อมูล',
+    'join': 'กำลัง Join ข้อมูล',
+    'stream': 'กำลังรวมแบบสตรีม',
+}
+
+def format_progress(update: Dict) -> str:
+    """One status line for a ProgressReporter update"""
+    parts = [PROGRESS_STAGES.get(update['stage'], update['stage'])]
+    if update['file']:
+        parts.append(update['file'])
+    parts.append(f"{update['files_done']}/{update['files_total']} ไฟล์")
+    if update['rows']:
+        parts.append(f"{update['rows']:,} แถว")
+    if update['rows_per_second']:
+        parts.append(f"{update['rows_per_second']:,.0f} แถว/วินาที")
+    if update['eta'] is not None and update['fraction'] < 1:
+        parts.append(f"เหลืออีกประมาณ {update['eta']:.0f} วินาที")
+    return " • ".join(parts)
+
+def progress_updater(progress_bar, status_text) -> Callable:
+    """Progress callback that drives a st.progress bar and a status line"""
+    def update(state: Dict):
+        progress_bar.progress(state['fraction'])
+        status_text.text(format_progress(state))
+    return update
+
+def request_merge_cancel():
+    """on_click of the cancel button
+
+    Clicking it also reruns the script, which stops the running merge at its
+    next progress update; the event covers work that is not touching the UI.
+    """
+    cancel_event = st.session_state.get('merge_cancel')
+    if cancel_event is not None:
+        cancel_event.set()
+    st.session_state.merge_cancelled = True
+
+def clear_streamed_result():
+    """Forget the last streamed merge and delete its temporary output file"""
+    result = st.session_state.get('streamed_result')
+    if result and os.path.exists(result['path']):
+        os.remove(result['path'])
+    st.session_state.streamed_result = None
+    st.session_state.pop('prepared_downloads', None)
+
+def show_duplicate_summary(duplicates: pd.DataFrame):
+    """Rows dropped by the dedupe stage, per pair of source files"""
+    st.subheader("🧹 แถวที่ซ้ำกัน")
+    if duplicates.empty:
+        st.success("✅ ไม่พบแถวที่ซ้ำกัน")
+        return
+    st.info(f"ลบแถวที่ซ้ำออก {duplicates['rows'].sum():,} แถว")
+    st.dataframe(duplicates.rename(columns={
+        'first_file': 'ไฟล์ที่เก็บไว้', 'duplicate_file': 'ไฟล์ที่มีแถวซ้ำ', 'rows': 'จำนวนแถวที่ลบ'
+    }), use_container_width=True, hide_index=True)
+
+def show_widened_columns(widened: Dict[str, Dict]):
+    """Columns whose dtype differed between files and was unified by the merge"""
+    if not widened:
+        return
+    with st.expander(f"🔧 ปรับชนิดข้อมูลให้ตรงกัน {len(widened)} คอลัมน์", expanded=False):
+        st.dataframe(pd.DataFrame({
+            'คอลัมน์': list(widened),
+            'ชนิดข้อมูลหลังรวม': [info['dtype'] for info in widened.values()],
+            'ชนิดข้อมูลเดิม': [', '.join(f"{source}: {dtype}" for source, dtype in info['sources'].items())
+                             for info in widened.values()],
+        }), use_container_width=True, hide_index=True)
+
+def show_join_report(report: List[Dict]):
+    """Match rates of a key join, one row per joined file"""
+    st.subheader("🔗 ผลการ Join")
+    base = report[0]
+    rows = []
+    for entry in report[1:]:
+        rows.append({
+            'ไฟล์': entry['file'],
+            'จำนวนแถว': entry['rows'],
+            'แถวที่จับคู่ได้': entry['matched'],
+            'อัตราการจับคู่ (%)': round(entry['matched'] / max(entry['rows'], 1) * 100, 2),
+            'แถวของผลลัพธ์ที่พบในไฟล์นี้ (%)': round(entry['base_matched'] / max(entry['base_rows'], 1) * 100, 2),
+            'วิธีจับคู่': entry['strategy'],
+        })
+    st.caption(f"ไฟล์หลัก: {base['file']} ({base['rows']:,} แถว)")
+    st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+
+def show_query_report(report: Dict[str, Dict]):
+    """Rows each file contributed out of the rows scanned by the query"""
+    st.subheader("🔎 ผลการกรองข้อมูล")
+    scanned = sum(entry['rows'] for entry in report.values())
+    matched = sum(entry['matched'] for entry in report.values())
+    st.caption(f"อ่าน {scanned:,} แถว เก็บไว้ {matched:,} แถวที่ตรงเงื่อนไข")
+    st.dataframe(pd.DataFrame([
+        {'ไฟล์': filename, 'แถวที่อ่าน': entry['rows'], 'แถวที่ตรงเงื่อนไข': entry['matched']}
+        for filename, entry in report.items()
+    ]), use_container_width=True, hide_index=True)
+
+# Files wider than this open the mapping section as one table per file
+COMPACT_MAPPING_COLUMNS = 30
+
+MAPPING_STATUS_LABELS = {
+    'match': '✅ มีในไฟล์อื่น',
+    'no_match': '❌ ไม่มีในไฟล์อื่น',
+    'single_file': '📄 ไฟล์เดียว',
+}
+
+def build_mapping_table(headers: List[str], header_status: Dict[str, str], sample_df: pd.DataFrame,
+                        suggestions: Dict[str, Tuple[str, float]], mapping: Dict[str, str],
+                        excluded: List[str]) -> pd.DataFrame:
+    """One row per header for the compact st.data_editor mapping view
+
+    The output name defaults to the profile mapping, then the suggestion,
+    then the header itself.
+    """
+    samples = []
+    for header in headers:
+        values = sample_df[header].dropna().head(3).tolist() if header in sample_df.columns else []
+        samples.append(', '.join(str(v)[:15] for v in values))
+    return pd.DataFrame({
+        'header': headers,
+        'status': [MAPPING_STATUS_LABELS.get(header_status.get(h), '') for h in headers],
+        'sample': samples,
+        'keep': [h not in excluded for h in headers],
+        'target': [mapping.get(h) or suggestions.get(h, (h, 0))[0] for h in headers],
+        'score': [round(suggestions[h][1] * 100) if h in suggestions and h not in mapping else None
+                  for h in headers],
+    })
+
+def read_mapping_table(table: pd.DataFrame) -> Tuple[Dict[str, str], List[str]]:
+    """Turn an edited mapping table back into (file_mapping, file_excluded)"""
+    file_mapping = {}
+    file_excluded = []
+    for header, keep, target in zip(table['header'], table['keep'], table['target']):
+        if not keep:
+            file_excluded.append(header)
+            continue
+        target = '' if pd.isna(target) else str(target).strip()
+        if target and target != header:
+            file_mapping[header] = target
+    return file_mapping, file_excluded
+
 def main():
+    # Page configuration
+    st.set_page_config(
+        page_title="File Merger - by Bot Aom",
+        page_icon="📁",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+    
     load_css()
     
     # Header
@@ -277,8 +3120,16 @@ def main():
         st.session_state.merged_df = None
     if 'selected_files' not in st.session_state:
         st.session_state.selected_files = {}
+    if 'streamed_result' not in st.session_state:
+        st.session_state.streamed_result = None
+    if 'export_cache' not in st.session_state:
+        st.session_state.export_cache = None
+    if 'pipeline' not in st.session_state:
+        st.session_state.pipeline = StageCache()
     
     merger = st.session_state.merger
+    pipeline = st.session_state.pipeline
+    pipeline.start_rerun()
     
     # Sidebar for file upload and settings
     with st.sidebar:
@@ -290,13 +3141,99 @@ def main():
             help="รองรับไฟล์ CSV และ Excel หลายไฟล์"
         )
         
+        engine_options = available_reader_engines()
+        default_engine = merger.reader_engine if merger.reader_engine in engine_options else 'auto'
+        merger.reader_engine = st.selectbox(
+            "⚡ ตัวอ่านไฟล์",
+            engine_options,
+            index=engine_options.index(default_engine),
+            format_func=lambda name: "อัตโนมัติ (เร็วที่สุดที่มี)" if name == 'auto' else READER_ENGINES[name]['label'],
+            help="เลือก engine สำหรับอ่านไฟล์ ตัวเลือกที่ไม่ได้ติดตั้งจะใช้ pandas แทน"
+        )
+        
+        cpu_count = os.cpu_count() or 1
+        parallel = st.checkbox(
+            "🧵 อ่านไฟล์แบบขนาน",
+            value=merger.max_workers > 1,
+            disabled=cpu_count < 2,
+            help="แยกอ่านหลายไฟล์พร้อมกันด้วยหลาย process"
+        )
+        if parallel:
+            merger.max_workers = int(st.number_input(
+                "จำนวน workers",
+                min_value=2,
+                max_value=max(cpu_count, 2),
+                value=min(max(merger.max_workers, 2), max(cpu_count, 2)),
+                step=1
+            ))
+        else:
+            merger.max_workers = 1
+        
+        merger.optimize_memory = st.checkbox(
+            "🗜️ ลดการใช้หน่วยความจำ",
+            value=merger.optimize_memory,
+            help="แปลงข้อความที่ซ้ำกันมากเป็น category ลดขนาดตัวเลข และใช้ Arrow strings หลังอ่านไฟล์และหลังรวมไฟล์"
+        )
+        
+        st.header("💾 โปรไฟล์ Mapping")
+        profile_file = st.file_uploader(
+            "โหลดโปรไฟล์ (.json)",
+            type=['json'],
+            key="profile_upload",
+            help="ใช้ mapping ที่บันทึกไว้กับไฟล์ที่มี Headers รูปแบบเดียวกัน โดยไม่ต้องจับคู่ใหม่"
+        )
+        if profile_file is not None:
+            profile_id = getattr(profile_file, 'file_id', profile_file.name)
+            if st.session_state.get('profile_id') != profile_id:
+                try:
+                    st.session_state.mapping_profile = MappingProfile.from_json(profile_file.getvalue())
+                    st.session_state.profile_id = profile_id
+                except ValueError as e:
+                    st.error(f"โหลดโปรไฟล์ไม่สำเร็จ: {str(e)}")
+        elif st.session_state.get('profile_id') is not None:
+            st.session_state.mapping_profile = None
+            st.session_state.profile_id = None
+        
+        profile = st.session_state.get('mapping_profile')
+        if profile is not None:
+            st.caption(f"โปรไฟล์: {profile.name or 'ไม่มีชื่อ'} ({len(profile.layouts)} รูปแบบไฟล์)")
+        
         if uploaded_files:
-            if len(uploaded_files) != len(st.session_state.get('last_uploaded', [])):
-                st.session_state.processed_data = merger.process_uploaded_files(uploaded_files)
-                st.session_state.last_uploaded = uploaded_files
+            # Hash each upload once, keyed by Streamlit's per-upload file id
+            upload_hashes = st.session_state.setdefault('upload_hashes', {})
+            upload_keys = []
+            for f in uploaded_files:
+                file_id = getattr(f, 'file_id', f.name)
+                if file_id not in upload_hashes:
+                    upload_hashes[file_id] = content_hash(f.getvalue())
+                upload_keys.append((f.name, upload_hashes[file_id], merger.reader_engine))
+            
+            def ingest():
+                ingest_bar = st.progress(0)
+                ingest_status = st.empty()
+                processed = merger.process_uploaded_files(
+                    uploaded_files, cache=get_ingest_cache(),
+                    progress_callback=progress_updater(ingest_bar, ingest_status)
+                )
+                ingest_bar.empty()
+                ingest_status.empty()
+                return processed
+            
+            processed_data = pipeline.run('ingest', tuple(upload_keys), ingest)
+            if processed_data is not st.session_state.processed_data:
+                st.session_state.processed_data = processed_data
+                # Kept so the next merge only reads the files that were added or changed
+                if st.session_state.merged_df is not None:
+                    st.session_state.previous_merge = st.session_state.merged_df
                 st.session_state.merged_df = None
-                # Initialize selected files to all True
-                st.session_state.selected_files = {f.name: True for f in uploaded_files}
+                pipeline.invalidate('merge')
+                clear_export_cache()
+                clear_streamed_result()
+                # Keep earlier choices, new files start selected
+                previous_selection = st.session_state.selected_files
+                st.session_state.selected_files = {
+                    f.name: previous_selection.get(f.name, True) for f in uploaded_files
+                }
     
     # Main content
     if st.session_state.processed_data:
@@ -379,9 +3316,11 @@ def main():
                     if is_selected:
                         sheet_name = selected_sheets[filename]
                         if sheet_name in file_info['data']:
-                            df = file_info['data'][sheet_name]
-                            st.write(f"**Preview ({len(df)} แถว, {len(df.columns)} คอลัมน์):**")
-                            st.dataframe(df.head(3), use_container_width=True)
+                            preview_df = merger.get_sheet_preview(file_info, sheet_name, 3)
+                            row_count = merger.get_sheet_rows(file_info, sheet_name)
+                            rows_text = f"{row_count} แถว" if row_count is not None else "โหลดข้อมูลเต็มเมื่อรวมไฟล์"
+                            st.write(f"**Preview ({rows_text}, {len(preview_df.columns)} คอลัมน์):**")
+                            st.dataframe(preview_df, use_container_width=True)
                     else:
                         st.markdown("*ไฟล์นี้จะไม่ถูกรวมในการประมวลผล*")
         
@@ -391,11 +3330,15 @@ def main():
                                  if st.session_state.selected_files.get(k, True)}
             
             total_files = len(selected_files_data)
-            total_records = sum([
-                len(file_info['data'][selected_sheets.get(filename, file_info['sheets'][0])]) 
-                for filename, file_info in selected_files_data.items()
-                if selected_sheets.get(filename, file_info['sheets'][0]) in file_info['data']
-            ]) if selected_files_data else 0
+            # Row counts are only known for sheets that have been loaded
+            row_counts = [
+                merger.get_sheet_rows(file_info, sheet_name)
+                for _, file_info, sheet_name in merger.iter_selected_sheets(
+                    selected_files_data, selected_sheets, st.session_state.selected_files
+                )
+            ]
+            total_records = sum(count for count in row_counts if count is not None)
+            unloaded_files = sum(count is None for count in row_counts)
             
             excluded_files = len(st.session_state.processed_data) - total_files
             
@@ -404,21 +3347,67 @@ def main():
                 <h3>📊 สถิติ</h3>
                 <p><strong>ไฟล์ที่เลือก:</strong> {total_files}</p>
                 <p><strong>ไฟล์ที่ไม่เลือก:</strong> {excluded_files}</p>
-                <p><strong>จำนวนแถวรวม:</strong> {total_records:,}</p>
+                <p><strong>จำนวนแถวรวม:</strong> {total_records:,}{f" (ยังไม่โหลด {unloaded_files} ไฟล์)" if unloaded_files else ""}</p>
             </div>
             """, unsafe_allow_html=True)
+            
+            ingest_memory = st.session_state.get('ingest_memory')
+            if ingest_memory:
+                before, after = ingest_memory
+                st.metric(
+                    "หน่วยความจำข้อมูลที่เลือก",
+                    f"{after / 1024 / 1024:.2f} MB",
+                    delta=f"{(after - before) / 1024 / 1024:.2f} MB จาก {before / 1024 / 1024:.2f} MB",
+                    delta_color="inverse"
+                )
         
         # Header analysis - only for selected files
         if any(st.session_state.selected_files.values()):
             st.header("🔍 การวิเคราะห์ Headers")
             
-            all_headers, has_mismatch, file_headers = merger.analyze_headers(
-                st.session_state.processed_data, 
-                selected_sheets,
-                st.session_state.selected_files
+            schema_key = (
+                tuple((name, info.get('hash')) for name, info in st.session_state.processed_data.items()),
+                freeze_key(selected_sheets),
+                freeze_key(st.session_state.selected_files)
+            )
+            
+            def analyze_schema():
+                all_headers, has_mismatch, file_headers = merger.analyze_headers(
+                    st.session_state.processed_data, 
+                    selected_sheets,
+                    st.session_state.selected_files
+                )
+                # Looked up while rendering instead of being recomputed per widget
+                header_status = {
+                    filename: {header: merger.get_header_match_status(header, file_headers, filename) for header in headers}
+                    for filename, headers in file_headers.items()
+                }
+                return all_headers, has_mismatch, file_headers, header_status, sorted(all_headers)
+            
+            all_headers, has_mismatch, file_headers, header_status, sorted_headers = pipeline.run(
+                'schema', schema_key, analyze_schema
             )
             
-            if has_mismatch and len(file_headers) > 1:
+            # A loaded profile that knows every layout replaces the mapping UI
+            use_profile = False
+            profile_mapping, profile_excluded = profile.resolve(file_headers) if profile is not None else ({}, {})
+            if profile is not None and file_headers:
+                unmatched_layouts = profile.unmatched(file_headers)
+                if not unmatched_layouts:
+                    st.markdown(f"""
+                    <div class="success-box">
+                        💾 ทุกไฟล์ตรงกับโปรไฟล์ "{profile.name or 'ไม่มีชื่อ'}" - ใช้ mapping ที่บันทึกไว้
+                    </div>
+                    """, unsafe_allow_html=True)
+                    use_profile = not st.checkbox("✏️ แก้ไข mapping เอง", key="edit_profile_mapping")
+                else:
+                    st.info(f"💾 โปรไฟล์ไม่มีรูปแบบ Headers ของ: {', '.join(unmatched_layouts)}")
+            
+            if use_profile:
+                st.session_state.header_mapping = profile_mapping
+                st.session_state.excluded_headers = profile_excluded
+            
+            elif has_mismatch and len(file_headers) > 1:
                 st.markdown("""
                 <div class="warning-box">
                     ⚠️ พบความไม่สอดคล้องของ Headers - กรุณาตรวจสอบและปรับแต่ง
@@ -434,7 +3423,7 @@ def main():
                         header_html = "<div style='display: flex; flex-wrap: wrap; gap: 5px; margin: 10px 0;'>"
                         
                         for header in headers:
-                            match_status = merger.get_header_match_status(header, file_headers, filename)
+                            match_status = header_status[filename][header]
                             
                             if match_status == "match":
                                 css_class = "header-match"
@@ -452,8 +3441,8 @@ def main():
                         st.markdown(header_html, unsafe_allow_html=True)
                         
                         # Show statistics
-                        matched_headers = [h for h in headers if merger.get_header_match_status(h, file_headers, filename) == "match"]
-                        unmatched_headers = [h for h in headers if merger.get_header_match_status(h, file_headers, filename) == "no_match"]
+                        matched_headers = [h for h in headers if header_status[filename][h] == "match"]
+                        unmatched_headers = [h for h in headers if header_status[filename][h] == "no_match"]
                         
                         col1, col2 = st.columns(2)
                         with col1:
@@ -467,6 +3456,11 @@ def main():
                 # Enhanced Header mapping interface
                 st.subheader("🔧 ปรับแต่ง Headers สำหรับการรวมไฟล์")
                 
+                # Likely counterparts for unmatched headers, used as the selectbox defaults
+                suggestions = pipeline.run('suggest', schema_key, lambda: merger.suggest_header_matches(
+                    st.session_state.processed_data, selected_sheets, st.session_state.selected_files
+                ))
+                
                 st.markdown("""
                 <div style="background: #E8F4FD; padding: 1rem; border-radius: 8px; margin-bottom: 1rem;">
                     <h4 style="color: #1E40AF; margin: 0;">📝 วิธีใช้งาน:</h4>
@@ -479,6 +3473,16 @@ def main():
                 </div>
                 """, unsafe_allow_html=True)
                 
+                # One data_editor per file keeps the widget count flat for wide files
+                compact_mapping = st.radio(
+                    "รูปแบบการแสดงผล:",
+                    ["📊 ตาราง (กะทัดรัด)", "📝 ทีละ Header"],
+                    index=0 if max(len(h) for h in file_headers.values()) > COMPACT_MAPPING_COLUMNS else 1,
+                    key="mapping_mode",
+                    horizontal=True,
+                    help="โหมดตารางเหมาะกับไฟล์ที่มีหลายคอลัมน์ - เรียงตามสถานะได้โดยคลิกหัวคอลัมน์"
+                ) == "📊 ตาราง (กะทัดรัด)"
+                
                 header_mapping = {}
                 excluded_headers = {}
                 
@@ -486,7 +3490,7 @@ def main():
                     st.markdown("---")
                     
                     # File header with match statistics
-                    matched_count = len([h for h in headers if merger.get_header_match_status(h, file_headers, filename) == "match"])
+                    matched_count = len([h for h in headers if header_status[filename][h] == "match"])
                     unmatched_count = len(headers) - matched_count
                     
                     st.markdown(f"### 📁 {filename}")
@@ -498,126 +3502,161 @@ def main():
                     
                     # Get sample data for this file
                     sheet_name = selected_sheets.get(filename, st.session_state.processed_data[filename]['sheets'][0])
-                    sample_df = st.session_state.processed_data[filename]['data'][sheet_name].head(5)
+                    sample_df = merger.get_sheet_preview(st.session_state.processed_data[filename], sheet_name, 5)
                     
                     # Show sample data first
                     with st.expander(f"👁️ ดูตัวอย่างข้อมูล 5 แถวแรก", expanded=False):
                         st.dataframe(sample_df, use_container_width=True)
                     
                     st.write("**⚙️ จัดการ Headers:**")
+                    file_suggestions = suggestions.get(filename, {})
                     
                     file_mapping = {}
                     file_excluded = []
                     
-                    # Create a clean table-like interface
-                    for i, header in enumerate(headers):
-                        match_status = merger.get_header_match_status(header, file_headers, filename)
-                        
-                        with st.container():
-                            col1, col2, col3 = st.columns([2, 2, 3])
+                    if compact_mapping:
+                        table = build_mapping_table(
+                            headers, header_status[filename], sample_df, file_suggestions,
+                            profile_mapping.get(filename, {}), profile_excluded.get(filename, [])
+                        )
+                        edited = st.data_editor(
+                            table,
+                            key=f"mapping_table_{filename}",
+                            hide_index=True,
+                            num_rows="fixed",
+                            use_container_width=True,
+                            disabled=['header', 'status', 'sample', 'score'],
+                            column_config={
+                                'header': st.column_config.TextColumn("Header"),
+                                'status': st.column_config.TextColumn("สถานะ"),
+                                'sample': st.column_config.TextColumn("ตัวอย่าง"),
+                                'keep': st.column_config.CheckboxColumn("ใช้งาน", help="เอาเครื่องหมายออกเพื่อลบ header นี้"),
+                                'target': st.column_config.TextColumn(
+                                    "ชื่อในไฟล์ที่รวม", help="พิมพ์ชื่อ header อื่นเพื่อจับคู่ หรือชื่อใหม่เพื่อเปลี่ยนชื่อ"
+                                ),
+                                'score': st.column_config.NumberColumn("แนะนำ (%)", format="%d%%"),
+                            },
+                        )
+                        file_mapping, file_excluded = read_mapping_table(edited)
+                    else:
+                        # Create a clean table-like interface
+                        for i, header in enumerate(headers):
+                            match_status = header_status[filename][header]
                             
-                            with col1:
-                                # Show header with color coding
-                                if match_status == "match":
-                                    st.markdown(f"✅ **`{header}`**")
-                                    st.caption("🟢 มีในไฟล์อื่น")
-                                elif match_status == "no_match":
-                                    st.markdown(f"❌ **`{header}`**")
-                                    st.caption("🔴 ไม่มีในไฟล์อื่น - ควรพิจารณา")
-                                else:
-                                    st.markdown(f"📄 **`{header}`**")
-                                    st.caption("📁 ไฟล์เดียว")
+                            with st.container():
+                                col1, col2, col3 = st.columns([2, 2, 3])
                                 
-                                # Show sample values
-                                if header in sample_df.columns:
-                                    sample_values = sample_df[header].dropna().head(3).tolist()
-                                    if sample_values:
-                                        st.caption(f"ตัวอย่าง: {', '.join(str(v)[:15] + ('...' if len(str(v)) > 15 else '') for v in sample_values)}")
+                                with col1:
+                                    # Show header with color coding
+                                    if match_status == "match":
+                                        st.markdown(f"✅ **`{header}`**")
+                                        st.caption("🟢 มีในไฟล์อื่น")
+                                    elif match_status == "no_match":
+                                        st.markdown(f"❌ **`{header}`**")
+                                        st.caption("🔴 ไม่มีในไฟล์อื่น - ควรพิจารณา")
                                     else:
-                                        st.caption("ไม่มีข้อมูล")
-                            
-                            with col2:
-                                # Action selection with default based on match status
-                                default_action = 0 if match_status == "match" else 0  # Always default to "ใช้งาน"
-                                
-                                action = st.selectbox(
-                                    "การดำเนินการ:",
-                                    ["✅ ใช้งาน", "❌ ลบทิ้ง"],
-                                    key=f"action_{filename}_{i}",
-                                    index=default_action,
-                                    label_visibility="collapsed",
-                                    help="เลือกว่าจะใช้ header นี้หรือลบทิ้ง"
-                                )
-                            
-                            with col3:
-                                if action == "✅ ใช้งาน":
-                                    # Create mapping options
-                                    mapping_options = []
-                                    mapping_options.append(f"📌 ใช้ชื่อเดิม: {header}")
-                                    
-                                    # Add other headers as mapping options (prioritize matching ones)
-                                    matching_headers = [h for h in all_headers if h != header]
-                                    for other_header in sorted(matching_headers):
-                                        mapping_options.append(f"🔗 จับคู่กับ: {other_header}")
+                                        st.markdown(f"📄 **`{header}`**")
+                                        st.caption("📁 ไฟล์เดียว")
                                     
-                                    mapping_options.append("✏️ สร้างชื่อใหม่")
-                                    
-                                    # Set default selection for unmatched headers
-                                    default_mapping = 0
-                                    if match_status == "no_match" and len(matching_headers) > 0:
-                                        # Suggest the first available header for mapping
-                                        st.info(f"💡 แนะนำ: header นี้ไม่มีในไฟล์อื่น คลิกเพื่อเลือกการจับคู่")
+                                    # Show sample values
+                                    if header in sample_df.columns:
+                                        sample_values = sample_df[header].dropna().head(3).tolist()
+                                        if sample_values:
+                                            st.caption(f"ตัวอย่าง: {', '.join(str(v)[:15] + ('...' if len(str(v)) > 15 else '') for v in sample_values)}")
+                                        else:
+                                            st.caption("ไม่มีข้อมูล")
+                                
+                                with col2:
+                                    # Action selection with default based on match status
+                                    default_action = 1 if header in profile_excluded.get(filename, []) else 0
                                     
-                                    selected_mapping = st.selectbox(
-                                        "เลือกการจับคู่:",
-                                        mapping_options,
-                                        key=f"map_{filename}_{i}",
-                                        index=default_mapping,
+                                    action = st.selectbox(
+                                        "การดำเนินการ:",
+                                        ["✅ ใช้งาน", "❌ ลบทิ้ง"],
+                                        key=f"action_{filename}_{i}",
+                                        index=default_action,
                                         label_visibility="collapsed",
-                                        help="เลือกว่าจะใช้ชื่อเดิม จับคู่กับ header อื่น หรือสร้างชื่อใหม่"
+                                        help="เลือกว่าจะใช้ header นี้หรือลบทิ้ง"
                                     )
-                                    
-                                    if selected_mapping.startswith("🔗 จับคู่กับ:"):
-                                        mapped_header = selected_mapping.replace("🔗 จับคู่กับ: ", "")
-                                        file_mapping[header] = mapped_header
-                                        st.success(f"✅ จับคู่: {header} → {mapped_header}")
+                                
+                                with col3:
+                                    if action == "✅ ใช้งาน":
+                                        # Create mapping options
+                                        mapping_options = []
+                                        mapping_options.append(f"📌 ใช้ชื่อเดิม: {header}")
+                                        
+                                        # Add other headers as mapping options (prioritize matching ones)
+                                        matching_headers = [h for h in sorted_headers if h != header]
+                                        for other_header in matching_headers:
+                                            mapping_options.append(f"🔗 จับคู่กับ: {other_header}")
+                                        
+                                        mapping_options.append("✏️ สร้างชื่อใหม่")
                                         
-                                    elif selected_mapping == "✏️ สร้างชื่อใหม่":
-                                        custom_header = st.text_input(
-                                            "พิมพ์ชื่อใหม่:",
-                                            value=header,
-                                            key=f"custom_{filename}_{i}",
+                                        # Set default selection for unmatched headers, from the profile when it has one
+                                        default_mapping = 0
+                                        profile_target = profile_mapping.get(filename, {}).get(header)
+                                        if profile_target in matching_headers:
+                                            default_mapping = 1 + matching_headers.index(profile_target)
+                                        elif profile_target:
+                                            default_mapping = len(mapping_options) - 1
+                                        elif header in file_suggestions:
+                                            suggested, score = file_suggestions[header]
+                                            default_mapping = 1 + matching_headers.index(suggested)
+                                            st.info(f"💡 แนะนำ: จับคู่กับ {suggested} (ความใกล้เคียง {score:.0%})")
+                                        elif match_status == "no_match" and len(matching_headers) > 0:
+                                            # Suggest the first available header for mapping
+                                            st.info(f"💡 แนะนำ: header นี้ไม่มีในไฟล์อื่น คลิกเพื่อเลือกการจับคู่")
+                                        
+                                        selected_mapping = st.selectbox(
+                                            "เลือกการจับคู่:",
+                                            mapping_options,
+                                            key=f"map_{filename}_{i}",
+                                            index=default_mapping,
                                             label_visibility="collapsed",
-                                            placeholder="พิมพ์ชื่อ header ใหม่...",
-                                            help="กรอกชื่อ header ใหม่ที่ต้องการใช้"
+                                            help="เลือกว่าจะใช้ชื่อเดิม จับคู่กับ header อื่น หรือสร้างชื่อใหม่"
                                         )
-                                        if custom_header and custom_header != header:
-                                            file_mapping[header] = custom_header
-                                            st.success(f"✅ เปลี่ยนชื่อ: {header} → {custom_header}")
+                                        
+                                        if selected_mapping.startswith("🔗 จับคู่กับ:"):
+                                            mapped_header = selected_mapping.replace("🔗 จับคู่กับ: ", "")
+                                            file_mapping[header] = mapped_header
+                                            st.success(f"✅ จับคู่: {header} → {mapped_header}")
+                                            
+                                        elif selected_mapping == "✏️ สร้างชื่อใหม่":
+                                            custom_header = st.text_input(
+                                                "พิมพ์ชื่อใหม่:",
+                                                value=profile_target or header,
+                                                key=f"custom_{filename}_{i}",
+                                                label_visibility="collapsed",
+                                                placeholder="พิมพ์ชื่อ header ใหม่...",
+                                                help="กรอกชื่อ header ใหม่ที่ต้องการใช้"
+                                            )
+                                            if custom_header and custom_header != header:
+                                                file_mapping[header] = custom_header
+                                                st.success(f"✅ เปลี่ยนชื่อ: {header} → {custom_header}")
+                                        else:
+                                            st.info("📌 ใช้ชื่อเดิม")
                                     else:
-                                        st.info("📌 ใช้ชื่อเดิม")
-                                else:
-                                    file_excluded.append(header)
-                                    st.error("🗑️ **Header นี้จะถูกลบออก**")
-                            
-                            # Add spacing between headers
-                            if i < len(headers) - 1:
-                                st.markdown("<div style='height: 10px;'></div>", unsafe_allow_html=True)
-                    
+                                        file_excluded.append(header)
+                                        st.error("🗑️ **Header นี้จะถูกลบออก**")
+                                
+                                # Add spacing between headers
+                                if i < len(headers) - 1:
+                                    st.markdown("<div style='height: 10px;'></div>", unsafe_allow_html=True)
+                        
                     # Summary for this file
                     if file_mapping or file_excluded:
                         with st.expander(f"📋 สรุปการเปลี่ยนแปลงสำหรับ {filename}", expanded=False):
                             if file_mapping:
                                 st.write("**🔄 Headers ที่จะถูกเปลี่ยนชื่อ/จับคู่:**")
                                 for old, new in file_mapping.items():
-                                    match_status = merger.get_header_match_status(old, file_headers, filename)
+                                    match_status = header_status[filename][old]
                                     icon = "❌→✅" if match_status == "no_match" else "🔄"
                                     st.write(f"• {icon} `{old}` → `{new}`")
                             
                             if file_excluded:
                                 st.write("**🗑️ Headers ที่จะถูกลบออก:**")
                                 for excluded in file_excluded:
-                                    match_status = merger.get_header_match_status(excluded, file_headers, filename)
+                                    match_status = header_status[filename][excluded]
                                     icon = "❌🗑️" if match_status == "no_match" else "🗑️"
                                     st.write(f"• {icon} `{excluded}`")
                     
@@ -643,21 +3682,37 @@ def main():
                 st.session_state.header_mapping = {}
                 st.session_state.excluded_headers = {}
             
+            # Compiled once per mapping and reused by the merge
+            mapping_key = (
+                schema_key,
+                freeze_key(st.session_state.get('header_mapping', {})),
+                freeze_key(st.session_state.get('excluded_headers', {}))
+            )
+            column_plan = pipeline.run('mapping', mapping_key, lambda: ColumnPlan.compile(
+                file_headers,
+                st.session_state.get('header_mapping', {}),
+                st.session_state.get('excluded_headers', {})
+            ))
+            
+            with st.expander("💾 บันทึกโปรไฟล์ Mapping", expanded=False):
+                profile_name = st.text_input("ชื่อโปรไฟล์:", value=profile.name if profile is not None else "",
+                                             key="profile_name")
+                saved_profile = MappingProfile(profile_name, dict(profile.layouts) if profile is not None else {})
+                saved_profile.add(file_headers, st.session_state.get('header_mapping', {}),
+                                  st.session_state.get('excluded_headers', {}))
+                st.download_button(
+                    label="💾 ดาวน์โหลดโปรไฟล์",
+                    data=saved_profile.to_json(),
+                    file_name=f"{profile_name or 'mapping_profile'}.json",
+                    mime="application/json",
+                    help="โหลดไฟล์นี้ในครั้งถัดไปเพื่อใช้ mapping เดิมกับไฟล์ที่มี Headers รูปแบบเดียวกัน"
+                )
+            
             # Show final header preview before merge
             if len(file_headers) > 1:
                 st.subheader("📋 ตัวอย่าง Headers หลังการปรับแต่ง")
                 
-                preview_headers = set()
-                for filename, headers in file_headers.items():
-                    mapped_headers = st.session_state.get('header_mapping', {}).get(filename, {})
-                    excluded = st.session_state.get('excluded_headers', {}).get(filename, [])
-                    
-                    for header in headers:
-                        if header not in excluded:
-                            final_header = mapped_headers.get(header, header)
-                            preview_headers.add(final_header)
-                
-                preview_headers.add('_source_file')  # Always added during merge
+                preview_headers = set(column_plan.columns) | {'_source_file'}  # _source_file is always added during merge
                 
                 col1, col2 = st.columns([3, 1])
                 with col1:
@@ -698,32 +3753,325 @@ def main():
                     for f in excluded_files_list:
                         st.write(f"• 🚫 {f}")
             
-            if st.button("🚀 เริ่มรวมไฟล์", type="primary", use_container_width=True):
-                with st.spinner("กำลังรวมไฟล์..."):
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
+            join_mode = st.radio(
+                "รูปแบบการรวม:",
+                ["📚 ต่อแถว (รวมแถวจากทุกไฟล์)", "🔗 Join ตามคีย์ (เพิ่มคอลัมน์จากไฟล์อื่น)"],
+                key="merge_mode",
+                horizontal=True,
+                help="Join ใช้ไฟล์แรกเป็นหลัก แล้วเติมคอลัมน์จากไฟล์ถัดไปที่มีคีย์ตรงกัน แบบเดียวกับ VLOOKUP "
+                     "ทำในหน่วยความจำทั้งหมด ไม่รองรับโหมดสตรีม"
+            ) == "🔗 Join ตามคีย์ (เพิ่มคอลัมน์จากไฟล์อื่น)"
+            
+            join_keys, join_how, join_strategy = [], 'left', 'auto'
+            if join_mode:
+                # Keys must exist in every file after header mapping
+                common_columns = [
+                    col for col in column_plan.columns
+                    if all(col in column_plan.file_columns(filename) for filename in column_plan.sources)
+                ]
+                col1, col2, col3 = st.columns([3, 2, 2])
+                with col1:
+                    join_keys = st.multiselect("คอลัมน์คีย์:", common_columns, key="join_keys",
+                                               help="เฉพาะคอลัมน์ที่มีในทุกไฟล์หลังการจับคู่ Headers")
+                with col2:
+                    join_how = st.selectbox(
+                        "ชนิดการ Join:", list(JOIN_TYPES), key="join_how",
+                        format_func=lambda how: {'left': "Left - เก็บทุกแถวของไฟล์แรก",
+                                                 'inner': "Inner - เฉพาะแถวที่ตรงกัน",
+                                                 'outer': "Outer - ทุกแถวจากทุกไฟล์"}[how]
+                    )
+                with col3:
+                    join_strategy = st.selectbox(
+                        "วิธีจับคู่:", list(JOIN_STRATEGIES), key="join_strategy",
+                        format_func=lambda strategy: {'auto': "อัตโนมัติ", 'hash': "Hash join",
+                                                      'sort': "Sort-merge"}[strategy],
+                        help="Sort-merge เร็วเมื่อคีย์ของไฟล์ถัดไปเรียงอยู่แล้ว ผลลัพธ์เหมือนกันทุกวิธี"
+                    )
+                if not join_keys:
+                    st.info("💡 เลือกคอลัมน์คีย์อย่างน้อย 1 คอลัมน์ที่มีในทุกไฟล์")
+            
+            query = MergeQuery()
+            if not join_mode:
+                with st.expander("🔎 กรองและสรุปข้อมูลระหว่างอ่านไฟล์", expanded=False):
+                    st.caption("เงื่อนไขถูกตรวจระหว่างอ่านไฟล์ทีละส่วน แถวที่ไม่ตรงเงื่อนไขและคอลัมน์ที่ไม่ได้ใช้จะไม่ถูกเก็บในหน่วยความจำ")
+                    conditions = st.data_editor(
+                        pd.DataFrame({'column': pd.Series(dtype='object'), 'op': pd.Series(dtype='object'),
+                                      'value': pd.Series(dtype='object')}),
+                        key="query_conditions",
+                        num_rows="dynamic",
+                        hide_index=True,
+                        use_container_width=True,
+                        column_config={
+                            'column': st.column_config.SelectboxColumn("คอลัมน์", options=column_plan.columns),
+                            'op': st.column_config.SelectboxColumn("เงื่อนไข", options=list(QUERY_OPERATORS)),
+                            'value': st.column_config.TextColumn(
+                                "ค่า", help="in และ between คั่นค่าด้วยจุลภาค เช่น 2024-01-01,2024-03-31"),
+                        }
+                    )
+                    query_columns = st.multiselect("เลือกเฉพาะคอลัมน์:", column_plan.columns, key="query_columns",
+                                                   placeholder="ทุกคอลัมน์")
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        group_by = st.multiselect("จัดกลุ่มตาม:", column_plan.columns, key="query_group_by")
+                    with col2:
+                        aggregate_options = ['count'] + [
+                            MergeQuery.aggregate_name(func, col)
+                            for col in column_plan.columns for func in QUERY_AGGREGATES if func != 'count'
+                        ]
+                        aggregate_names = st.multiselect("สรุปค่า:", aggregate_options, key="query_aggregates",
+                                                         help="เมื่อเลือก ผลลัพธ์จะเป็นหนึ่งแถวต่อกลุ่มแทนแถวข้อมูล")
+                    try:
+                        where = [
+                            MergeQuery.parse_condition(row['column'], row['op'], row['value'])
+                            for row in conditions.to_dict('records')
+                            if row['column'] and row['op'] and not pd.isna(row['value'])
+                        ]
+                        aggregates = [
+                            ('count', None) if name == 'count' else tuple(name[:-1].split('(', 1))
+                            for name in aggregate_names
+                        ]
+                        query = MergeQuery(where, query_columns, group_by, aggregates)
+                    except ValueError as e:
+                        st.error(f"❌ {e}")
+            
+            streaming = st.checkbox(
+                "💾 โหมดสตรีม (สำหรับไฟล์ขนาดใหญ่)",
+                value=False,
+                disabled=join_mode or bool(query.aggregates),
+                help="อ่านและเขียนทีละส่วนลงไฟล์ CSV โดยตรง ใช้หน่วยความจำน้อย แต่ไม่แสดงตัวอย่างข้อมูลหลังรวม"
+            ) and not join_mode and not query.aggregates
+            dedupe = not join_mode and st.checkbox(
+                "🧹 ลบแถวที่ซ้ำกัน",
+                value=False,
+                key="dedupe",
+                help="เก็บแถวแรกที่พบตามลำดับไฟล์ และลบแถวที่ซ้ำในไฟล์เดียวกันหรือไฟล์ถัดไป "
+                     "(โหมดสตรีมจำแถวก่อนหน้าด้วยค่า Hash 64 บิต จึงมีโอกาสน้อยมากที่แถวต่างกันจะถูกนับว่าซ้ำ)"
+            )
+            dedupe_keys = []
+            if dedupe:
+                dedupe_keys = st.multiselect(
+                    "คอลัมน์ที่ใช้ตรวจสอบการซ้ำ:",
+                    column_plan.columns,
+                    key="dedupe_keys",
+                    placeholder="ทุกคอลัมน์ (ทั้งแถว)",
+                    help="เช่น เลขที่รายการ - ถ้าไม่เลือก แถวต้องเหมือนกันทุกคอลัมน์จึงนับว่าซ้ำ"
+                )
+            
+            if st.session_state.pop('merge_cancelled', False):
+                st.warning("⏹️ ยกเลิกการรวมไฟล์แล้ว")
+            
+            if st.button("🚀 เริ่มรวมไฟล์", type="primary", use_container_width=True, disabled=join_mode and not join_keys):
+                clear_streamed_result()
+                clear_export_cache()
+                st.session_state.merge_cancel = cancel_event = threading.Event()
+                st.button("⏹️ ยกเลิกการรวม", key="cancel_merge", on_click=request_merge_cancel)
+                progress_bar = st.progress(0)
+                status_text = st.empty()
+                show_progress = progress_updater(progress_bar, status_text)
+                
+                try:
+                    if streaming:
+                        st.session_state.merged_df = None
+
+                        output = tempfile.NamedTemporaryFile(prefix="merged_", suffix=".csv", delete=False)
+                        output.close()
+                        deduplicator = RowDeduplicator(dedupe_keys) if dedupe else None
+                        try:
+                            summary = merger.merge_files_to_csv(
+                                st.session_state.processed_data,
+                                selected_sheets,
+                                st.session_state.selected_files,
+                                output.name,
+                                st.session_state.get('header_mapping', {}),
+                                st.session_state.get('excluded_headers', {}),
+                                progress_callback=show_progress,
+                                cancel_event=cancel_event,
+                                deduplicator=deduplicator,
+                                query=None if query.is_empty() else query
+                            )
+                        except BaseException:
+                            # Cancelled or interrupted by a rerun, drop the partial file
+                            os.remove(output.name)
+                            raise
+                        finally:
+                            if deduplicator is not None:
+                                deduplicator.close()
+                        summary['path'] = output.name
+                        summary['duplicates'] = deduplicator.summary() if deduplicator is not None else None
+                        if not query.is_empty():
+                            summary['query_report'] = {
+                                filename: {'rows': summary['rows_scanned'][filename], 'matched': rows}
+                                for filename, rows in summary['rows_per_file'].items()
+                            }
+                        st.session_state.streamed_result = summary
+                        
+                        status_text.text('เสร็จสิ้น!')
+                        st.success(f"✅ รวมไฟล์สำเร็จ! รวม {len(summary['rows_per_file'])} ไฟล์ ได้รับ {summary['rows']:,} แถว")
                     
-                    # Simulate progress
-                    for i in range(100):
-                        progress_bar.progress(i + 1)
-                        status_text.text(f'กำลังประมวลผล... {i + 1}%')
+                    else:
+                        def merge():
+                            previous = st.session_state.merged_df
+                            if previous is None:
+                                previous = st.session_state.get('previous_merge')
+                            incremental = (previous is not None and not join_mode and query.is_empty()
+                                           and not dedupe and 'merge_inputs' in previous.attrs)
+                            # Sheets are only parsed now, concurrently when enabled and without excluded columns.
+                            # A query parses them itself during its scan, keeping only the rows it matches,
+                            # and an incremental merge only reads the files that were added or changed.
+                            scan_only = incremental or (not join_mode and not query.is_empty())
+                            if not scan_only:
+                                merger.load_sheets(st.session_state.processed_data, selected_sheets,
+                                                   st.session_state.selected_files,
+                                                   progress_callback=show_progress, cancel_event=cancel_event,
+                                                   plan=column_plan)
+                            ingest_memory = None
+                            if merger.optimize_memory and not scan_only:
+                                ingest_memory = merger.optimize_processed_data(
+                                    st.session_state.processed_data, selected_sheets, st.session_state.selected_files,
+                                    plan=column_plan
+                                )
+                            
+                            if join_mode:
+                                merged_df = merger.join_files(
+                                    st.session_state.processed_data,
+                                    selected_sheets,
+                                    st.session_state.selected_files,
+                                    join_keys,
+                                    join_how,
+                                    strategy=join_strategy,
+                                    progress_callback=show_progress,
+                                    cancel_event=cancel_event,
+                                    plan=column_plan
+                                )
+                                return merged_df, ingest_memory, None, None
+                            
+                            # Perform actual merge with header mapping and exclusions
+                            deduplicator = RowDeduplicator(dedupe_keys) if dedupe else None
+                            if incremental:
+                                merged_df = merger.update_merge(
+                                    previous,
+                                    st.session_state.processed_data,
+                                    selected_sheets,
+                                    st.session_state.selected_files,
+                                    progress_callback=show_progress,
+                                    cancel_event=cancel_event,
+                                    plan=column_plan
+                                )
+                            elif query.is_empty():
+                                merged_df = merger.merge_files(
+                                    st.session_state.processed_data,
+                                    selected_sheets,
+                                    st.session_state.selected_files,
+                                    st.session_state.get('header_mapping', {}),
+                                    st.session_state.get('excluded_headers', {}),
+                                    progress_callback=show_progress,
+                                    cancel_event=cancel_event,
+                                    plan=column_plan,
+                                    deduplicator=deduplicator
+                                )
+                            else:
+                                # Filtered while scanning, so only matching rows are ever held
+                                merged_df = merger.query_files(
+                                    st.session_state.processed_data,
+                                    selected_sheets,
+                                    st.session_state.selected_files,
+                                    query,
+                                    st.session_state.get('header_mapping', {}),
+                                    st.session_state.get('excluded_headers', {}),
+                                    progress_callback=show_progress,
+                                    cancel_event=cancel_event,
+                                    deduplicator=deduplicator
+                                )
+                            duplicates = None
+                            if deduplicator is not None:
+                                duplicates = deduplicator.summary()
+                                deduplicator.close()
+                            
+                            merge_memory_before = None
+                            if merger.optimize_memory:
+                                merge_memory_before = merged_df.memory_usage(deep=True).sum()
+                                merged_df = merger.optimize_dtypes(merged_df)
+                            return merged_df, ingest_memory, merge_memory_before, duplicates
                         
-                    # Perform actual merge with header mapping and exclusions
-                    merged_df = merger.merge_files(
-                        st.session_state.processed_data,
-                        selected_sheets,
-                        st.session_state.selected_files,
-                        st.session_state.get('header_mapping', {}),
-                        st.session_state.get('excluded_headers', {})
+                        # Merging again with unchanged inputs reuses the last result
+                        merge_key = (
+                            schema_key,
+                            freeze_key(st.session_state.get('header_mapping', {})),
+                            freeze_key(st.session_state.get('excluded_headers', {})),
+                            merger.optimize_memory,
+                            dedupe and tuple(dedupe_keys),
+                            join_mode and (tuple(join_keys), join_how, join_strategy),
+                            query.key()
+                        )
+                        (merged_df, st.session_state.ingest_memory, st.session_state.merge_memory_before,
+                         st.session_state.duplicates) = pipeline.run('merge', merge_key, merge)
+                        
+                        st.session_state.merged_df = merged_df
+                        st.session_state.export_cache = ExportCache(merger, merged_df)
+                        
+                        progress_bar.progress(1.0)
+                        status_text.text('เสร็จสิ้น!')
+                        
+                        selected_count = sum(st.session_state.selected_files.values())
+                        st.success(f"✅ รวมไฟล์สำเร็จ! รวม {selected_count} ไฟล์ ได้รับ {len(merged_df):,} แถว")
+                        st.session_state.previous_merge = None
+                        changes = merged_df.attrs.get('merge_changes')
+                        if changes and (changes['removed'] or len(changes['added']) < selected_count):
+                            st.info(f"🔁 อัปเดตผลลัพธ์เดิม: เพิ่ม {len(changes['added'])} ไฟล์ "
+                                    f"ลบ {len(changes['removed'])} ไฟล์ ไฟล์ที่ไม่เปลี่ยนไม่ถูกอ่านซ้ำ")
+                except MergeCancelled:
+                    status_text.empty()
+                    st.warning("⏹️ ยกเลิกการรวมไฟล์แล้ว")
+                finally:
+                    st.session_state.merge_cancel = None
+        
+        # Show streamed merge results
+        if st.session_state.streamed_result is not None:
+            st.header("📊 ผลลัพธ์การรวมไฟล์")
+            
+            result = st.session_state.streamed_result
+            file_size = os.path.getsize(result['path']) / 1024
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("จำนวนแถวรวม", f"{result['rows']:,}")
+            with col2:
+                st.metric("จำนวนคอลัมน์", len(result['columns']))
+            with col3:
+                st.metric("ไฟล์ที่รวม", len(result['rows_per_file']))
+            
+            st.header("⬇️ ดาวน์โหลด")
+            col1, col2 = st.columns([2, 1])
+            with col1:
+                def read_streamed_output(path=result['path']):
+                    with open(path, 'rb') as merged_file:
+                        return merged_file.read()
+                
+                if download_ready('streamed'):
+                    st.download_button(
+                        label="📥 ดาวน์โหลดไฟล์ CSV",
+                        data=read_streamed_output if DEFERRED_DOWNLOADS else read_streamed_output(),
+                        file_name=f"merged_file_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                        mime="text/csv",
+                        type="primary",
+                        use_container_width=True
                     )
-                    
-                    st.session_state.merged_df = merged_df
-                    
-                    progress_bar.progress(100)
-                    status_text.text('เสร็จสิ้น!')
-                    
-                    selected_count = sum(st.session_state.selected_files.values())
-                    st.success(f"✅ รวมไฟล์สำเร็จ! รวม {selected_count} ไฟล์ ได้รับ {len(merged_df):,} แถว")
+            with col2:
+                st.info(f"ขนาดไฟล์: {file_size:.2f} KB")
+            
+            show_widened_columns(result.get('widened', {}))
+            if result.get('duplicates') is not None:
+                show_duplicate_summary(result['duplicates'])
+            if result.get('query_report'):
+                show_query_report(result['query_report'])
+            
+            st.subheader("📋 สถิติรายละเอียดตามไฟล์")
+            rows_per_file = pd.Series(result['rows_per_file'], dtype='int64')
+            st.dataframe(pd.DataFrame({
+                'ไฟล์': rows_per_file.index,
+                'จำนวนแถว': rows_per_file.values,
+                'สัดส่วน (%)': (rows_per_file.values / max(result['rows'], 1) * 100).round(2)
+            }), use_container_width=True, hide_index=True)
         
         # Show merged results
         if st.session_state.merged_df is not None:
@@ -743,46 +4091,142 @@ def main():
                 st.metric("จำนวนคอลัมน์", len(merged_df.columns))
             with col3:
                 st.metric("ไฟล์ที่รวม", selected_files_count)
+            # Result statistics only change with a new merge
+            def summarize_result():
+                source_counts = merged_df['_source_file'].value_counts() if '_source_file' in merged_df.columns else None
+                return merged_df.memory_usage(deep=True).sum(), source_counts
+            
+            memory_bytes, source_counts = pipeline.run('stats', (pipeline.version('merge'), id(merged_df)), summarize_result)
+            
             with col4:
-                memory_usage = merged_df.memory_usage(deep=True).sum() / 1024 / 1024
-                st.metric("ใช้หน่วยความจำ", f"{memory_usage:.2f} MB")
+                memory_usage = memory_bytes / 1024 / 1024
+                memory_before = st.session_state.get('merge_memory_before')
+                if memory_before:
+                    memory_before = memory_before / 1024 / 1024
+                    st.metric(
+                        "ใช้หน่วยความจำ",
+                        f"{memory_usage:.2f} MB",
+                        delta=f"{memory_usage - memory_before:.2f} MB จาก {memory_before:.2f} MB",
+                        delta_color="inverse"
+                    )
+                else:
+                    st.metric("ใช้หน่วยความจำ", f"{memory_usage:.2f} MB")
             
             if excluded_files_count > 0:
                 st.info(f"ℹ️ มี {excluded_files_count} ไฟล์ที่ไม่ได้รวมตามที่เลือก")
             
-            # Data preview
+            show_widened_columns(merged_df.attrs.get('widened_columns', {}))
+            if merged_df.attrs.get('join_report'):
+                show_join_report(merged_df.attrs['join_report'])
+            if merged_df.attrs.get('query_report'):
+                show_query_report(merged_df.attrs['query_report'])
+            if st.session_state.get('duplicates') is not None:
+                show_duplicate_summary(st.session_state.duplicates)
+            
+            # Data browser, one page of rows sliced on the server per rerun
             st.subheader("ตัวอย่างข้อมูล")
-            st.dataframe(merged_df.head(100), use_container_width=True)
+            browser = st.session_state.get('result_browser')
+            if browser is None or browser.df is not merged_df:
+                browser = st.session_state.result_browser = ResultBrowser(merged_df)
+            
+            no_column = "(ไม่เลือก)"
+            col1, col2, col3, col4 = st.columns([2, 2, 2, 1])
+            with col1:
+                filter_column = st.selectbox("ค้นหาในคอลัมน์:", [no_column] + list(merged_df.columns),
+                                             key="browse_filter_column")
+            with col2:
+                filter_text = st.text_input("คำค้นหา:", key="browse_filter_text", placeholder="พิมพ์ข้อความที่ต้องการค้นหา...",
+                                            disabled=filter_column == no_column)
+            with col3:
+                sort_column = st.selectbox("เรียงตาม:", [no_column] + list(merged_df.columns), key="browse_sort_column")
+            with col4:
+                descending = st.toggle("มากไปน้อย", key="browse_descending", disabled=sort_column == no_column)
+            
+            filters = {}
+            if source_counts is not None and len(source_counts) > 1:
+                filters['_source_file'] = st.multiselect("ไฟล์ต้นทาง:", list(source_counts.index), key="browse_sources",
+                                                         placeholder="ทุกไฟล์")
+            if filter_column != no_column:
+                filters[filter_column] = filter_text
+            sort_by = None if sort_column == no_column else sort_column
+            
+            total_rows = browser.count(filters)
+            col1, col2 = st.columns([1, 3])
+            with col1:
+                page_size = st.selectbox("แถวต่อหน้า:", [50, 100, 500, 1000], index=1, key="browse_page_size")
+            page_count = max(1, -(-total_rows // page_size))
+            if st.session_state.get('browse_page', 1) > page_count:
+                st.session_state.browse_page = page_count
+            with col2:
+                page = st.number_input(f"หน้า (จาก {page_count:,}):", min_value=1, max_value=page_count, value=1,
+                                       key="browse_page")
+            
+            page_df = browser.page(page - 1, page_size, filters, sort_by, not descending)
+            st.dataframe(page_df, use_container_width=True)
+            if total_rows:
+                first_row = (page - 1) * page_size + 1
+                st.caption(f"แถวที่ {first_row:,}-{first_row + len(page_df) - 1:,} จาก {total_rows:,} แถว")
+            else:
+                st.caption("ไม่พบแถวที่ตรงกับเงื่อนไข")
             
             # Download section
             st.header("⬇️ ดาวน์โหลด")
             
             col1, col2 = st.columns([2, 1])
             
-            with col1:
-                filename = f"merged_file_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-                csv_data = merged_df.to_csv(index=False)
-                
-                st.download_button(
-                    label="📥 ดาวน์โหลดไฟล์ CSV",
-                    data=csv_data,
-                    file_name=filename,
-                    mime="text/csv",
-                    type="primary",
-                    use_container_width=True
+            with col2:
+                export_formats = available_export_formats()
+                export_format = st.selectbox(
+                    "รูปแบบไฟล์:",
+                    export_formats,
+                    format_func=lambda name: EXPORT_FORMATS[name]['label'],
+                    help="Parquet และ Feather เป็นไฟล์แบบคอลัมน์ เล็กและโหลดเร็วกว่า CSV สำหรับงานต่อ"
+                )
+                compressions = EXPORT_FORMATS[export_format]['compressions']
+                compression = st.selectbox(
+                    "การบีบอัด:",
+                    compressions,
+                    format_func=lambda name: name or "ไม่บีบอัด",
+                    disabled=len(compressions) == 1
                 )
             
-            with col2:
-                # File size info
-                file_size = len(csv_data.encode('utf-8')) / 1024
-                st.info(f"ขนาดไฟล์: {file_size:.2f} KB")
+            with col1:
+                spec = EXPORT_FORMATS[export_format]
+                filename = f"merged_file_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{spec['extension']}"
+                export_cache = st.session_state.export_cache
+                if export_cache is None:
+                    export_cache = st.session_state.export_cache = ExportCache(merger, merged_df)
+                
+                if DEFERRED_DOWNLOADS:
+                    # Built once on the first click, reruns never serialise the frame
+                    download_data = lambda: export_cache.read(export_format, compression)
+                elif download_ready(f"{export_format}:{compression}"):
+                    with st.spinner("กำลังเตรียมไฟล์..."):
+                        download_data = export_cache.read(export_format, compression)
+                else:
+                    download_data = None
+                
+                if download_data is not None:
+                    st.download_button(
+                        label=f"📥 ดาวน์โหลดไฟล์ {spec['label']}",
+                        data=download_data,
+                        file_name=filename,
+                        mime=spec['mime'],
+                        type="primary",
+                        use_container_width=True
+                    )
+                
+                # File size info, read from the generated file
+                file_size = export_cache.size(export_format, compression)
+                if file_size is not None:
+                    st.info(f"ขนาดไฟล์: {file_size / 1024:.2f} KB")
+                else:
+                    st.info("ไฟล์จะถูกสร้างเมื่อกดดาวน์โหลด")
             
             # Data distribution chart
-            if '_source_file' in merged_df.columns:
+            if source_counts is not None:
                 st.subheader("📈 การกระจายข้อมูลตามไฟล์ต้นทาง")
                 
-                source_counts = merged_df['_source_file'].value_counts()
-                
                 fig = px.pie(
                     values=source_counts.values,
                     names=source_counts.index,
@@ -841,5 +4285,340 @@ def main():
             - ดาวน์โหลดผลลัพธ์
             """)
 
+class PathUpload:
+    """A file on disk with the attributes FileMerger reads from a Streamlit upload
+    
+    process_uploaded_files reads it through path, so its bytes are not
+    kept in memory during the merge.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.name = path
+        self.size = os.path.getsize(path)
+    
+    def getvalue(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+def expand_input_globs(patterns: List[str]) -> List[str]:
+    """Files matching the input globs, sorted and without duplicates"""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        paths.extend(path for path in matches if os.path.isfile(path) and path not in paths)
+    return paths
+
+def load_mapping_file(path: str) -> Dict:
+    """Read header_mapping/excluded_headers from a JSON or YAML file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            if not is_module_available('yaml'):
+                raise ValueError("YAML mapping files need PyYAML: pip install pyyaml")
+            import yaml
+            config = yaml.safe_load(f) or {}
+        else:
+            config = json.load(f)
+    if not isinstance(config, dict) or set(config) - {'header_mapping', 'excluded_headers'}:
+        raise ValueError(f"{path}: expected only 'header_mapping' and 'excluded_headers' keys")
+    return config
+
+def resolve_file_settings(settings: Dict, filename: str, merge):
+    """Combine the entries whose key is the file's path, base name or a matching glob"""
+    resolved = None
+    for key, value in settings.items():
+        if key in (filename, os.path.basename(filename)) or fnmatch.fnmatch(filename, key) \
+                or fnmatch.fnmatch(os.path.basename(filename), key):
+            resolved = value if resolved is None else merge(resolved, value)
+    return resolved
+
+def select_cli_sheets(processed_data: Dict, sheet: Optional[str], report: Callable) -> Tuple[Dict, Dict]:
+    """Selected sheet per workbook from a sheet name or 0-based index, skipping workbooks without it"""
+    selected_sheets = {}
+    selected_files = {}
+    for filename, file_info in processed_data.items():
+        sheets = file_info['sheets']
+        if sheet is None or file_info['type'] == 'csv':
+            choice = sheets[0]
+        elif sheet in sheets:
+            choice = sheet
+        elif sheet.isdigit() and int(sheet) < len(sheets):
+            choice = sheets[int(sheet)]
+        else:
+            report(f"Skipping {filename}: no sheet {sheet!r}")
+            selected_files[filename] = False
+            continue
+        selected_sheets[filename] = choice
+        selected_files[filename] = True
+    return selected_sheets, selected_files
+
+def build_cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='file-merger',
+        description="Merge CSV and Excel files without the web UI, streaming the result to disk"
+    )
+    parser.add_argument('inputs', nargs='+', help="input files or globs, e.g. 'exports/**/*.xlsx'")
+    parser.add_argument('-o', '--output', required=True, help="output file")
+    parser.add_argument('-f', '--format', choices=list(EXPORT_FORMATS),
+                        help="output format, defaults to the output file extension")
+    parser.add_argument('--compression', help="Parquet/Feather compression codec")
+    parser.add_argument('--partitioned', action='store_true',
+                        help="write a Parquet directory with one file per input; running again only "
+                             "writes new or changed inputs and removes those no longer given")
+    parser.add_argument('-s', '--sheet', help="sheet name or 0-based index, defaults to the first sheet")
+    parser.add_argument('-m', '--mapping',
+                        help="JSON/YAML file with header_mapping and excluded_headers, keyed by file name or glob")
+    parser.add_argument('-p', '--profile',
+                        help="mapping profile saved from the app, applied to files with a known header layout")
+    parser.add_argument('--auto-match', action='store_true',
+                        help="map headers only one file has onto the most similar header of an earlier file")
+    parser.add_argument('--dedupe', action='store_true', help="drop rows already seen in an earlier row or file")
+    parser.add_argument('--dedupe-keys', help="comma-separated columns that identify a duplicate, implies --dedupe")
+    parser.add_argument('--where', nargs=3, action='append', metavar=('COLUMN', 'OP', 'VALUE'),
+                        help=f"keep rows matching a condition while reading, OP one of {' '.join(QUERY_OPERATORS)}; "
+                             "repeat for several, 'in' and 'between' values are comma-separated")
+    parser.add_argument('--select', help="comma-separated columns to keep")
+    parser.add_argument('--group-by', help="comma-separated columns to aggregate by")
+    parser.add_argument('--agg', help="comma-separated aggregates such as count,sum(Amount),max(Date)")
+    parser.add_argument('--join', metavar='KEYS',
+                        help="comma-separated key columns: join the files on them instead of stacking rows")
+    parser.add_argument('--how', default='left', choices=JOIN_TYPES, help="join type, with --join")
+    parser.add_argument('--join-strategy', default='auto', choices=JOIN_STRATEGIES, help="join algorithm, with --join")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="worker processes for parsing")
+    parser.add_argument('--engine', default=DEFAULT_READER_ENGINE, choices=['auto'] + list(READER_ENGINES),
+                        help="reader engine")
+    parser.add_argument('--chunksize', type=int, default=100_000, help="rows per streamed chunk")
+    parser.add_argument('-q', '--quiet', action='store_true', help="only report errors")
+    return parser
+
+def cli(argv: Optional[List[str]] = None) -> int:
+    """Console entry point: merge files matching the input globs into one output file"""
+    args = build_cli_parser().parse_args(argv)
+    
+    def report(message: str):
+        print(message, file=sys.stderr)
+    
+    errors = []
+    
+    def report_error(message: str):
+        errors.append(message)
+        report(message)
+    
+    paths = expand_input_globs(args.inputs)
+    if not paths:
+        report("No input files matched")
+        return 2
+    
+    fmt = args.format
+    if args.partitioned:
+        if fmt not in (None, 'parquet') or not is_module_available('pyarrow'):
+            report("--partitioned writes Parquet and needs pyarrow")
+            return 2
+        fmt = 'parquet'
+    if fmt is None:
+        extension = os.path.splitext(args.output)[1].lstrip('.').lower()
+        fmt = next((name for name, spec in EXPORT_FORMATS.items() if spec['extension'] == extension), 'csv')
+    if args.compression and args.compression not in EXPORT_FORMATS[fmt]['compressions']:
+        report(f"{EXPORT_FORMATS[fmt]['label']} does not support compression {args.compression!r}")
+        return 2
+    
+    config = load_mapping_file(args.mapping) if args.mapping else {}
+    merger = FileMerger(reader_engine=args.engine, max_workers=max(args.workers, 1), error_handler=report_error)
+    processed_data = merger.process_uploaded_files([PathUpload(path) for path in paths])
+    selected_sheets, selected_files = select_cli_sheets(processed_data, args.sheet, report)
+    if not any(selected_files.values()):
+        report("No readable input files")
+        return 1
+    
+    header_mapping = {}
+    excluded_headers = {}
+    for filename in processed_data:
+        mapping = resolve_file_settings(config.get('header_mapping') or {}, filename, lambda a, b: {**a, **b})
+        excluded = resolve_file_settings(config.get('excluded_headers') or {}, filename, lambda a, b: a + b)
+        if mapping:
+            header_mapping[filename] = mapping
+        if excluded:
+            excluded_headers[filename] = excluded
+    
+    if args.profile:
+        # Layouts known to the profile use its mapping instead of the mapping file
+        with open(args.profile, 'r', encoding='utf-8') as f:
+            profile = MappingProfile.from_json(f.read())
+        file_headers = merger.get_file_headers(processed_data, selected_sheets, selected_files)
+        profile_mapping, profile_excluded = profile.resolve(file_headers)
+        unmatched = set(profile.unmatched(file_headers))
+        for filename in file_headers:
+            if filename in unmatched:
+                report(f"{filename}: header layout not in profile {profile.name!r}")
+                continue
+            header_mapping.pop(filename, None)
+            excluded_headers.pop(filename, None)
+        header_mapping.update(profile_mapping)
+        excluded_headers.update(profile_excluded)
+    
+    if args.auto_match:
+        suggestions = merger.suggest_header_matches(processed_data, selected_sheets, selected_files)
+        for filename, matches in suggestions.items():
+            for header, (target, score) in matches.items():
+                if header in header_mapping.get(filename, {}) or header in excluded_headers.get(filename, []):
+                    continue
+                header_mapping.setdefault(filename, {})[header] = target
+                if not args.quiet:
+                    report(f"{filename}: {header} -> {target} ({score:.0%})")
+    
+    join_keys = [key.strip() for key in (args.join or '').split(',') if key.strip()]
+    if args.join is not None and not join_keys:
+        report("--join needs at least one key column")
+        return 2
+    if join_keys and (args.dedupe or args.dedupe_keys):
+        report("--join cannot be combined with --dedupe")
+        return 2
+    
+    def split_names(value: Optional[str]) -> List[str]:
+        return [name.strip() for name in (value or '').split(',') if name.strip()]
+    
+    query = None
+    if args.where or args.select or args.group_by or args.agg:
+        if join_keys:
+            report("--join cannot be combined with --where/--select/--group-by/--agg")
+            return 2
+        try:
+            aggregates = [
+                tuple(name[:-1].split('(', 1)) if name.endswith(')') else (name, None)
+                for name in split_names(args.agg)
+            ]
+            query = MergeQuery([MergeQuery.parse_condition(*condition) for condition in args.where or []],
+                               split_names(args.select), split_names(args.group_by), aggregates)
+            query.validate(merger.compile_column_plan(processed_data, selected_sheets, selected_files,
+                                                      header_mapping, excluded_headers).columns)
+        except ValueError as e:
+            report(str(e))
+            return 2
+    
+    deduplicator = None
+    if args.dedupe or args.dedupe_keys:
+        keys = [key.strip() for key in (args.dedupe_keys or '').split(',') if key.strip()]
+        columns = merger.compile_column_plan(processed_data, selected_sheets, selected_files,
+                                             header_mapping, excluded_headers).columns
+        missing = [key for key in keys if key not in columns]
+        if missing:
+            report(f"Dedupe keys not in the merged columns: {', '.join(missing)}")
+            return 2
+        deduplicator = RowDeduplicator(keys)
+    
+    def show_progress(update: Dict):
+        if update['file'] and update['rows_per_second']:
+            report(f"{update['files_done']}/{update['files_total']} files, {update['rows']:,} rows, "
+                   f"{update['rows_per_second']:,.0f} rows/s")
+    
+    # Written next to the output and renamed at the end, so readers never see a partial file
+    if args.partitioned:
+        if join_keys or query is not None or deduplicator is not None:
+            report("--partitioned cannot be combined with --join, --dedupe or a query")
+            return 2
+        try:
+            dataset = ParquetPartitions(args.output)
+        except ValueError as e:
+            report(str(e))
+            return 2
+        summary = dataset.sync(merger, processed_data, selected_sheets, selected_files, header_mapping,
+                               excluded_headers, args.compression or 'snappy', chunksize=args.chunksize,
+                               progress_callback=None if args.quiet else show_progress)
+        if not args.quiet:
+            for action in ('added', 'removed', 'rewritten'):
+                if summary[action]:
+                    report(f"{action.capitalize()}: {', '.join(summary[action])}")
+            report(f"Dataset has {len(dataset.partitions)} files, {summary['rows']:,} rows, "
+                   f"{len(summary['columns'])} columns -> {args.output}")
+        return 1 if errors else 0
+    
+    partial = f"{args.output}.partial"
+    if query is not None and query.aggregates:
+        # Aggregates are small, so they are computed in memory and exported afterwards
+        result = merger.query_files(processed_data, selected_sheets, selected_files, query,
+                                    header_mapping, excluded_headers, chunksize=args.chunksize,
+                                    progress_callback=None if args.quiet else show_progress,
+                                    deduplicator=deduplicator)
+        try:
+            merger.export(result, partial, fmt, args.compression, chunksize=args.chunksize)
+            os.replace(partial, args.output)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        finally:
+            if deduplicator is not None:
+                deduplicator.close()
+        if not args.quiet:
+            scanned = sum(entry['rows'] for entry in result.attrs['query_report'].values())
+            matched = sum(entry['matched'] for entry in result.attrs['query_report'].values())
+            report(f"Aggregated {matched:,} of {scanned:,} rows into {len(result):,} groups -> {args.output}")
+        return 1 if errors else 0
+    
+    if join_keys:
+        # A join needs every file at once, so it runs in memory and is exported afterwards
+        try:
+            joined = merger.join_files(
+                processed_data, selected_sheets, selected_files, join_keys, args.how,
+                header_mapping, excluded_headers, strategy=args.join_strategy,
+                progress_callback=None if args.quiet else show_progress
+            )
+        except ValueError as e:
+            report(str(e))
+            return 2
+        try:
+            merger.export(joined, partial, fmt, args.compression, chunksize=args.chunksize)
+            os.replace(partial, args.output)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        if not args.quiet:
+            report_join = joined.attrs['join_report']
+            for entry in report_join[1:]:
+                report(f"{entry['file']}: {entry['matched']:,}/{entry['rows']:,} rows matched, "
+                       f"covers {entry['base_matched']:,}/{entry['base_rows']:,} rows of {report_join[0]['file']} "
+                       f"({entry['strategy']})")
+            report(f"Joined {len(report_join)} files on {', '.join(join_keys)}, {len(joined):,} rows, "
+                   f"{joined.shape[1]} columns -> {args.output}")
+        return 1 if errors else 0
+    
+    try:
+        summary = merger.merge_files_to_file(
+            processed_data, selected_sheets, selected_files, partial, fmt, args.compression,
+            header_mapping, excluded_headers, chunksize=args.chunksize,
+            progress_callback=None if args.quiet else show_progress, deduplicator=deduplicator, query=query
+        )
+        os.replace(partial, args.output)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        if deduplicator is not None:
+            deduplicator.close()
+    
+    if not args.quiet:
+        for column, info in summary['widened'].items():
+            sources = ', '.join(sorted(set(info['sources'].values())))
+            report(f"Column {column!r}: {sources} unified to {info['dtype']}")
+    if deduplicator is not None and not args.quiet:
+        report(f"Dropped {deduplicator.rows_dropped:,} duplicate rows")
+        for first, duplicate, rows in deduplicator.summary().itertuples(index=False):
+            report(f"  {duplicate} repeats {first}: {rows:,} rows")
+    if query is not None and not args.quiet:
+        report(f"Kept {summary['rows']:,} of {sum(summary['rows_scanned'].values()):,} rows matching the query")
+    if not args.quiet:
+        report(f"Merged {len(summary['rows_per_file'])} files, {summary['rows']:,} rows, "
+               f"{len(summary['columns'])} columns -> {args.output}")
+    return 1 if errors else 0
+
 if __name__ == "__main__":
-    main()
+    # Streamlit re-executes this script on every rerun. Running main() from the
+    # imported module keeps class identities and module state stable across
+    # reruns, so objects kept in session_state and the ingest cache stay valid.
+    # Outside a Streamlit session, `python app.py ...` runs the command line.
+    if runtime.exists():
+        _importable(main)()
+    else:
+        sys.exit(cli())
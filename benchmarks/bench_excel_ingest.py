@@ -0,0 +1,77 @@
+"""Benchmark: Excel load time versus sheet count
+
+Compares the old ingest path, which re-read the raw upload once per sheet,
+with LazySheetStore, which parses every sheet from one open workbook handle.
+
+Usage:
+    python benchmarks/bench_excel_ingest.py [--sheets 30] [--rows 2000]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import LazySheetStore
+
+
+def build_workbook(n_sheets: int, n_rows: int) -> bytes:
+    """Create an .xlsx with n_sheets identical sheets of n_rows rows"""
+    df = pd.DataFrame({
+        'ID': range(n_rows),
+        'Branch': [f'BR{i % 40:03d}' for i in range(n_rows)],
+        'Amount': [i * 1.5 for i in range(n_rows)],
+        'Note': ['monthly export'] * n_rows,
+    })
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        for i in range(n_sheets):
+            df.to_excel(writer, sheet_name=f'Sheet{i + 1}', index=False)
+    return buffer.getvalue()
+
+
+def load_per_sheet(content: bytes, sheets):
+    """Old behaviour: one pd.read_excel call on the raw upload per sheet"""
+    buffer = io.BytesIO(content)
+    return {sheet: pd.read_excel(buffer, sheet_name=sheet) for sheet in sheets}
+
+
+def load_single_handle(content: bytes, sheets):
+    """New behaviour: every sheet parsed from one pd.ExcelFile"""
+    workbook = pd.ExcelFile(io.BytesIO(content))
+    store = LazySheetStore(content, 'excel', workbook.sheet_names, workbook=workbook)
+    return store.load_sheets(sheets)
+
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sheets', type=int, default=30, help='sheets in the workbook')
+    parser.add_argument('--rows', type=int, default=2000, help='rows per sheet')
+    args = parser.parse_args()
+
+    content = build_workbook(args.sheets, args.rows)
+    sheet_names = [f'Sheet{i + 1}' for i in range(args.sheets)]
+    print(f"workbook: {args.sheets} sheets x {args.rows} rows, {len(content) / 1024:.0f} KB")
+    print(f"{'sheets loaded':>13} | {'per-sheet re-read (s)':>21} | {'single handle (s)':>17} | speedup")
+
+    for count in sorted({1, 5, 10, 20, args.sheets}):
+        if count > args.sheets:
+            continue
+        wanted = sheet_names[:count]
+        before = timed(load_per_sheet, content, wanted)
+        after = timed(load_single_handle, content, wanted)
+        print(f"{count:>13} | {before:>21.3f} | {after:>17.3f} | {before / after:6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Micro-benchmark: header match status lookups on wide files
+
+main() asks for the match status of every header of every file several
+times per rerun. This compares the old per-call scan of the other files'
+header lists with the inverted index built by analyze_headers.
+
+Usage:
+    python benchmarks/bench_headers.py [--files 40] [--columns 200] [--calls-per-header 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import FileMerger
+
+
+def build_file_headers(n_files: int, n_columns: int):
+    """Each file shares most columns and has a few of its own"""
+    shared = [f'col_{i:04d}' for i in range(n_columns - 10)]
+    return {
+        f'branch_{f:02d}.xlsx': shared + [f'extra_{f:02d}_{i}' for i in range(10)]
+        for f in range(n_files)
+    }
+
+
+def legacy_match_status(header, all_file_headers, current_filename):
+    """get_header_match_status before the index"""
+    other_files = [f for f in all_file_headers.keys() if f != current_filename]
+    if not other_files:
+        return "single_file"
+    exists_in_others = any(header in all_file_headers[f] for f in other_files)
+    return "match" if exists_in_others else "no_match"
+
+
+def run(status, file_headers, calls_per_header: int) -> float:
+    start = time.perf_counter()
+    for filename, headers in file_headers.items():
+        for _ in range(calls_per_header):
+            for header in headers:
+                status(header, file_headers, filename)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=40)
+    parser.add_argument('--columns', type=int, default=200)
+    parser.add_argument('--calls-per-header', type=int, default=5,
+                        help='lookups per header per file, as in one rerun of main()')
+    args = parser.parse_args()
+
+    print(f"{'files':>5} | {'columns':>7} | {'lookups':>9} | {'scan (s)':>9} | {'index (s)':>9} | speedup")
+    for n_files, n_columns in sorted({(10, 50), (40, 200), (args.files, args.columns), (100, 300)}):
+        file_headers = build_file_headers(n_files, n_columns)
+        merger = FileMerger()
+
+        build_start = time.perf_counter()
+        merger.build_header_index(file_headers)
+        build_time = time.perf_counter() - build_start
+
+        before = run(legacy_match_status, file_headers, args.calls_per_header)
+        after = run(merger.get_header_match_status, file_headers, args.calls_per_header) + build_time
+        lookups = n_files * n_columns * args.calls_per_header
+        print(f"{n_files:>5} | {n_columns:>7} | {lookups:>9,} | {before:>9.3f} | {after:>9.3f} | {before / after:6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Benchmark: peak RSS and wall time of FileMerger.merge_files
+
+Compares the previous merge path (.copy() per source, in-place rename and
+a string _source_file column) with the copy-free path. Each variant runs
+in its own subprocess so peak RSS is measured independently.
+
+Usage:
+    python benchmarks/bench_merge.py [--files 10] [--rows 1000000]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import FileMerger
+
+
+def build_inputs(n_files: int, n_rows: int):
+    """processed_data with n_files identical-schema frames plus one audit column to drop"""
+    rng = np.random.default_rng(0)
+    processed = {}
+    for i in range(n_files):
+        df = pd.DataFrame({
+            'ID': np.arange(n_rows, dtype='int64'),
+            'Amount': rng.random(n_rows),
+            'Branch': rng.choice([f'BR{b:03d}' for b in range(50)], n_rows).astype(object),
+            'Audit': rng.integers(0, 1000, n_rows),
+        })
+        if i % 2:
+            df = df.rename(columns={'Amount': 'Total'})
+        processed[f'branch_{i:02d}.csv'] = {'sheets': ['Sheet1'], 'data': {'Sheet1': df}}
+    return processed
+
+
+def legacy_merge(processed_data, selected_sheets, selected_files, header_mapping, excluded_headers):
+    """The merge path before the copy-free rework"""
+    merged_dfs = []
+    for filename, file_info in processed_data.items():
+        if selected_files.get(filename, True):
+            sheet_name = selected_sheets.get(filename, file_info['sheets'][0])
+            if sheet_name in file_info['data']:
+                df = file_info['data'][sheet_name].copy()
+                if excluded_headers and filename in excluded_headers:
+                    columns_to_keep = [col for col in df.columns if col not in excluded_headers[filename]]
+                    df = df[columns_to_keep]
+                if header_mapping and filename in header_mapping:
+                    df.rename(columns=header_mapping[filename], inplace=True)
+                df['_source_file'] = filename
+                merged_dfs.append(df)
+    if merged_dfs:
+        return pd.concat(merged_dfs, ignore_index=True, sort=False)
+    return pd.DataFrame()
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_variant(variant: str, n_files: int, n_rows: int) -> dict:
+    processed = build_inputs(n_files, n_rows)
+    selected_sheets = {name: 'Sheet1' for name in processed}
+    selected_files = {name: True for name in processed}
+    header_mapping = {name: {'Total': 'Amount'} for i, name in enumerate(processed) if i % 2}
+    excluded_headers = {name: ['Audit'] for name in processed}
+    inputs_rss = peak_rss_mb()
+
+    merge = legacy_merge if variant == 'legacy' else FileMerger().merge_files
+    start = time.perf_counter()
+    merged = merge(processed, selected_sheets, selected_files, header_mapping, excluded_headers)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'variant': variant,
+        'seconds': elapsed,
+        'peak_rss_mb': peak_rss_mb(),
+        'merge_rss_mb': peak_rss_mb() - inputs_rss,
+        'result_mb': merged.memory_usage(deep=True).sum() / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=10, help='number of input frames')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='rows per input frame')
+    parser.add_argument('--variant', choices=['legacy', 'copy-free'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        print(json.dumps(run_variant(args.variant, args.files, args.rows)))
+        return
+
+    print(f"inputs: {args.files} x {args.rows:,} rows")
+    print(f"{'variant':>10} | {'wall (s)':>8} | {'peak RSS (MB)':>13} | {'merge RSS (MB)':>14} | {'result (MB)':>11}")
+    for variant in ('legacy', 'copy-free'):
+        output = subprocess.run(
+            [sys.executable, __file__, '--files', str(args.files), '--rows', str(args.rows), '--variant', variant],
+            check=True, capture_output=True, text=True
+        ).stdout
+        stats = json.loads(output.strip().splitlines()[-1])
+        print(f"{variant:>10} | {stats['seconds']:>8.2f} | {stats['peak_rss_mb']:>13.0f} | "
+              f"{stats['merge_rss_mb']:>14.0f} | {stats['result_mb']:>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,7 @@ setup(
     long_description_content_type="text/markdown",
     url="https://github.com/yourusername/file-merger-spa",
     packages=find_packages(),
+    py_modules=["app"],
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: End Users/Desktop",
@@ -42,11 +43,18 @@ setup(
         "test": [
             "pytest>=7.0.0",
             "pytest-cov>=4.0.0",
+        ],
+        "fast": [
+            "pyarrow>=10.0.0",
+            "python-calamine>=0.1.7",
+        ],
+        "yaml": [
+            "PyYAML>=6.0",
         ]
     },
     entry_points={
         "console_scripts": [
-            "file-merger=app:main",
+            "file-merger=app:cli",
         ],
     },
     include_package_data=True,
@@ -1,13 +1,37 @@
 import unittest
 import pandas as pd
+import numpy as np
 import io
 import sys
 import os
+import tempfile
+import threading
+from unittest import mock
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app import FileMerger
+import app
+from app import (ColumnPlan, ExportCache, FileMerger, HashRuns, HeaderMatcher, IngestCache, LazySheetStore,
+                 MappingProfile, MergeCancelled, MergeQuery, ParquetPartitions, ProgressReporter, ResultBrowser, RowDeduplicator, StageCache,
+                 build_mapping_table, condition_mask, dtype_kind, join_indexers, freeze_key, header_signature, header_tokens, read_mapping_table,
+                 resolve_reader_engines)
+
+class FakeUpload(io.BytesIO):
+    """Minimal stand-in for Streamlit's UploadedFile"""
+    
+    def __init__(self, name, content):
+        super().__init__(content)
+        self.name = name
+        self.size = len(content)
+
+def make_workbook(sheets):
+    """Build an in-memory .xlsx from a dict of sheet name -> DataFrame"""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    return buffer.getvalue()
 
 class TestFileMerger(unittest.TestCase):
     
@@ -83,6 +107,22 @@ class TestFileMerger(unittest.TestCase):
         self.assertTrue(has_mismatch)
         self.assertEqual(set(headers), {'Name', 'Age', 'City', 'Country'})
     
+    def test_header_match_status_from_index(self):
+        """Match status is served from the index built by analyze_headers"""
+        processed_data = {
+            'file1.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': self.df1}},
+            'file2.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': self.df2}}
+        }
+        _, _, file_headers = self.merger.analyze_headers(processed_data, {}, {})
+        
+        self.assertEqual(self.merger.header_index['Name'], {'file1.csv', 'file2.csv'})
+        self.assertEqual(self.merger.get_header_match_status('Name', file_headers, 'file1.csv'), 'match')
+        self.assertEqual(self.merger.get_header_match_status('City', file_headers, 'file1.csv'), 'no_match')
+        self.assertEqual(self.merger.get_header_match_status('City', file_headers, 'file2.csv'), 'match')
+        self.assertEqual(
+            self.merger.get_header_match_status('City', {'file1.csv': ['City']}, 'file1.csv'), 'single_file'
+        )
+    
     def test_merge_files_simple(self):
         """Test simple file merging"""
         processed_data = {
@@ -132,6 +172,35 @@ class TestFileMerger(unittest.TestCase):
         self.assertIn('City', merged_df.columns)
         self.assertNotIn('Country', merged_df.columns)
     
+    def test_merge_files_source_column_categorical(self):
+        """_source_file is stored as a categorical of the file names"""
+        processed_data = {
+            'file1.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': self.df1}},
+            'file2.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': self.df2}}
+        }
+        
+        merged_df = self.merger.merge_files(
+            processed_data, {}, {}, {'file2.csv': {'Country': 'City'}}, {'file1.csv': ['Age']}
+        )
+        
+        self.assertIsInstance(merged_df['_source_file'].dtype, pd.CategoricalDtype)
+        self.assertEqual(list(merged_df['_source_file']), ['file1.csv'] * 2 + ['file2.csv'] * 2)
+        self.assertEqual(list(merged_df.columns), ['Name', 'City', 'Age', '_source_file'])
+        self.assertEqual(merged_df['City'].tolist(), ['Bangkok', 'Chiang Mai', 'Thailand', 'Thailand'])
+    
+    def test_merge_files_leaves_sources_untouched(self):
+        """Renaming and dropping columns does not modify the source frames"""
+        processed_data = {
+            'file1.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': self.df1}},
+            'file2.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': self.df2}}
+        }
+        
+        self.merger.merge_files(processed_data, {}, {}, {'file2.csv': {'Country': 'City'}}, {'file1.csv': ['Age']})
+        
+        self.assertEqual(list(self.df1.columns), ['Name', 'Age', 'City'])
+        self.assertEqual(list(self.df2.columns), ['Name', 'Age', 'Country'])
+        self.assertNotIn('_source_file', self.df1.columns)
+    
     def test_convert_to_csv(self):
         """Test CSV conversion"""
         df = pd.DataFrame({
@@ -238,6 +307,1498 @@ class TestDataValidation(unittest.TestCase):
         self.assertIn('Name', headers)
         self.assertIn('Name.1', headers)
 
+class TestLazySheetStore(unittest.TestCase):
+    """Test lazy per-sheet loading of uploads"""
+    
+    def setUp(self):
+        self.merger = FileMerger()
+        self.sheets = {
+            f'Sheet{i}': pd.DataFrame({'ID': range(20), 'Value': [i] * 20})
+            for i in range(1, 4)
+        }
+        self.upload = FakeUpload('book.xlsx', make_workbook(self.sheets))
+    
+    def test_upload_reads_only_sheet_names(self):
+        """No sheet should be fully parsed at upload time"""
+        processed = self.merger.process_uploaded_files([self.upload])
+        store = processed['book.xlsx']['data']
+        
+        self.assertIsInstance(store, LazySheetStore)
+        self.assertEqual(processed['book.xlsx']['sheets'], ['Sheet1', 'Sheet2', 'Sheet3'])
+        self.assertIn('Sheet2', store)
+        self.assertFalse(any(store.is_loaded(s) for s in store.sheet_names))
+    
+    def test_preview_does_not_load_sheet(self):
+        """Previews are limited to a few rows and do not load the sheet"""
+        processed = self.merger.process_uploaded_files([self.upload])
+        store = processed['book.xlsx']['data']
+        
+        preview = store.preview('Sheet2')
+        self.assertEqual(len(preview), store.preview_rows)
+        self.assertFalse(store.is_loaded('Sheet2'))
+    
+    def test_sheet_loaded_on_access(self):
+        """Only the accessed sheet gets parsed"""
+        processed = self.merger.process_uploaded_files([self.upload])
+        store = processed['book.xlsx']['data']
+        
+        df = store['Sheet3']
+        self.assertEqual(len(df), 20)
+        self.assertTrue((df['Value'] == 3).all())
+        self.assertTrue(store.is_loaded('Sheet3'))
+        self.assertFalse(store.is_loaded('Sheet1'))
+    
+    def test_load_sheets_reuses_workbook_handle(self):
+        """Every sheet is parsed from the workbook opened at upload"""
+        processed = self.merger.process_uploaded_files([self.upload])
+        store = processed['book.xlsx']['data']
+        workbook = store.workbook
+        
+        loaded = store.load_sheets(['Sheet1', 'Sheet3'])
+        
+        self.assertIs(store.workbook, workbook)
+        self.assertEqual(list(loaded), ['Sheet1', 'Sheet3'])
+        self.assertTrue((loaded['Sheet1']['Value'] == 1).all())
+    
+    def test_merge_loads_selected_sheet_only(self):
+        """Merging pulls in just the selected sheets"""
+        csv_upload = FakeUpload('data.csv', b"ID,Value\n100,9\n101,9")
+        processed = self.merger.process_uploaded_files([self.upload, csv_upload])
+        
+        merged_df = self.merger.merge_files(
+            processed,
+            {'book.xlsx': 'Sheet2', 'data.csv': 'Sheet1'},
+            {'book.xlsx': True, 'data.csv': True}
+        )
+        
+        self.assertEqual(len(merged_df), 22)
+        store = processed['book.xlsx']['data']
+        self.assertTrue(store.is_loaded('Sheet2'))
+        self.assertFalse(store.is_loaded('Sheet1'))
+
+class TestReaderEngines(unittest.TestCase):
+    """Test reader engine selection and fallback"""
+    
+    def test_explicit_pandas_engine(self):
+        """The pandas engine keeps the default parsers"""
+        self.assertEqual(resolve_reader_engines('pandas'), {'csv': 'c', 'excel': None})
+    
+    def test_missing_backend_falls_back(self):
+        """Engines whose backend is not installed fall back to pandas"""
+        with mock.patch.object(app, 'is_module_available', return_value=False):
+            self.assertEqual(resolve_reader_engines('auto'), {'csv': 'c', 'excel': None})
+            self.assertEqual(resolve_reader_engines('calamine'), {'csv': 'c', 'excel': None})
+    
+    def test_unknown_engine_falls_back(self):
+        """Unknown names resolve to the pandas defaults"""
+        self.assertEqual(resolve_reader_engines('nope'), {'csv': 'c', 'excel': None})
+    
+    @unittest.skipUnless(app.is_module_available('pyarrow'), "pyarrow not installed")
+    def test_pyarrow_csv_engine_matches_default(self):
+        """The pyarrow CSV engine produces the same frame as the C parser"""
+        content = b"Name,Age\nJohn,25\nJane,30\n"
+        upload = FakeUpload('people.csv', content)
+        
+        fast = FileMerger(reader_engine='pyarrow').process_uploaded_files([upload])
+        default = FileMerger(reader_engine='pandas').process_uploaded_files([upload])
+        
+        self.assertEqual(fast['people.csv']['data'].engines['csv'], 'pyarrow')
+        pd.testing.assert_frame_equal(
+            fast['people.csv']['data']['Sheet1'],
+            default['people.csv']['data']['Sheet1']
+        )
+
+class TestParallelIngest(unittest.TestCase):
+    """Test process-pool ingestion of several uploads"""
+    
+    def setUp(self):
+        self.merger = FileMerger(reader_engine='pandas')
+        self.uploads = [
+            FakeUpload(f'branch{i}.csv', f"ID,Branch\n{i},B{i}\n{i + 10},B{i}\n".encode())
+            for i in range(4)
+        ]
+        self.uploads.insert(2, FakeUpload('book.xlsx', make_workbook({
+            'Jan': pd.DataFrame({'ID': [1], 'Branch': ['X']}),
+            'Feb': pd.DataFrame({'ID': [2, 3], 'Branch': ['Y', 'Z']}),
+        })))
+    
+    def test_parallel_matches_serial_in_upload_order(self):
+        """Parallel ingest keeps upload order and the same sheets"""
+        serial = self.merger.process_uploaded_files(self.uploads, max_workers=1)
+        parallel = self.merger.process_uploaded_files(self.uploads, max_workers=2)
+        
+        self.assertEqual(list(parallel), [f.name for f in self.uploads])
+        for filename in serial:
+            self.assertEqual(parallel[filename]['sheets'], serial[filename]['sheets'])
+    
+    def test_parallel_load_sheets(self):
+        """Selected sheets are parsed by the pool and stored in place"""
+        processed = self.merger.process_uploaded_files(self.uploads, max_workers=2)
+        selected_sheets = {'book.xlsx': 'Feb'}
+        selected_files = {f.name: True for f in self.uploads}
+        
+        self.merger.load_sheets(processed, selected_sheets, selected_files, max_workers=2)
+        
+        store = processed['book.xlsx']['data']
+        self.assertTrue(store.is_loaded('Feb'))
+        self.assertFalse(store.is_loaded('Jan'))
+        self.assertEqual(len(store['Feb']), 2)
+        self.assertTrue(processed['branch0.csv']['data'].is_loaded('Sheet1'))
+    
+    def test_errors_reported_per_file(self):
+        """A broken upload is reported and skipped without affecting the others"""
+        uploads = self.uploads + [FakeUpload('broken.xlsx', b'not a workbook')]
+        
+        with mock.patch.object(app.st, 'error') as error:
+            processed = self.merger.process_uploaded_files(uploads, max_workers=2)
+        
+        self.assertNotIn('broken.xlsx', processed)
+        self.assertEqual(list(processed), [f.name for f in self.uploads])
+        error.assert_called_once()
+        self.assertIn('broken.xlsx', error.call_args[0][0])
+
+class TestIngestCache(unittest.TestCase):
+    """Test the content-hash ingest cache"""
+    
+    def setUp(self):
+        self.merger = FileMerger(reader_engine='pandas')
+        self.now = [0.0]
+        self.cache = IngestCache(max_entries=2, ttl=60, clock=lambda: self.now[0])
+    
+    def test_same_content_parsed_once(self):
+        """Re-uploading identical content reuses the earlier parse"""
+        content = b"ID,Value\n1,a\n2,b\n"
+        first = self.merger.process_uploaded_files([FakeUpload('jan.csv', content)], cache=self.cache)
+        
+        with mock.patch.object(app, 'open_sheet_store') as open_store:
+            second = self.merger.process_uploaded_files(
+                [FakeUpload('jan copy.csv', content)], cache=self.cache
+            )
+        
+        open_store.assert_not_called()
+        self.assertIs(second['jan copy.csv']['data'], first['jan.csv']['data'])
+        self.assertEqual(second['jan copy.csv']['hash'], first['jan.csv']['hash'])
+    
+    def test_changed_content_is_reparsed(self):
+        """A file with the same name but new content is parsed again"""
+        first = self.merger.process_uploaded_files([FakeUpload('jan.csv', b"ID\n1\n")], cache=self.cache)
+        second = self.merger.process_uploaded_files([FakeUpload('jan.csv', b"ID\n2\n")], cache=self.cache)
+        
+        self.assertIsNot(second['jan.csv']['data'], first['jan.csv']['data'])
+        self.assertEqual(second['jan.csv']['data']['Sheet1']['ID'].tolist(), [2])
+    
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted beyond max_entries"""
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+    
+    def test_byte_budget(self):
+        """Stores beyond max_bytes are evicted least recently used first, measured as they grow"""
+        content = ("ID,Name\n" + "".join(f"{i},name{i}\n" for i in range(500))).encode()
+        stores = [app.open_sheet_store(content.replace(b'name', name), 'csv', resolve_reader_engines('pandas'))
+                  for name in (b'a', b'b', b'c')]
+        for store in stores:
+            store['Sheet1']
+        budget = stores[0].memory_usage() * 2 + 1
+        cache = IngestCache(max_bytes=budget)
+        cache.put('a', stores[0])
+        cache.put('b', stores[1])
+        cache.get('a')
+        cache.put('c', stores[2])
+        
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertIs(cache.get('a'), stores[0])
+        
+        # The newest entry is kept even when it alone is over the budget
+        cache.max_bytes = 1
+        cache.put('d', stores[1])
+        self.assertEqual(len(cache), 1)
+        self.assertIs(cache.get('d'), stores[1])
+    
+    def test_ttl_expiry(self):
+        """Entries older than the TTL are dropped"""
+        self.cache.put('a', 1)
+        self.now[0] = 61
+        
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+class TestStreamingMerge(unittest.TestCase):
+    """Test the chunked CSV merge"""
+    
+    def setUp(self):
+        self.merger = FileMerger(reader_engine='pandas')
+        csv_rows = "\n".join(f"{i},Name{i},{i % 7}" for i in range(25))
+        self.processed = self.merger.process_uploaded_files([
+            FakeUpload('a.csv', ("ID,Name,Audit\n" + csv_rows + "\n").encode()),
+            FakeUpload('b.xlsx', make_workbook({
+                'Data': pd.DataFrame({'ID': [100, 101, 102], 'FullName': ['X', 'Y', 'Z'], 'City': ['BKK'] * 3})
+            })),
+        ])
+        self.selected_sheets = {'a.csv': 'Sheet1', 'b.xlsx': 'Data'}
+        self.selected_files = {'a.csv': True, 'b.xlsx': True}
+        self.header_mapping = {'b.xlsx': {'FullName': 'Name'}}
+        self.excluded_headers = {'a.csv': ['Audit']}
+    
+    def test_matches_in_memory_merge(self):
+        """Streaming in small chunks yields the same rows as merge_files"""
+        output = io.StringIO()
+        summary = self.merger.merge_files_to_csv(
+            self.processed, self.selected_sheets, self.selected_files, output,
+            self.header_mapping, self.excluded_headers, chunksize=4
+        )
+        streamed = pd.read_csv(io.StringIO(output.getvalue()))
+        expected = self.merger.merge_files(
+            self.processed, self.selected_sheets, self.selected_files,
+            self.header_mapping, self.excluded_headers
+        )
+        
+        self.assertEqual(summary['rows'], 28)
+        self.assertEqual(summary['rows_per_file'], {'a.csv': 25, 'b.xlsx': 3})
+        self.assertEqual(list(streamed.columns), ['ID', 'Name', 'City', '_source_file'])
+        pd.testing.assert_frame_equal(streamed, pd.read_csv(io.StringIO(expected[streamed.columns].to_csv(index=False))))
+    
+    def test_csv_source_not_loaded(self):
+        """CSV sources are streamed without being stored in full"""
+        self.merger.merge_files_to_csv(
+            self.processed, self.selected_sheets, self.selected_files, io.StringIO(), chunksize=10
+        )
+        
+        self.assertFalse(self.processed['a.csv']['data'].is_loaded('Sheet1'))
+        self.assertFalse(self.processed['b.xlsx']['data'].is_loaded('Data'))
+    
+    def test_writes_to_path(self):
+        """A path output is opened and closed by the merger"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'merged.csv')
+            summary = self.merger.merge_files_to_csv(
+                self.processed, self.selected_sheets, self.selected_files, path
+            )
+            self.assertEqual(len(pd.read_csv(path)), summary['rows'])
+
+class TestDtypeOptimization(unittest.TestCase):
+    """Test the memory optimisation pass"""
+    
+    def setUp(self):
+        self.merger = FileMerger()
+        n = 200
+        self.df = pd.DataFrame({
+            'ID': np.arange(n, dtype='int64'),
+            'Exact': np.full(n, 0.5),
+            'Precise': np.full(n, 0.1),
+            'Branch': pd.Series(['BKK', 'CNX'] * (n // 2), dtype=object),
+            'Ref': pd.Series([f'REF-{i}' for i in range(n)], dtype=object),
+            'Mixed': pd.Series([1, 'a'] * (n // 2), dtype=object),
+        })
+    
+    def test_optimize_dtypes(self):
+        """Numbers are downcast losslessly and repetitive text becomes categorical"""
+        optimized = self.merger.optimize_dtypes(self.df)
+        
+        self.assertEqual(optimized['ID'].dtype, np.int16)
+        self.assertEqual(optimized['Exact'].dtype, np.float32)
+        self.assertEqual(optimized['Precise'].dtype, np.float64)
+        self.assertIsInstance(optimized['Branch'].dtype, pd.CategoricalDtype)
+        self.assertNotIsInstance(optimized['Ref'].dtype, pd.CategoricalDtype)
+        self.assertEqual(optimized['Mixed'].dtype, object)
+        self.assertLess(optimized.memory_usage(deep=True).sum(), self.df.memory_usage(deep=True).sum())
+        for col in self.df.columns:
+            self.assertEqual(optimized[col].astype(object).tolist(), self.df[col].tolist())
+    
+    def test_category_union_survives_merge(self):
+        """Categoricals from different files keep a categorical dtype after merging"""
+        df_a = pd.DataFrame({'Branch': pd.Series(['BKK', 'BKK', 'CNX'], dtype='category')})
+        df_b = pd.DataFrame({'Branch': pd.Series(['HKT', 'HKT', 'BKK'], dtype='category')})
+        processed_data = {
+            'a.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': df_a}},
+            'b.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': df_b}}
+        }
+        
+        merged_df = self.merger.merge_files(processed_data, {}, {})
+        
+        self.assertIsInstance(merged_df['Branch'].dtype, pd.CategoricalDtype)
+        self.assertEqual(set(merged_df['Branch'].cat.categories), {'BKK', 'CNX', 'HKT'})
+        self.assertEqual(merged_df['Branch'].tolist(), ['BKK', 'BKK', 'CNX', 'HKT', 'HKT', 'BKK'])
+        self.assertEqual(list(df_b['Branch'].cat.categories), ['BKK', 'HKT'])
+    
+    def test_optimize_processed_data(self):
+        """Selected sheets are optimised for the session and memory is reported"""
+        processed_data = {'a.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': self.df}}}
+        
+        before, after = self.merger.optimize_processed_data(processed_data, {}, {})
+        
+        self.assertLess(after, before)
+        file_info = processed_data['a.csv']
+        self.assertTrue(self.merger.get_sheet_data(file_info, 'Sheet1').attrs['dtypes_optimized'])
+        self.assertIs(file_info['data']['Sheet1'], self.df)
+        self.assertEqual(self.merger.optimize_processed_data(processed_data, {}, {}), (before, after))
+    
+    def test_optimize_leaves_cached_store_alone(self):
+        """Another session reusing the cached parse still gets the sheet as parsed"""
+        cache = IngestCache()
+        upload = FakeUpload('a.csv', b"Branch,Amount\nBKK,1\nBKK,2\nCNX,3\nBKK,4\n")
+        optimizing = FileMerger(optimize_memory=True)
+        mine = optimizing.process_uploaded_files([upload], cache=cache)
+        optimizing.load_sheets(mine, {}, {})
+        optimizing.optimize_processed_data(mine, {}, {})
+        theirs = FileMerger().process_uploaded_files([upload], cache=cache)
+        
+        self.assertIs(theirs['a.csv']['data'], mine['a.csv']['data'])
+        self.assertFalse(mine['a.csv']['data'].is_loaded('Sheet1'))
+        self.assertIsInstance(optimizing.merge_files(mine, {}, {})['Branch'].dtype, pd.CategoricalDtype)
+        merged = FileMerger().merge_files(theirs, {}, {})
+        self.assertNotIsInstance(merged['Branch'].dtype, pd.CategoricalDtype)
+        self.assertFalse(merged.attrs.get('dtypes_optimized', False))
+
+class TestSchemaProbe(unittest.TestCase):
+    """Test header analysis from schema probes"""
+    
+    def setUp(self):
+        self.merger = FileMerger(reader_engine='pandas')
+        self.processed = self.merger.process_uploaded_files([
+            FakeUpload('a.csv', b"ID,Name,Amount\n1,x,1.5\n2,y,2.5\n"),
+            FakeUpload('b.xlsx', make_workbook({
+                'Summary': pd.DataFrame({'Total': [1]}),
+                'Data': pd.DataFrame({'ID': [7, 8], 'Name': ['p', 'q'], 'Branch': ['BKK', 'CNX']}),
+            })),
+        ])
+        self.selected_sheets = {'a.csv': 'Sheet1', 'b.xlsx': 'Data'}
+        self.selected_files = {'a.csv': True, 'b.xlsx': True}
+    
+    def test_analyze_headers_without_loading(self):
+        """Header analysis reads schemas only"""
+        headers, has_mismatch, file_headers = self.merger.analyze_headers(
+            self.processed, self.selected_sheets, self.selected_files
+        )
+        
+        self.assertTrue(has_mismatch)
+        self.assertEqual(file_headers['b.xlsx'], ['ID', 'Name', 'Branch'])
+        self.assertEqual(set(headers), {'ID', 'Name', 'Amount', 'Branch'})
+        for filename, sheet_name in self.selected_sheets.items():
+            self.assertFalse(self.processed[filename]['data'].is_loaded(sheet_name))
+    
+    def test_excel_probe_reads_first_row(self):
+        """Excel schemas come from the header plus one row"""
+        store = self.processed['b.xlsx']['data']
+        
+        with mock.patch.object(store, '_read', wraps=store._read) as read:
+            schema = store.schema('Data')
+            store.schema('Data')
+        
+        read.assert_called_once_with('Data', nrows=1)
+        self.assertEqual(schema['ID'], np.int64)
+    
+    def test_row_counts_unknown_until_loaded(self):
+        """Row counts are reported once the sheet has been loaded"""
+        file_info = self.processed['a.csv']
+        
+        self.assertIsNone(self.merger.get_sheet_rows(file_info, 'Sheet1'))
+        self.merger.load_sheets(self.processed, self.selected_sheets, self.selected_files)
+        self.assertEqual(self.merger.get_sheet_rows(file_info, 'Sheet1'), 2)
+
+class TestExport(unittest.TestCase):
+    """Test the export writers"""
+    
+    def setUp(self):
+        self.merger = FileMerger()
+        self.df = pd.DataFrame({
+            'ID': [1, 2, 3, 4, 5],
+            'Name': ['a', None, 'c', 'd', 'e'],
+            'Amount': [1.5, 2.0, None, 4.25, 5.0],
+            '_source_file': pd.Categorical(['x.csv', 'x.csv', 'y.csv', 'y.csv', 'y.csv'])
+        })
+    
+    def test_csv_matches_to_csv(self):
+        """Chunked CSV output is identical to DataFrame.to_csv"""
+        buffer = io.BytesIO()
+        self.merger.export(self.df, buffer, 'csv', chunksize=2)
+        
+        self.assertEqual(buffer.getvalue().decode('utf-8'), self.df.to_csv(index=False))
+        self.assertFalse(buffer.closed)
+    
+    @unittest.skipUnless(app.is_module_available('pyarrow'), "pyarrow not installed")
+    def test_parquet_round_trip(self):
+        """Parquet is written in row groups and reads back unchanged"""
+        import pyarrow.parquet as pq
+        buffer = io.BytesIO()
+        self.merger.export(self.df, buffer, 'parquet', 'zstd', chunksize=2)
+        
+        buffer.seek(0)
+        self.assertEqual(pq.ParquetFile(buffer).num_row_groups, 3)
+        buffer.seek(0)
+        pd.testing.assert_frame_equal(pd.read_parquet(buffer), self.df, check_dtype=False)
+    
+    @unittest.skipUnless(app.is_module_available('pyarrow'), "pyarrow not installed")
+    def test_feather_round_trip(self):
+        """Feather output reads back unchanged"""
+        buffer = io.BytesIO()
+        self.merger.export(self.df, buffer, 'feather', 'lz4', chunksize=2)
+        
+        buffer.seek(0)
+        pd.testing.assert_frame_equal(pd.read_feather(buffer), self.df, check_dtype=False)
+    
+    def test_xlsx_spills_to_new_sheets(self):
+        """Rows beyond the sheet limit continue on a new sheet"""
+        buffer = io.BytesIO()
+        with mock.patch.object(app, 'XLSX_MAX_ROWS', 3):
+            self.merger.export(self.df, buffer, 'xlsx', chunksize=2)
+        
+        sheets = pd.read_excel(io.BytesIO(buffer.getvalue()), sheet_name=None)
+        self.assertEqual(list(sheets), ['Merged_1', 'Merged_2'])
+        combined = pd.concat(sheets.values(), ignore_index=True)
+        self.assertEqual(combined['ID'].tolist(), [1, 2, 3, 4, 5])
+        self.assertTrue(pd.isna(combined.loc[1, 'Name']))
+    
+    def test_unknown_format(self):
+        """Unknown formats are rejected"""
+        with self.assertRaises(ValueError):
+            self.merger.export(self.df, io.BytesIO(), 'json')
+    
+    def test_spooled_export_rolls_to_disk(self):
+        """Exports beyond max_memory move to a temp file and read back from the start"""
+        spooled = self.merger.export_to_spooled(self.df, 'csv', max_memory=16)
+        try:
+            self.assertTrue(spooled._rolled)
+            self.assertEqual(spooled.read().decode('utf-8'), self.df.to_csv(index=False))
+        finally:
+            spooled.close()
+    
+    def test_export_cache_generates_once(self):
+        """Each format is exported once per merge result"""
+        cache = ExportCache(self.merger, self.df)
+        self.assertIsNone(cache.size('csv'))
+        with mock.patch.object(self.merger, 'export', wraps=self.merger.export) as export:
+            first = cache.read('csv')
+            second = cache.read('csv')
+        
+        self.assertEqual(export.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(cache.size('csv'), len(first))
+        cache.close()
+        self.assertIsNone(cache.size('csv'))
+
+class TestProgress(unittest.TestCase):
+    """Test progress reporting and cancellation"""
+    
+    def setUp(self):
+        self.merger = FileMerger(reader_engine='pandas')
+        csv_rows = "\n".join(f"{i},Name{i}" for i in range(25))
+        self.processed = self.merger.process_uploaded_files([
+            FakeUpload('a.csv', ("ID,Name\n" + csv_rows + "\n").encode()),
+            FakeUpload('b.xlsx', make_workbook({'Data': pd.DataFrame({'ID': [100, 101, 102], 'Name': ['X', 'Y', 'Z']})})),
+        ])
+        self.selected_sheets = {'a.csv': 'Sheet1', 'b.xlsx': 'Data'}
+        self.selected_files = {'a.csv': True, 'b.xlsx': True}
+    
+    def test_eta_and_throughput(self):
+        """Fraction follows rows when the total is known"""
+        clock = iter([0.0, 2.0, 4.0])
+        updates = []
+        progress = ProgressReporter('merge', 2, rows_total=100, callback=updates.append, clock=lambda: next(clock))
+        progress.advance('a.csv', 25)
+        progress.advance('a.csv', 25, file_done=True)
+        
+        self.assertEqual(updates[0]['fraction'], 0.25)
+        self.assertEqual(updates[0]['eta'], 6.0)
+        self.assertEqual(updates[1]['rows_per_second'], 12.5)
+        self.assertEqual(updates[1]['files_done'], 1)
+    
+    def test_load_and_merge_report_per_file(self):
+        """load_sheets and merge_files report every file with its rows"""
+        updates = []
+        self.merger.load_sheets(self.processed, self.selected_sheets, self.selected_files,
+                                progress_callback=updates.append)
+        self.merger.merge_files(self.processed, self.selected_sheets, self.selected_files,
+                                progress_callback=updates.append)
+        
+        self.assertEqual([(u['stage'], u['file'], u['rows']) for u in updates], [
+            ('load', 'a.csv', 25), ('load', 'b.xlsx', 28),
+            ('merge', 'a.csv', 25), ('merge', 'b.xlsx', 28),
+        ])
+        # Loaded sheets weight the merge bar by their rows
+        self.assertAlmostEqual(updates[2]['fraction'], 25 / 28)
+        self.assertEqual(updates[-1]['fraction'], 1.0)
+    
+    def test_streaming_reports_per_chunk(self):
+        """The streaming merge reports each chunk"""
+        updates = []
+        self.merger.merge_files_to_csv(self.processed, self.selected_sheets, self.selected_files,
+                                       io.StringIO(), chunksize=10, progress_callback=updates.append)
+        
+        chunk_rows = [u['rows'] for u in updates if u['file'] == 'a.csv']
+        self.assertEqual(chunk_rows[:3], [10, 20, 25])
+        self.assertEqual(updates[-1]['files_done'], 2)
+    
+    def test_cancel_stops_merge(self):
+        """Setting the cancel event stops the merge at the next file"""
+        cancel_event = threading.Event()
+        
+        def cancel_after_first(update):
+            cancel_event.set()
+        
+        with self.assertRaises(MergeCancelled):
+            self.merger.merge_files_to_csv(self.processed, self.selected_sheets, self.selected_files,
+                                           io.StringIO(), chunksize=10, progress_callback=cancel_after_first,
+                                           cancel_event=cancel_event)
+        with self.assertRaises(MergeCancelled):
+            self.merger.merge_files(self.processed, self.selected_sheets, self.selected_files,
+                                    cancel_event=cancel_event)
+
+class TestStageCache(unittest.TestCase):
+    """Test the memoised rerun stages"""
+    
+    def setUp(self):
+        self.stages = StageCache()
+        self.calls = []
+    
+    def compute(self, value):
+        def stage():
+            self.calls.append(value)
+            return value
+        return stage
+    
+    def test_recomputes_only_on_key_change(self):
+        """A stage reruns only when its input key changes"""
+        self.stages.start_rerun()
+        self.assertEqual(self.stages.run('schema', ('a', 1), self.compute('first')), 'first')
+        self.stages.start_rerun()
+        self.assertEqual(self.stages.run('schema', ('a', 1), self.compute('second')), 'first')
+        self.assertTrue(self.stages.timings['schema'][1])
+        self.assertEqual(self.stages.run('schema', ('a', 2), self.compute('third')), 'third')
+        
+        self.assertEqual(self.calls, ['first', 'third'])
+        self.assertEqual(self.stages.version('schema'), 2)
+    
+    def test_invalidate(self):
+        """Invalidated stages are computed again for the same key"""
+        self.stages.run('merge', 1, self.compute('first'))
+        self.stages.invalidate('merge')
+        self.stages.run('merge', 1, self.compute('second'))
+        
+        self.assertEqual(self.calls, ['first', 'second'])
+    
+    def test_freeze_key(self):
+        """Mappings and selections give equal keys regardless of insertion order"""
+        first = freeze_key({'b.csv': {'Name': 'Full'}, 'a.csv': ['Audit']})
+        second = freeze_key({'a.csv': ['Audit'], 'b.csv': {'Name': 'Full'}})
+        
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+
+class TestCli(unittest.TestCase):
+    """Test the headless command line"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = lambda name: os.path.join(self.tmp.name, name)
+        with open(self.path('branch_a.csv'), 'w') as f:
+            f.write("ID,Name,Audit\n1,x,9\n2,y,8\n")
+        with open(self.path('branch_b.csv'), 'w') as f:
+            f.write("ID,FullName\nB3,z\n")
+        with open(self.path('c.xlsx'), 'wb') as f:
+            f.write(make_workbook({
+                'Summary': pd.DataFrame({'Total': [3]}),
+                'Data': pd.DataFrame({'ID': [4, 5], 'Name': ['p', 'q']}),
+            }))
+        with open(self.path('mapping.json'), 'w') as f:
+            f.write('{"header_mapping": {"branch_b.csv": {"FullName": "Name"}},'
+                    ' "excluded_headers": {"branch_*.csv": ["Audit"]}}')
+    
+    def run_cli(self, *args):
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            return app.cli([self.path('*.csv'), self.path('*.xlsx'), '-m', self.path('mapping.json'), *args])
+    
+    def test_globs_sheet_and_mapping(self):
+        """Globs, the sheet selector and the mapping file drive the merge"""
+        output = self.path('merged.csv')
+        self.assertEqual(self.run_cli('-o', output, '-s', 'Data', '--chunksize', '1'), 0)
+        
+        merged = pd.read_csv(output)
+        self.assertEqual(list(merged.columns), ['ID', 'Name', '_source_file'])
+        self.assertEqual(merged['Name'].tolist(), ['x', 'y', 'z', 'p', 'q'])
+        self.assertFalse(os.path.exists(output + '.partial'))
+    
+    def test_inputs_read_from_path(self):
+        """Files given on the command line are read from disk, not kept as bytes"""
+        uploads = [app.PathUpload(self.path('branch_a.csv')), app.PathUpload(self.path('c.xlsx'))]
+        with mock.patch.object(app.PathUpload, 'getvalue', side_effect=AssertionError("read into memory")):
+            processed = FileMerger().process_uploaded_files(uploads)
+        
+        store = processed[self.path('c.xlsx')]['data']
+        self.assertEqual(store.source, self.path('c.xlsx'))
+        self.assertEqual(store['Data']['Name'].tolist(), ['p', 'q'])
+        with open(self.path('branch_a.csv'), 'rb') as f:
+            self.assertEqual(processed[self.path('branch_a.csv')]['hash'], app.content_hash(f.read()))
+    
+    @unittest.skipUnless(app.is_module_available('pyarrow'), "pyarrow not installed")
+    def test_streamed_parquet_unifies_types(self):
+        """Chunks with conflicting types are written under one schema"""
+        output = self.path('merged.parquet')
+        self.assertEqual(self.run_cli('-o', output, '-s', '1', '--chunksize', '1'), 0)
+        
+        merged = pd.read_parquet(output)
+        self.assertEqual(merged['ID'].tolist(), ['1', '2', 'B3', '4', '5'])
+        self.assertEqual(len(merged), 5)
+    
+    def test_no_matching_inputs(self):
+        """No matching inputs is an error"""
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            self.assertEqual(app.cli([self.path('*.tsv'), '-o', self.path('out.csv')]), 2)
+    
+    @unittest.skipUnless(app.is_module_available('pyarrow'), "pyarrow not installed")
+    def test_unify_arrow_type(self):
+        """Integers widen, mixed numbers become float, anything else string"""
+        import pyarrow as pa
+        self.assertEqual(app.unify_arrow_type([pa.int8(), pa.null(), pa.int64()]), pa.int64())
+        self.assertEqual(app.unify_arrow_type([pa.int64(), pa.float64()]), pa.float64())
+        self.assertEqual(app.unify_arrow_type([pa.int64(), pa.string()]), pa.string())
+
+class TestMappingProfile(unittest.TestCase):
+    """Test mapping profiles and compiled column plans"""
+    
+    def setUp(self):
+        self.merger = FileMerger()
+        self.processed = {
+            'jan_a.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': pd.DataFrame({
+                'ID': [1, 2], 'Name': ['a', 'b'], 'Audit': [0, 0]})}},
+            'jan_b.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': pd.DataFrame({
+                'FullName': ['c'], 'ID': [3]})}},
+        }
+        self.selected_sheets = {'jan_a.csv': 'Sheet1', 'jan_b.csv': 'Sheet1'}
+        self.selected_files = {'jan_a.csv': True, 'jan_b.csv': True}
+        self.header_mapping = {'jan_b.csv': {'FullName': 'Name'}}
+        self.excluded_headers = {'jan_a.csv': ['Audit']}
+    
+    def test_plan_matches_mapping_merge(self):
+        """A compiled plan selects and renames by position in output order"""
+        plan = self.merger.compile_column_plan(self.processed, self.selected_sheets, self.selected_files,
+                                               self.header_mapping, self.excluded_headers)
+        
+        self.assertEqual(plan.columns, ['ID', 'Name'])
+        self.assertEqual(plan.sources['jan_b.csv'][0].tolist(), [1, 0])
+        merged = self.merger.merge_files(self.processed, self.selected_sheets, self.selected_files, plan=plan)
+        self.assertEqual(merged['Name'].tolist(), ['a', 'b', 'c'])
+        self.assertEqual(list(merged.columns), ['ID', 'Name', '_source_file'])
+    
+    def test_profile_matches_by_header_signature(self):
+        """A saved profile applies to files with the same layout under new names"""
+        file_headers = self.merger.get_file_headers(self.processed, self.selected_sheets, self.selected_files)
+        profile = MappingProfile.from_json(
+            MappingProfile('monthly').add(file_headers, self.header_mapping, self.excluded_headers).to_json()
+        )
+        
+        next_month = {'feb_a.csv': file_headers['jan_a.csv'], 'feb_b.csv': file_headers['jan_b.csv'],
+                      'feb_c.csv': ['Other']}
+        self.assertEqual(profile.unmatched(next_month), ['feb_c.csv'])
+        self.assertEqual(profile.resolve(next_month),
+                         ({'feb_b.csv': {'FullName': 'Name'}}, {'feb_a.csv': ['Audit']}))
+        self.assertEqual(profile.compile(next_month).columns, ['ID', 'Name', 'Other'])
+    
+    def test_signature_depends_on_order(self):
+        """Reordered headers are a different layout"""
+        self.assertEqual(header_signature(['ID', 'Name']), header_signature(['ID', 'Name']))
+        self.assertNotEqual(header_signature(['ID', 'Name']), header_signature(['Name', 'ID']))
+    
+    def test_compiled_plan(self):
+        """Exclusions, renames and collisions compile to one column order, applied to whole or pruned frames"""
+        plan = ColumnPlan.compile(
+            {'a.csv': ['ID', 'Name', 'Audit'], 'b.csv': ['Code', 'FullName', 'ID']},
+            {'b.csv': {'FullName': 'Name', 'Code': 'ID'}},
+            {'a.csv': ['Audit']}
+        )
+        
+        self.assertEqual(plan.columns, ['ID', 'Name'])
+        # The later of two columns renamed onto ID wins
+        self.assertEqual(plan.used_columns('b.csv'), ['FullName', 'ID'])
+        whole = pd.DataFrame([['c1', 'x', 7]], columns=['Code', 'FullName', 'ID'])
+        applied = plan.apply('b.csv', whole)
+        self.assertEqual(list(applied.columns), ['ID', 'Name'])
+        self.assertEqual(applied.iloc[0].tolist(), [7, 'x'])
+        pd.testing.assert_frame_equal(plan.apply('b.csv', whole[plan.used_columns('b.csv')]), applied)
+        
+        narrowed = plan.project(['Name'])
+        self.assertEqual(narrowed.columns, ['Name'])
+        self.assertEqual(narrowed.used_columns('a.csv'), ['Name'])
+    
+    def test_rejects_other_json(self):
+        """Only profile files are accepted"""
+        with self.assertRaises(ValueError):
+            MappingProfile.from_json('{"header_mapping": {}}')
+
+class TestHeaderMatcher(unittest.TestCase):
+    """Test fuzzy header suggestions"""
+    
+    def setUp(self):
+        self.matcher = HeaderMatcher()
+    
+    def test_normalisation(self):
+        """Case, separators, camelCase and Thai/English variants share tokens"""
+        self.assertEqual(header_tokens('CustomerName')[1], header_tokens('customer_name')[1])
+        self.assertEqual(header_tokens('ชื่อลูกค้า')[1], header_tokens('Customer Name')[1])
+        self.assertEqual(header_tokens('จำนวน')[0], header_tokens('Quantity')[0])
+    
+    def test_later_files_map_onto_earlier(self):
+        """Only the later file is renamed, so a pair is never swapped"""
+        suggestions = self.matcher.suggest({
+            'a.csv': ['ID', 'CustomerName', 'E-mail'],
+            'b.csv': ['ID', 'ชื่อลูกค้า', 'อีเมล', 'Notes'],
+        })
+        
+        self.assertEqual(list(suggestions), ['b.csv'])
+        self.assertEqual({h: target for h, (target, _) in suggestions['b.csv'].items()},
+                         {'ชื่อลูกค้า': 'CustomerName', 'อีเมล': 'E-mail'})
+    
+    def test_value_profile_breaks_ties(self):
+        """Sampled values pick between equally named candidates"""
+        samples = {
+            'a.csv': pd.DataFrame({'Amount 1': ['x', 'y'], 'Amount 2': [10.5, 20.0]}),
+            'b.csv': pd.DataFrame({'Amount': [11.0, 19.5]}),
+        }
+        suggestions = self.matcher.suggest({'a.csv': ['Amount 1', 'Amount 2'], 'b.csv': ['Amount']}, samples)
+        
+        self.assertEqual(suggestions['b.csv']['Amount'][0], 'Amount 2')
+    
+    def test_wide_files(self):
+        """Thousands of columns are matched through the candidate index"""
+        file_headers = {
+            f'f{f}.csv': [f'Metric {i}' for i in range(2000)] + [f'Branch Code {f}' if f else 'Branch ID']
+            for f in range(3)
+        }
+        suggestions = self.matcher.suggest(file_headers)
+        
+        self.assertEqual(suggestions['f1.csv']['Branch Code 1'][0], 'Branch ID')
+    
+    def test_suggest_header_matches_reads_samples(self):
+        """FileMerger samples each selected sheet without loading it"""
+        merger = FileMerger(reader_engine='pandas')
+        processed = merger.process_uploaded_files([
+            FakeUpload('a.csv', b"ID,Qty\n1,5\n"),
+            FakeUpload('b.csv', "ID,จำนวน\n2,6\n".encode('utf-8')),
+        ])
+        suggestions = merger.suggest_header_matches(processed, {}, {'a.csv': True, 'b.csv': True})
+        
+        self.assertEqual(suggestions['b.csv']['จำนวน'][0], 'Qty')
+        self.assertFalse(processed['b.csv']['data'].is_loaded('Sheet1'))
+
+class TestMappingTable(unittest.TestCase):
+    """Test the compact data_editor mapping view"""
+    
+    def test_defaults_follow_profile_then_suggestion(self):
+        """Profile targets win over suggestions, excluded headers start unticked"""
+        sample_df = pd.DataFrame({'ID': [1, 2], 'ชื่อ': ['ก', None], 'Audit': [0, 0]})
+        table = build_mapping_table(
+            ['ID', 'ชื่อ', 'Audit'], {'ID': 'match', 'ชื่อ': 'no_match', 'Audit': 'no_match'}, sample_df,
+            {'ชื่อ': ('Name', 0.8), 'Audit': ('Audited', 0.7)}, {'Audit': 'AuditFlag'}, ['ID']
+        )
+        
+        self.assertEqual(table['target'].tolist(), ['ID', 'Name', 'AuditFlag'])
+        self.assertEqual(table['keep'].tolist(), [False, True, True])
+        self.assertEqual(table['sample'].tolist(), ['1, 2', 'ก', '0, 0'])
+        self.assertEqual(table['score'].iloc[1], 80)
+        self.assertTrue(pd.isna(table['score'].iloc[2]))
+    
+    def test_read_back_edits(self):
+        """Unticked rows are excluded and changed targets become mappings"""
+        table = build_mapping_table(['ID', 'Name', 'Note'], {}, pd.DataFrame(), {}, {}, [])
+        table.loc[1, 'target'] = ' Customer '
+        table.loc[2, 'keep'] = False
+        
+        self.assertEqual(read_mapping_table(table), ({'Name': 'Customer'}, ['Note']))
+    
+    def test_blank_target_keeps_header(self):
+        """Clearing the output name falls back to the original header"""
+        table = build_mapping_table(['ID'], {}, pd.DataFrame(), {}, {}, [])
+        table.loc[0, 'target'] = None
+        
+        self.assertEqual(read_mapping_table(table), ({}, []))
+
+class TestResultBrowser(unittest.TestCase):
+    """Test server-side paging of the merge result"""
+    
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'ID': range(10),
+            'Name': [f'Customer {i}' for i in range(10)],
+            'Amount': [5.0, None, 3.0, 9.0, 1.0, 7.0, None, 2.0, 8.0, 4.0],
+            '_source_file': ['a.csv'] * 5 + ['b.csv'] * 5,
+        })
+        self.browser = ResultBrowser(self.df)
+    
+    def test_pages_without_filters(self):
+        """Pages are plain slices and keep the result's row numbers"""
+        page = self.browser.page(2, 3)
+        
+        self.assertEqual(page['ID'].tolist(), [6, 7, 8])
+        self.assertEqual(page.index.tolist(), [6, 7, 8])
+        self.assertIsNone(self.browser.positions())
+        self.assertEqual(len(self.browser.page(3, 3)), 1)
+    
+    def test_filters(self):
+        """Text filters match case-insensitively, list filters match exactly"""
+        filters = {'_source_file': ['b.csv'], 'Name': 'CUSTOMER 8'}
+        
+        self.assertEqual(self.browser.page(0, 10, filters)['ID'].tolist(), [8])
+        self.assertEqual(self.browser.count({'_source_file': ['a.csv']}), 5)
+        self.assertEqual(self.browser.count({'Name': '', '_source_file': []}), 10)
+    
+    def test_sort_puts_missing_last(self):
+        """Sorting works on the filtered rows and keeps missing values at the end"""
+        page = self.browser.page(0, 10, {'_source_file': ['b.csv']}, sort_by='Amount', ascending=False)
+        
+        self.assertEqual(page['ID'].tolist(), [8, 5, 9, 7, 6])
+    
+    def test_mixed_types_sort_as_text(self):
+        """Object columns mixing numbers and text still sort"""
+        browser = ResultBrowser(pd.DataFrame({'Code': pd.Series([10, 'A', 2], dtype=object)}))
+        
+        self.assertEqual(browser.page(0, 3, sort_by='Code')['Code'].tolist(), [10, 2, 'A'])
+    
+    def test_orders_are_reused(self):
+        """Paging through one view computes its row order once"""
+        first = self.browser.positions({'Name': '1'}, 'ID', False)
+        
+        self.assertIs(self.browser.positions({'Name': '1'}, 'ID', False), first)
+        for i in range(4):
+            self.browser.positions(sort_by='ID', ascending=bool(i % 2), filters={'ID': str(i)})
+        self.assertLessEqual(len(self.browser._orders), self.browser.max_orders)
+
+class TestDeduplication(unittest.TestCase):
+    """Test the dedupe stage"""
+    
+    def setUp(self):
+        self.merger = FileMerger()
+        self.processed = {
+            'jan.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': pd.DataFrame({
+                'ID': [1, 2, 2, 3], 'Amount': [10.0, 20.0, 20.0, 30.0], 'Note': ['a', 'b', 'b', 'c']
+            })}},
+            'feb.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': pd.DataFrame({
+                'ID': [3.0, 4.0, 1.0], 'Amount': [30, 40, 10], 'Note': ['c', 'd', 'changed']
+            })}},
+        }
+    
+    def test_full_rows_across_types(self):
+        """Identical rows match across files even when one side is float"""
+        deduplicator = RowDeduplicator()
+        merged = self.merger.merge_files(self.processed, {}, {}, deduplicator=deduplicator)
+        
+        self.assertEqual(merged['ID'].tolist(), [1, 2, 3, 4, 1])
+        self.assertEqual(merged.index.tolist(), list(range(5)))
+        self.assertEqual(deduplicator.pair_counts, {('jan.csv', 'jan.csv'): 1, ('jan.csv', 'feb.csv'): 1})
+        self.assertEqual(deduplicator.summary()['rows'].tolist(), [1, 1])
+    
+    def test_key_set(self):
+        """Only the key columns decide what is a duplicate"""
+        deduplicator = RowDeduplicator(['ID'])
+        merged = self.merger.merge_files(self.processed, {}, {}, deduplicator=deduplicator)
+        
+        self.assertEqual(merged['ID'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(deduplicator.pair_counts[('jan.csv', 'feb.csv')], 2)
+        self.assertEqual(deduplicator.rows_dropped, 3)
+    
+    def test_missing_key(self):
+        """Unknown key columns are rejected"""
+        with self.assertRaises(ValueError):
+            RowDeduplicator(['Branch']).filter(pd.DataFrame({'ID': [1]}))
+    
+    def test_streaming_with_spill_matches_in_memory(self):
+        """Chunked dedupe that spills its hashes to disk keeps the same rows"""
+        in_memory = self.merger.merge_files(self.processed, {}, {}, deduplicator=RowDeduplicator(['ID', 'Note']))
+        deduplicator = RowDeduplicator(['ID', 'Note'], max_memory_rows=2)
+        output = io.StringIO()
+        summary = self.merger.merge_files_to_csv(self.processed, {}, {}, output, chunksize=1,
+                                                 deduplicator=deduplicator)
+        
+        self.assertGreater(deduplicator.seen.spilled, 0)
+        self.assertEqual(pd.read_csv(io.StringIO(output.getvalue()))['Note'].tolist(), in_memory['Note'].tolist())
+        self.assertEqual(summary['rows_per_file'], {'jan.csv': 3, 'feb.csv': 2})
+        
+        spill_dir = deduplicator.seen._tempdir.name
+        deduplicator.close()
+        self.assertFalse(os.path.exists(spill_dir))
+    
+    def test_hash_runs_lookup(self):
+        """Lookups find hashes in memory and in spilled runs"""
+        runs = HashRuns(max_memory_rows=3, max_runs=1)
+        self.addCleanup(runs.close)
+        runs.add(np.array([5, 1, 9], dtype=np.uint64), np.array([0, 0, 0]))
+        runs.add(np.array([7, 3], dtype=np.uint64), np.array([1, 1]))
+        runs.add(np.array([2], dtype=np.uint64), np.array([2]))
+        
+        self.assertEqual(runs.spilled, 1)
+        self.assertEqual(len(runs), 6)
+        found = runs.lookup(np.array([9, 3, 2, 4, 2 ** 63], dtype=np.uint64))
+        self.assertEqual(found.tolist(), [0, 1, 2, -1, -1])
+    
+    def test_streamed_keys_across_dtypes(self):
+        """A key read as a number in one file matches the same key read as text in another"""
+        processed = self.merger.process_uploaded_files([
+            FakeUpload('d1.csv', b"ID,V\n25,a\n"),
+            FakeUpload('d2.csv', b"ID,V\n25,a\nx,b\n"),
+        ])
+        in_memory = self.merger.merge_files(processed, {}, {}, deduplicator=RowDeduplicator())
+        output = io.StringIO()
+        self.merger.merge_files_to_csv(processed, {}, {}, output, deduplicator=RowDeduplicator())
+        
+        self.assertEqual(len(in_memory), 2)
+        self.assertEqual(output.getvalue().splitlines()[1:], ['25,a,d1.csv', 'x,b,d2.csv'])
+    
+    def test_hash_collision_keeps_rows(self):
+        """Rows whose hashes collide are compared by value before one is dropped"""
+        deduplicator = RowDeduplicator(['ID'])
+        df = pd.DataFrame({'ID': [1, 2, 1, 3, 2], '_source_file': 'a.csv'})
+        with mock.patch.object(deduplicator, 'hash_rows', return_value=np.zeros(5, dtype=np.uint64)):
+            kept = deduplicator.filter(df)
+        
+        self.assertEqual(kept['ID'].tolist(), [1, 2, 3])
+        self.assertEqual(deduplicator.rows_dropped, 2)
+    
+    def test_large_integer_keys(self):
+        """Integers beyond float64 precision are not treated as duplicates"""
+        deduplicator = RowDeduplicator()
+        kept = deduplicator.filter(pd.DataFrame({'ID': [2 ** 53, 2 ** 53 + 1], '_source_file': 'a.csv'}))
+        
+        self.assertEqual(len(kept), 2)
+    
+    def test_hash_runs_compaction(self):
+        """Spilled runs past max_runs are merged into one without losing hashes"""
+        runs = HashRuns(max_memory_rows=2, max_runs=2)
+        self.addCleanup(runs.close)
+        for i, batch in enumerate([[9, 1, 5], [4, 8, 2], [7, 3, 6], [0, 10, 11]]):
+            runs.add(np.array(batch, dtype=np.uint64), np.full(3, i))
+        
+        self.assertLessEqual(runs.spilled, 2)
+        self.assertEqual(len(runs), 12)
+        self.assertEqual(len(os.listdir(runs._tempdir.name)), 2 * runs.spilled)
+        found = runs.lookup(np.arange(13, dtype=np.uint64))
+        self.assertEqual(found.tolist(), [3, 0, 1, 2, 1, 0, 2, 2, 1, 0, 3, 3, -1])
+    
+    def test_cli_dedupe(self):
+        """--dedupe-keys drops repeated IDs from the written file"""
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, text in [('a.csv', "ID,V\n1,x\n2,y\n"), ('b.csv', "ID,V\n2,z\n3,w\n")]:
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(text)
+            output = os.path.join(tmp, 'out.csv')
+            with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                code = app.cli([os.path.join(tmp, '*.csv'), '-o', output, '--dedupe-keys', 'ID'])
+            
+            self.assertEqual(code, 0)
+            self.assertEqual(pd.read_csv(output)['V'].tolist(), ['x', 'y', 'w'])
+            self.assertIn(f"{os.path.join(tmp, 'b.csv')} repeats {os.path.join(tmp, 'a.csv')}: 1 rows",
+                          stderr.getvalue())
+
+class TestColumnPruning(unittest.TestCase):
+    """Test that excluded columns are skipped at read time"""
+    
+    def setUp(self):
+        self.merger = FileMerger(reader_engine='pandas')
+        self.processed = self.merger.process_uploaded_files([
+            FakeUpload('a.csv', b"ID,Audit1,Name,Audit2\n1,x,p,y\n2,x,q,y\n"),
+            FakeUpload('b.xlsx', make_workbook({'Data': pd.DataFrame({
+                'Audit1': ['x'], 'FullName': ['r'], 'ID': [3]
+            })})),
+        ])
+        self.mapping = {'b.xlsx': {'FullName': 'Name'}}
+        self.excluded = {'a.csv': ['Audit1', 'Audit2'], 'b.xlsx': ['Audit1']}
+        self.plan = self.merger.compile_column_plan(self.processed, {}, {}, self.mapping, self.excluded)
+    
+    def test_used_columns(self):
+        """The plan lists kept source columns in file order"""
+        self.assertEqual(self.plan.used_columns('a.csv'), ['ID', 'Name'])
+        self.assertEqual(self.plan.used_columns('b.xlsx'), ['FullName', 'ID'])
+        self.assertIsNone(self.plan.used_columns('other.csv'))
+    
+    def test_merge_never_parses_excluded_columns(self):
+        """Only kept columns are read and the full sheet is never loaded"""
+        self.merger.load_sheets(self.processed, {}, {}, plan=self.plan)
+        merged = self.merger.merge_files(self.processed, {}, {}, plan=self.plan)
+        
+        self.assertEqual(list(merged.columns), ['ID', 'Name', '_source_file'])
+        self.assertEqual(merged['Name'].tolist(), ['p', 'q', 'r'])
+        self.assertEqual(merged['ID'].tolist(), [1, 2, 3])
+        for filename in self.processed:
+            store = self.processed[filename]['data']
+            sheet = self.processed[filename]['sheets'][0]
+            self.assertFalse(store.is_loaded(sheet))
+            self.assertEqual(store.loaded_rows(sheet), 2 if filename == 'a.csv' else 1)
+    
+    def test_pruned_read_does_not_leak_into_full_reads(self):
+        """The shared store still serves every column to other callers"""
+        store = self.processed['a.csv']['data']
+        self.assertEqual(list(store.select('Sheet1', ['Name'])), ['Name'])
+        self.assertTrue(store.has_columns('Sheet1', ['Name']))
+        self.assertFalse(store.has_columns('Sheet1', ['ID']))
+        
+        self.assertEqual(list(store['Sheet1'].columns), ['ID', 'Audit1', 'Name', 'Audit2'])
+        self.assertTrue(store.is_loaded('Sheet1'))
+    
+    def test_pool_and_streaming_paths(self):
+        """Pool parsing and streamed chunks read only the kept columns"""
+        merger = FileMerger(reader_engine='pandas', max_workers=2)
+        merger.load_sheets(self.processed, {}, {}, plan=self.plan)
+        self.assertEqual(list(self.processed['b.xlsx']['data']._pruned['Data'].columns), ['FullName', 'ID'])
+        
+        chunks = list(self.processed['a.csv']['data'].iter_chunks('Sheet1', 1, ['ID', 'Name']))
+        self.assertEqual([list(chunk.columns) for chunk in chunks], [['ID', 'Name']] * 2)
+        
+        output = io.StringIO()
+        self.merger.merge_files_to_csv(self.processed, {}, {}, output, self.mapping, self.excluded, chunksize=1)
+        self.assertEqual(pd.read_csv(io.StringIO(output.getvalue()))['Name'].tolist(), ['p', 'q', 'r'])
+    
+    def test_duplicate_headers_fall_back_to_full_read(self):
+        """Mangled duplicate headers cannot be selected by name and read everything"""
+        processed = self.merger.process_uploaded_files([FakeUpload('dup.csv', b"A,A,B\n1,2,3\n")])
+        excluded = {'dup.csv': ['B']}
+        plan = self.merger.compile_column_plan(processed, {}, {}, None, excluded)
+        merged = self.merger.merge_files(processed, {}, {}, plan=plan)
+        
+        self.assertEqual(list(merged.columns), ['A', 'A.1', '_source_file'])
+        self.assertEqual(merged.iloc[0, :2].tolist(), [1, 2])
+
+class TestDtypeReconciliation(unittest.TestCase):
+    """Test cross-file dtype reconciliation"""
+    
+    def setUp(self):
+        self.merger = FileMerger()
+    
+    def processed(self, **frames):
+        return {f'{name}.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': df}} for name, df in frames.items()}
+    
+    def test_kinds(self):
+        """Whole floats and all-missing columns are told apart from real floats"""
+        self.assertEqual(dtype_kind(pd.Series([1, 2])), 'int')
+        self.assertEqual(dtype_kind(pd.Series([1.0, np.nan])), 'intlike')
+        self.assertEqual(dtype_kind(pd.Series([1.5, np.nan])), 'float')
+        self.assertEqual(dtype_kind(pd.Series([np.nan, np.nan])), 'null')
+        self.assertEqual(dtype_kind(pd.Series(['a', None], dtype=object)), 'text')
+        self.assertEqual(dtype_kind(pd.Series([1, 'a'], dtype=object)), 'other')
+    
+    def test_integers_with_gaps_stay_integers(self):
+        """int64, whole floats with NaN and a missing column merge into Int64"""
+        merged = self.merger.merge_files(self.processed(
+            jan=pd.DataFrame({'Age': [25, 30], 'Price': [1, 2]}),
+            feb=pd.DataFrame({'Age': [np.nan, 40.0]}),
+        ), {}, {})
+        
+        self.assertEqual(str(merged['Age'].dtype), 'Int64')
+        self.assertEqual(str(merged['Price'].dtype), 'Int64')
+        self.assertEqual(merged['Age'].tolist()[1:], [30, pd.NA, 40])
+        self.assertIn('25\n', merged.to_csv(index=False).replace(',', '\n'))
+        self.assertEqual(merged.attrs['widened_columns']['Age'],
+                         {'dtype': 'Int64', 'sources': {'jan.csv': 'int64', 'feb.csv': 'float64'}})
+    
+    def test_numbers_mixed_with_text_become_text(self):
+        """Codes that are numbers in one file and text in another stay text, without .0"""
+        merged = self.merger.merge_files(self.processed(
+            jan=pd.DataFrame({'Code': [1.0, np.nan], 'Rate': [1, 2]}),
+            feb=pd.DataFrame({'Code': ['A1', 'B2'], 'Rate': [0.5, 1.0]}),
+        ), {}, {})
+        
+        self.assertEqual(merged['Code'].tolist()[0], '1')
+        self.assertTrue(pd.isna(merged['Code'].iloc[1]))
+        self.assertNotEqual(merged['Code'].dtype, object)
+        self.assertEqual(merged['Rate'].dtype, np.float64)
+        self.assertEqual(set(merged.attrs['widened_columns']), {'Code', 'Rate'})
+    
+    def test_matching_dtypes_are_untouched(self):
+        """Sources that already agree keep their dtype and report nothing"""
+        merged = self.merger.merge_files(self.processed(
+            jan=pd.DataFrame({'ID': [1, 2], 'Amount': [1.5, 2.5]}),
+            feb=pd.DataFrame({'ID': [3], 'Amount': [3.5]}),
+        ), {}, {})
+        
+        self.assertEqual(merged['ID'].dtype, np.int64)
+        self.assertEqual(merged.attrs['widened_columns'], {})
+        self.assertEqual(self.merger.optimize_dtypes(merged).attrs['widened_columns'], {})
+    
+    def test_streamed_chunks_with_gaps(self):
+        """A chunk whose integers contain gaps is not written as floats"""
+        processed = self.merger.process_uploaded_files([FakeUpload('a.csv', b"ID,Qty\n1,5\n2,6\n3,\n4,8\n")])
+        output = io.StringIO()
+        summary = self.merger.merge_files_to_csv(processed, {}, {}, output, chunksize=2)
+        
+        self.assertEqual(output.getvalue().splitlines()[1:], ['1,5,a.csv', '2,6,a.csv', '3,,a.csv', '4,8,a.csv'])
+        self.assertEqual(summary['widened']['Qty']['dtype'], 'Int64')
+    
+    def test_streamed_whole_floats_stay_floats(self):
+        """Whole floats are not written as integers before later fractions are seen"""
+        processed = self.merger.process_uploaded_files([
+            FakeUpload('f1.csv', b"Amount\n100.0\n200.0\n"),
+            FakeUpload('f2.csv', b"Amount\n300.0\n100.5\n"),
+        ])
+        output = io.StringIO()
+        self.merger.merge_files_to_csv(processed, {}, {}, output, chunksize=1)
+        expected = io.BytesIO()
+        self.merger.export(self.merger.merge_files(processed, {}, {}), expected, 'csv')
+        
+        self.assertEqual(output.getvalue().splitlines(), expected.getvalue().decode().splitlines())
+        self.assertEqual([line.split(',')[0] for line in output.getvalue().splitlines()[1:]],
+                         ['100.0', '200.0', '300.0', '100.5'])
+
+class TestJoin(unittest.TestCase):
+    """Test the key-based join mode"""
+    
+    def setUp(self):
+        self.merger = FileMerger()
+        self.processed = {
+            'a.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': pd.DataFrame(
+                {'customer_id': [1, 2, 3], 'name': ['A', 'B', 'C']})}},
+            'b.csv': {'sheets': ['Sheet1'], 'data': {'Sheet1': pd.DataFrame(
+                {'CustID': ['2', '3', '3', '9'], 'total': [20, 30, 31, 90]})}},
+        }
+        self.mapping = {'b.csv': {'CustID': 'customer_id'}}
+    
+    def join(self, how, **kwargs):
+        return self.merger.join_files(self.processed, {}, {}, ['customer_id'], how, self.mapping, **kwargs)
+    
+    def test_join_types(self):
+        """Left keeps the base rows, inner only matches, outer adds unmatched right rows"""
+        left = self.join('left')
+        self.assertEqual(left['customer_id'].tolist(), [1, 2, 3, 3])
+        self.assertEqual(left['total'].tolist()[1:], [20, 30, 31])
+        self.assertTrue(pd.isna(left['total'].iloc[0]))
+        self.assertEqual(str(left['total'].dtype), 'Int64')
+        
+        self.assertEqual(self.join('inner')['name'].tolist(), ['B', 'C', 'C'])
+        
+        outer = self.join('outer')
+        self.assertEqual(outer['customer_id'].astype(str).tolist(), ['1', '2', '3', '3', '9'])
+        self.assertTrue(pd.isna(outer['name'].iloc[-1]))
+    
+    def test_match_report(self):
+        """Per-file match counts in both directions"""
+        report = self.join('left').attrs['join_report']
+        self.assertEqual(report[0]['file'], 'a.csv')
+        self.assertEqual((report[1]['rows'], report[1]['matched']), (4, 3))
+        self.assertEqual((report[1]['base_rows'], report[1]['base_matched']), (3, 2))
+    
+    def test_strategies_agree(self):
+        """Hash and sort give the same rows"""
+        rng = np.random.default_rng(0)
+        left = pd.DataFrame({'k': rng.integers(0, 500, 2000), 'j': rng.choice(['x', 'y', None], 2000)})
+        right = pd.DataFrame({'k': rng.integers(0, 500, 1500), 'j': rng.choice(['x', 'y'], 1500)})
+        for how in ('left', 'inner', 'outer'):
+            expected = join_indexers(left, right, how, 'hash')
+            self.assertEqual(expected[2], 'hash')
+            left_idx, right_idx, _ = join_indexers(left, right, how, 'sort')
+            np.testing.assert_array_equal(left_idx, expected[0])
+            np.testing.assert_array_equal(right_idx, expected[1])
+        
+        left_idx, right_idx, _ = join_indexers(left, right, 'inner', 'hash')
+        self.assertEqual(len(left_idx), len(left.merge(right, on=['k', 'j'])))
+    
+    def test_large_integer_keys(self):
+        """IDs beyond 2**53 are matched exactly by both strategies"""
+        left = pd.DataFrame({'k': np.array([2 ** 53, 2 ** 53 + 1], dtype='int64')})
+        right = pd.DataFrame({'k': np.array([2 ** 53 + 1, 5], dtype='int64')})
+        for strategy in ('hash', 'sort'):
+            left_idx, right_idx, _ = join_indexers(left, right, 'left', strategy)
+            self.assertEqual(right_idx.tolist(), [-1, 0])
+        
+        # Whole floats with gaps still match integer keys
+        left_idx, right_idx, _ = join_indexers(pd.DataFrame({'k': [1.0, 5.0, np.nan]}), right, 'left')
+        self.assertEqual(right_idx.tolist(), [-1, 1, -1])
+    
+    def test_sort_strategy_sorts_key_values(self):
+        """Sort ranks the keys by value without hashing them, auto checks the normalised keys"""
+        left = pd.DataFrame({'k': ['b', 'a', None, 'c'], 'n': [2, 1, 1, 3]})
+        right = pd.DataFrame({'k': ['a', 'c', 'b'], 'n': [1, 3, 2]})
+        with mock.patch('pandas.factorize', side_effect=AssertionError("hashed")):
+            left_idx, right_idx, used = join_indexers(left, right, 'left', 'sort')
+        self.assertEqual(used, 'sort')
+        self.assertEqual(right_idx.tolist(), [2, 0, -1, 1])
+        
+        # 1, 2, 10 are in order as numbers but not once compared as text
+        used = join_indexers(pd.DataFrame({'k': ['1']}), pd.DataFrame({'k': [1, 2, 10]}), 'left')[2]
+        self.assertEqual(used, 'hash')
+        self.assertEqual(join_indexers(left[['k']], pd.DataFrame({'k': ['a', 'b']}), 'left')[2], 'sort')
+    
+    def test_invalid_arguments(self):
+        """Unknown join types and missing keys are rejected"""
+        with self.assertRaises(ValueError):
+            self.join('cross')
+        with self.assertRaises(ValueError):
+            self.merger.join_files(self.processed, {}, {}, ['customer_id'], 'left')
+    
+    def test_cli_join(self):
+        """--join writes the joined file and reports match rates"""
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, content in (('a.csv', "id,name\n1,A\n2,B\n"), ('b.csv', "id,total\n2,20\n")):
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(content)
+            output = os.path.join(tmp, 'out.csv')
+            with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                code = app.cli([os.path.join(tmp, '*.csv'), '-o', output, '--join', 'id'])
+            
+            self.assertEqual(code, 0)
+            self.assertEqual(pd.read_csv(output)['total'].tolist()[1], 20)
+            self.assertIn('1/1 rows matched', stderr.getvalue())
+
+class TestQuery(unittest.TestCase):
+    """Test the query stage evaluated during the scan"""
+    
+    def setUp(self):
+        self.merger = FileMerger()
+        self.processed = self.merger.process_uploaded_files([
+            FakeUpload('jan.csv', b"ID,Region,Amount,Note\n1,North,10,x\n2,South,5,y\n3,north,7,\n"),
+            FakeUpload('feb.xlsx', make_workbook({'Sheet1': pd.DataFrame(
+                {'ID': [4, 5], 'Region': ['North', 'East'], 'Amount': [1.5, 2.0]})})),
+        ])
+    
+    def test_condition_types(self):
+        """Values are compared in the column's type and missing values never match"""
+        numbers = pd.Series([1.0, 10.0, np.nan])
+        self.assertEqual(condition_mask(numbers, '>', '2').tolist(), [False, True, False])
+        self.assertEqual(condition_mask(numbers, '!=', '1').tolist(), [False, True, False])
+        self.assertEqual(condition_mask(numbers, '==', 'abc').tolist(), [False, False, False])
+        self.assertEqual(condition_mask(numbers, 'between', ['1', '5']).tolist(), [True, False, False])
+        text = pd.Series(['North', 'north', None])
+        self.assertEqual(condition_mask(text, '==', 'North').tolist(), [True, False, False])
+        self.assertEqual(condition_mask(text, 'contains', 'NOR').tolist(), [True, True, False])
+        self.assertEqual(condition_mask(text, 'in', ['north', 'x']).tolist(), [False, True, False])
+        dates = pd.Series(pd.to_datetime(['2024-01-05', '2024-03-01']))
+        self.assertEqual(condition_mask(dates, '<', '2024-02-01').tolist(), [True, False])
+    
+    def test_filter_and_projection(self):
+        """Matching rows with only the selected columns, CSV sources read in chunks and not kept"""
+        query = MergeQuery([('Region', '==', 'North')], columns=['ID', 'Amount'])
+        result = self.merger.query_files(self.processed, {}, {}, query, chunksize=1)
+        
+        self.assertEqual(list(result.columns), ['ID', 'Amount', '_source_file'])
+        self.assertEqual(result['ID'].tolist(), [1, 4])
+        self.assertEqual(result.attrs['query_report'],
+                         {'jan.csv': {'rows': 3, 'matched': 1}, 'feb.xlsx': {'rows': 2, 'matched': 1}})
+        self.assertFalse(self.processed['jan.csv']['data'].is_loaded('Sheet1'))
+    
+    def test_aggregates_match_merged_groupby(self):
+        """Per-chunk partials combine to the same result as aggregating the merge"""
+        query = MergeQuery([('Amount', '>=', '2')], group_by=['Region'],
+                           aggregates=[('count', None), ('sum', 'Amount'), ('mean', 'Amount'), ('max', 'ID')])
+        result = self.merger.query_files(self.processed, {}, {}, query, chunksize=1)
+        
+        merged = self.merger.merge_files(self.processed, {}, {})
+        merged = merged[merged['Amount'] >= 2]
+        expected = merged.groupby('Region')['Amount'].agg(['count', 'sum', 'mean'])
+        self.assertEqual(result['Region'].tolist(), list(expected.index))
+        self.assertEqual(result['count'].tolist(), expected['count'].tolist())
+        self.assertEqual(result['sum(Amount)'].astype(float).tolist(), expected['sum'].tolist())
+        self.assertEqual(result['mean(Amount)'].tolist(), expected['mean'].tolist())
+        self.assertEqual(result['max(ID)'].tolist(), [5, 1, 2, 3])
+    
+    def test_count_without_columns(self):
+        """A plain row count reads no columns and still counts every row"""
+        result = self.merger.query_files(self.processed, {}, {}, MergeQuery(aggregates=[('count', None)]))
+        self.assertEqual(result['count'].tolist(), [5])
+    
+    def test_streamed_query(self):
+        """The streaming merge applies the query chunk by chunk"""
+        output = io.StringIO()
+        summary = self.merger.merge_files_to_csv(self.processed, {}, {}, output, chunksize=2,
+                                                 query=MergeQuery([('Region', 'in', ['South', 'East'])], ['ID']))
+        
+        self.assertEqual(output.getvalue().splitlines(), ['ID,_source_file', '2,jan.csv', '5,feb.xlsx'])
+        self.assertEqual(summary['rows_scanned'], {'jan.csv': 3, 'feb.xlsx': 2})
+    
+    def test_dedupe_sees_the_whole_row(self):
+        """Rows that only agree on the queried columns are not duplicates"""
+        processed = self.merger.process_uploaded_files([
+            FakeUpload('orders.csv', b"Order,Region,Amount\n1,North,5\n2,North,5\n2,North,5\n3,South,100\n"),
+            FakeUpload('more.csv', b"Order,Region,Amount\n4,North,100\n1,North,5\n"),
+        ])
+        query = MergeQuery(group_by=['Region'], aggregates=[('sum', 'Amount'), ('count', None)])
+        result = self.merger.query_files(processed, {}, {}, query, chunksize=2, deduplicator=RowDeduplicator())
+        
+        self.assertEqual(result.to_dict('records'), [{'Region': 'North', 'sum(Amount)': 110, 'count': 3},
+                                                     {'Region': 'South', 'sum(Amount)': 100, 'count': 1}])
+        
+        # Keys the projection leaves out are still compared
+        output = io.StringIO()
+        self.merger.merge_files_to_csv(processed, {}, {}, output, deduplicator=RowDeduplicator(['Order']),
+                                       query=MergeQuery(columns=['Region']))
+        self.assertEqual(output.getvalue().splitlines(),
+                         ['Region,_source_file', 'North,orders.csv', 'North,orders.csv', 'South,orders.csv',
+                          'North,more.csv'])
+    
+    def test_invalid_queries(self):
+        """Unknown columns, operators and aggregates are rejected"""
+        with self.assertRaises(ValueError):
+            self.merger.query_files(self.processed, {}, {}, MergeQuery([('Missing', '==', 'x')]))
+        with self.assertRaises(ValueError):
+            MergeQuery([('ID', '~', 'x')])
+        with self.assertRaises(ValueError):
+            MergeQuery(aggregates=[('sum', None)])
+        with self.assertRaises(ValueError):
+            MergeQuery.parse_condition('ID', 'between', '1')
+    
+    def test_cli_query(self):
+        """--where/--group-by/--agg write the aggregated result"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sales.csv')
+            with open(path, 'w') as f:
+                f.write("Region,Amount\nNorth,10\nSouth,5\nNorth,7\n")
+            output = os.path.join(tmp, 'out.csv')
+            code = app.cli([path, '-o', output, '-q', '--where', 'Amount', '>', '5',
+                            '--group-by', 'Region', '--agg', 'count,sum(Amount)'])
+            
+            self.assertEqual(code, 0)
+            result = pd.read_csv(output)
+            self.assertEqual(result.to_dict('records'), [{'Region': 'North', 'count': 2, 'sum(Amount)': 17}])
+            
+            code = app.cli([path, '-o', output, '-q', '--select', 'Region', '--dedupe-keys', 'Amount'])
+            self.assertEqual(code, 0)
+            self.assertEqual(pd.read_csv(output)['Region'].tolist(), ['North', 'South', 'North'])
+
+class TestIncrementalMerge(unittest.TestCase):
+    """Test updating a merge result and a partitioned dataset with added and removed files"""
+    
+    def setUp(self):
+        self.merger = FileMerger()
+        self.processed = self.merger.process_uploaded_files([
+            FakeUpload('a.csv', b"ID,Region\n1,North\n2,South\n"),
+            FakeUpload('b.csv', b"ID,Region,Amount\nx,East,1.5\n"),
+            FakeUpload('c.csv', b"ID,Region\n9,West\n"),
+            FakeUpload('d.csv', b"ID,Region,Amount\n7,East,2\n"),
+        ])
+    
+    def update(self, previous, selected, **mappings):
+        result = self.merger.update_merge(previous, self.processed, {}, selected, **mappings)
+        pd.testing.assert_frame_equal(result, self.merger.merge_files(self.processed, {}, selected, **mappings))
+        return result
+    
+    def test_matches_full_merge(self):
+        """Adding, removing and remapping files gives the same frame as merging again"""
+        selected = {'a.csv': True, 'b.csv': False, 'c.csv': True, 'd.csv': False}
+        result = self.merger.merge_files(self.processed, {}, selected)
+        
+        selected['d.csv'] = True
+        result = self.update(result, selected)
+        self.assertEqual(result.attrs['merge_changes'], {'added': ['d.csv'], 'removed': []})
+        result = self.update(result, selected, header_mapping={'c.csv': {'Region': 'Area'}})
+        self.assertEqual(result.attrs['merge_changes'], {'added': ['c.csv'], 'removed': ['c.csv']})
+        selected['a.csv'] = False
+        result = self.update(result, selected, header_mapping={'c.csv': {'Region': 'Area'}})
+        # Re-added ahead of the kept files, rows follow the file order again
+        selected['a.csv'] = True
+        result = self.update(result, selected)
+        self.assertEqual(result['_source_file'].tolist(), ['a.csv', 'a.csv', 'c.csv', 'd.csv'])
+    
+    def test_only_changed_files_are_read(self):
+        """Kept partitions are not read again"""
+        selected = {'a.csv': True, 'b.csv': False, 'c.csv': True, 'd.csv': False}
+        result = self.merger.merge_files(self.processed, {}, selected)
+        selected['d.csv'] = True
+        with mock.patch.object(self.merger, 'get_sheet_data', wraps=self.merger.get_sheet_data) as read:
+            result = self.merger.update_merge(result, self.processed, {}, selected)
+        
+        self.assertEqual(read.call_count, 1)
+        self.assertIs(read.call_args[0][0], self.processed['d.csv'])
+        self.assertIs(self.merger.update_merge(result, self.processed, {}, selected), result)
+    
+    def test_widening_file_removed(self):
+        """Removing the file that widened a column narrows it back"""
+        selected = {'a.csv': True, 'b.csv': True, 'c.csv': False, 'd.csv': False}
+        result = self.merger.merge_files(self.processed, {}, selected)
+        self.assertIn('ID', result.attrs['widened_columns'])
+        selected['b.csv'] = False
+        result = self.update(result, selected)
+        self.assertEqual(result['ID'].dtype, np.int64)
+    
+    def test_deduplicated_result_is_merged_again(self):
+        """Results whose rows depend on other files are not updated in place"""
+        result = self.merger.merge_files(self.processed, {}, {}, deduplicator=RowDeduplicator(['Region']))
+        self.assertNotIn('merge_inputs', result.attrs)
+        self.update(result, {'a.csv': True, 'b.csv': False, 'c.csv': True, 'd.csv': True})
+    
+    def test_partitioned_dataset(self):
+        """Only new partitions are written and removed ones are deleted"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'dataset')
+            selected = {'a.csv': True, 'b.csv': False, 'c.csv': True, 'd.csv': False}
+            ParquetPartitions(path).sync(self.merger, self.processed, {}, selected)
+            first = {name: os.stat(os.path.join(path, name)).st_mtime_ns
+                     for name in os.listdir(path) if name.startswith('part-')}
+            
+            selected['d.csv'] = True
+            dataset = ParquetPartitions(path)
+            summary = dataset.sync(self.merger, self.processed, {}, selected)
+            self.assertEqual((summary['added'], summary['removed']), (['d.csv'], []))
+            self.assertEqual(summary['rewritten'], ['a.csv', 'c.csv'])
+            
+            selected['d.csv'] = False
+            summary = ParquetPartitions(path).sync(self.merger, self.processed, {}, selected)
+            self.assertEqual(summary['removed'], ['d.csv'])
+            result = ParquetPartitions(path).read()
+            self.assertEqual(result['ID'].tolist(), [1, 2, 9])
+            self.assertEqual(result['_source_file'].tolist(), ['a.csv', 'a.csv', 'c.csv'])
+            
+            summary = ParquetPartitions(path).sync(self.merger, self.processed, {}, selected)
+            self.assertEqual(summary['added'] + summary['removed'] + summary['rewritten'], [])
+            self.assertEqual(sorted(first), sorted(n for n in os.listdir(path) if n.startswith('part-')))
+    
+    def test_same_layout_partitions_are_not_rewritten(self):
+        """Appending a file with the same columns leaves the existing partitions untouched"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'dataset')
+            selected = {'a.csv': True, 'b.csv': False, 'c.csv': False, 'd.csv': False}
+            ParquetPartitions(path).sync(self.merger, self.processed, {}, selected)
+            existing = [name for name in os.listdir(path) if name.startswith('part-')]
+            written = os.stat(os.path.join(path, existing[0])).st_mtime_ns
+            
+            selected['c.csv'] = True
+            summary = ParquetPartitions(path).sync(self.merger, self.processed, {}, selected)
+            self.assertEqual((summary['added'], summary['rewritten']), (['c.csv'], []))
+            self.assertEqual(os.stat(os.path.join(path, existing[0])).st_mtime_ns, written)
+    
+    def test_identical_inputs(self):
+        """Copies of the same file get their own partitions"""
+        processed = self.merger.process_uploaded_files([
+            FakeUpload('a.csv', b"ID,Region\n1,North\n"),
+            FakeUpload('copy.csv', b"ID,Region\n1,North\n"),
+            FakeUpload('c.csv', b"ID,Region\n9,West\n"),
+        ])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'dataset')
+            summary = ParquetPartitions(path).sync(self.merger, processed, {}, {})
+            
+            self.assertEqual(summary['added'], ['a.csv', 'copy.csv', 'c.csv'])
+            self.assertEqual(ParquetPartitions(path).read()['_source_file'].tolist(), ['a.csv', 'copy.csv', 'c.csv'])
+            self.assertEqual(len([name for name in os.listdir(path) if name.endswith('.parquet')]), 3)
+            
+            summary = ParquetPartitions(path).sync(self.merger, processed, {}, {'copy.csv': False})
+            self.assertEqual(summary['removed'], ['copy.csv'])
+            self.assertEqual(ParquetPartitions(path).read()['_source_file'].tolist(), ['a.csv', 'c.csv'])
+    
+    def test_refuses_foreign_directory(self):
+        """A non-empty directory without a manifest is not overwritten"""
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'notes.txt'), 'w') as f:
+                f.write('keep')
+            with self.assertRaises(ValueError):
+                ParquetPartitions(tmp)
+    
+    def test_cli_partitioned(self):
+        """--partitioned keeps a dataset in sync with the inputs of each run"""
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name, content in (('jan.csv', "ID,Amount\n1,10\n"), ('feb.csv', "ID,Amount\n2,20\n")):
+                paths.append(os.path.join(tmp, name))
+                with open(paths[-1], 'w') as f:
+                    f.write(content)
+            output = os.path.join(tmp, 'dataset')
+            self.assertEqual(app.cli([paths[0], '-o', output, '--partitioned', '-q']), 0)
+            self.assertEqual(app.cli(paths + ['-o', output, '--partitioned', '-q']), 0)
+            
+            self.assertEqual(pd.read_parquet(output)['Amount'].tolist(), [10, 20])
+            self.assertEqual(app.cli([paths[1], '-o', output, '--partitioned', '-q', '-f', 'csv']), 2)
+
 if __name__ == '__main__':
     # Create test suite
     loader = unittest.TestLoader()
@@ -246,6 +1807,27 @@ if __name__ == '__main__':
     # Add test classes
     suite.addTests(loader.loadTestsFromTestCase(TestFileMerger))
     suite.addTests(loader.loadTestsFromTestCase(TestDataValidation))
+    suite.addTests(loader.loadTestsFromTestCase(TestLazySheetStore))
+    suite.addTests(loader.loadTestsFromTestCase(TestReaderEngines))
+    suite.addTests(loader.loadTestsFromTestCase(TestParallelIngest))
+    suite.addTests(loader.loadTestsFromTestCase(TestIngestCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestStreamingMerge))
+    suite.addTests(loader.loadTestsFromTestCase(TestDtypeOptimization))
+    suite.addTests(loader.loadTestsFromTestCase(TestSchemaProbe))
+    suite.addTests(loader.loadTestsFromTestCase(TestExport))
+    suite.addTests(loader.loadTestsFromTestCase(TestProgress))
+    suite.addTests(loader.loadTestsFromTestCase(TestStageCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestCli))
+    suite.addTests(loader.loadTestsFromTestCase(TestMappingProfile))
+    suite.addTests(loader.loadTestsFromTestCase(TestHeaderMatcher))
+    suite.addTests(loader.loadTestsFromTestCase(TestMappingTable))
+    suite.addTests(loader.loadTestsFromTestCase(TestResultBrowser))
+    suite.addTests(loader.loadTestsFromTestCase(TestDeduplication))
+    suite.addTests(loader.loadTestsFromTestCase(TestColumnPruning))
+    suite.addTests(loader.loadTestsFromTestCase(TestDtypeReconciliation))
+    suite.addTests(loader.loadTestsFromTestCase(TestJoin))
+    suite.addTests(loader.loadTestsFromTestCase(TestQuery))
+    suite.addTests(loader.loadTestsFromTestCase(TestIncrementalMerge))
     
     # Run tests
     runner = unittest.TextTestRunner(verbosity=2)